@@ -10,6 +10,7 @@ import torch
 
 from nanochat.common import get_base_dir
 from nanochat.gpt import GPT, GPTConfig
+from nanochat.quantize import quantize_model, model_size_bytes
 from nanochat.tokenizer import get_tokenizer
 from nanochat.common import setup_default_logging
 
@@ -55,9 +56,10 @@ def load_checkpoint(checkpoint_dir, step, device, load_optimizer=False, rank=0):
     return model_data, optimizer_data, meta_data
 
 
-def build_model(checkpoint_dir, step, device, phase):
+def build_model(checkpoint_dir, step, device, phase, quantize=None, quantize_lm_head=False):
     """
     A bunch of repetitive code to build a model from a given checkpoint.
+    Optionally quantize the weights of the model for inference: quantize = int8|int4.
     Returns:
     - base model - uncompiled, not wrapped in DDP
     - tokenizer
@@ -82,6 +84,12 @@ def build_model(checkpoint_dir, step, device, phase):
     model.to_empty(device=device)
     model.init_weights() # note: this is dumb, but we need to init the rotary embeddings. TODO: fix model re-init
     model.load_state_dict(model_data, strict=True, assign=True)
+    # Weight-only quantization (inference only)
+    if quantize is not None:
+        assert phase == "eval", "quantized models are for inference only"
+        bits = {"int8": 8, "int4": 4}[quantize]
+        quantize_model(model, bits=bits, include_lm_head=quantize_lm_head)
+        log0(f"Quantized the model to {quantize}, size: {model_size_bytes(model) / 1024**2:.2f}MB")
     # Put the model in the right training phase / mode
     if phase == "eval":
         model.eval()
@@ -125,7 +133,7 @@ def find_last_step(checkpoint_dir):
 # -----------------------------------------------------------------------------
 # convenience functions that take into account nanochat's directory structure
 
-def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=None):
+def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=None, quantize=None, quantize_lm_head=False):
     if model_tag is None:
         # guess the model tag by defaulting to the largest model
         model_tag = find_largest_model(checkpoints_dir)
@@ -137,7 +145,7 @@ def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=Non
     assert step is not None, f"No checkpoints found in {checkpoint_dir}"
     # build the model
     log0(f"Loading model from {checkpoint_dir} with step {step}")
-    model, tokenizer, meta_data = build_model(checkpoint_dir, step, device, phase)
+    model, tokenizer, meta_data = build_model(checkpoint_dir, step, device, phase, quantize=quantize, quantize_lm_head=quantize_lm_head)
     return model, tokenizer, meta_data
 
 def load_model(source, *args, **kwargs):
@@ -3,6 +3,7 @@ Common utilities for nanochat.
 """
 
 import os
+import glob
 import re
 import logging
 import urllib.request
@@ -175,6 +176,46 @@ def compute_init(device_type="cuda"): # cuda|cpu|mps
 
     return ddp, ddp_rank, ddp_local_rank, ddp_world_size, device
 
+def _read_cpu_list(path):
+    # sysfs cpu lists look like "0-3,8-11"
+    cpus = []
+    with open(path, "r") as f:
+        for part in f.read().strip().split(","):
+            if part:
+                first, _, last = part.partition("-")
+                cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+def cpu_partitions(num_workers):
+    """
+    Split the cpus this process may run on into num_workers disjoint sets, e.g. for CPU inference processes.
+    The workers are spread evenly over the NUMA nodes when their number allows it, and the hyperthreads of
+    a physical core always go to the same worker. Returns a list of (cpus, num_threads), one thread per core.
+    """
+    available = os.sched_getaffinity(0)
+    node_paths = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    nodes = [[cpu for cpu in _read_cpu_list(path) if cpu in available] for path in sorted(node_paths, key=lambda p: int(re.findall(r"node(\d+)", p)[0]))]
+    nodes = [cpus for cpus in nodes if cpus]
+    if not nodes or num_workers % len(nodes) != 0:
+        nodes = [sorted(available)] # no NUMA info, or the workers can't be split evenly: ignore the nodes
+    workers_per_node = num_workers // len(nodes)
+    partitions = []
+    for cpus in nodes:
+        # group the cpus of the node by physical core
+        cores = {}
+        for cpu in cpus:
+            try:
+                siblings = tuple(_read_cpu_list(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"))
+            except OSError:
+                siblings = (cpu,)
+            cores.setdefault(siblings, []).append(cpu)
+        cores = list(cores.values())
+        assert len(cores) >= workers_per_node, f"{num_workers} workers but only {len(cores)} cores per NUMA node"
+        for i in range(workers_per_node):
+            chunk = cores[i * len(cores) // workers_per_node:(i + 1) * len(cores) // workers_per_node]
+            partitions.append(([cpu for core in chunk for cpu in core], len(chunk)))
+    return partitions
+
 def compute_cleanup():
     """Companion function to compute_init, to clean things up before script exit"""
     if is_ddp():
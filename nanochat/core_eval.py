@@ -11,6 +11,9 @@ from jinja2 import Template
 import torch
 import torch.distributed as dist
 
+from nanochat.gpt import GPT
+from nanochat.engine import Engine
+
 # -----------------------------------------------------------------------------
 # Prompt rendering utilities
 
@@ -165,7 +168,7 @@ def forward_model(model, input_ids):
 
 
 @torch.no_grad()
-def evaluate_example(idx, model, tokenizer, data, device, task_meta):
+def evaluate_example(idx, model, tokenizer, data, device, task_meta, engine=None):
     """Evaluate a single example, return True if correct, False otherwise"""
     item = data[idx]
     task_type = task_meta['task_type']
@@ -212,6 +215,17 @@ def evaluate_example(idx, model, tokenizer, data, device, task_meta):
                 new_end_idxs.append(e)
         tokens, start_idxs, end_idxs = new_tokens, new_start_idxs, new_end_idxs
 
+    # With an Engine, score the continuations directly: each distinct context is forwarded once for all
+    # of its continuations, and the lm_head only runs at the positions of the continuations
+    if engine is not None:
+        contexts = [t[:si] for t, si in zip(tokens, start_idxs)]
+        continuations = [t[si:ei] for t, si, ei in zip(tokens, start_idxs, end_idxs)]
+        scores = engine.score(contexts, continuations)
+        if task_type == 'language_modeling':
+            return scores[0][2] # all the continuation tokens are the greedy prediction
+        mean_logprobs = [mean_logprob for _, mean_logprob, _ in scores]
+        return mean_logprobs.index(max(mean_logprobs)) == item['gold']
+
     # Stack up all the sequences into a batch
     pad_token_id = tokenizer.get_bos_token_id() # use BOS as pad token is ok
     input_ids = stack_sequences(tokens, pad_token_id)
@@ -249,10 +263,16 @@ def evaluate_task(model, tokenizer, data, device, task_meta):
     rank = dist.get_rank() if dist.is_initialized() else 0
     world_size = dist.get_world_size() if dist.is_initialized() else 1
     correct = torch.zeros(len(data), dtype=torch.float32, device=device)
+    # our own models are scored through the Engine, others (e.g. HuggingFace models) with a plain forward
+    engine = Engine(model, tokenizer) if isinstance(model, GPT) else None
     # stride the examples to each rank
-    for idx in range(rank, len(data), world_size):
-        is_correct = evaluate_example(idx, model, tokenizer, data, device, task_meta)
-        correct[idx] = float(is_correct)
+    try:
+        for idx in range(rank, len(data), world_size):
+            is_correct = evaluate_example(idx, model, tokenizer, data, device, task_meta, engine=engine)
+            correct[idx] = float(is_correct)
+    finally:
+        if engine is not None:
+            engine.release() # e.g. during training, the KV cache must not hold on to its memory
     # sync results across all the processes if running distributed
     if world_size > 1:
         dist.barrier()
@@ -14,11 +14,15 @@ The whole thing is made as efficient as possible.
 import torch
 import torch.nn.functional as F
 import signal
+import threading
+import time
 import warnings
 from contextlib import contextmanager
-from collections import deque
+from collections import deque, OrderedDict
+import concurrent.futures
 from nanochat.common import compute_init, autodetect_device_type
 from nanochat.checkpoint_manager import load_model
+from nanochat.gpt import apply_rotary_emb
 from contextlib import nullcontext 
 
 # -----------------------------------------------------------------------------
@@ -28,6 +32,11 @@ def timeout(duration, formula):
     def timeout_handler(signum, frame):
         raise Exception(f"'{formula}': timed out after {duration} seconds")
 
+    # SIGALRM only works on the main thread. Elsewhere (e.g. a ToolRunner thread) there is no timeout,
+    # but use_calculator only lets through expressions that can't blow up (no **, no string repetition)
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
     signal.signal(signal.SIGALRM, timeout_handler)
     signal.alarm(duration)
     yield
@@ -40,7 +49,8 @@ def eval_with_timeout(formula, max_time=3):
                 warnings.simplefilter("ignore", SyntaxWarning)
                 return eval(formula, {"__builtins__": {}}, {})
     except Exception as e:
-        signal.alarm(0)
+        if threading.current_thread() is threading.main_thread():
+            signal.alarm(0)
         # print(f"Warning: Failed to eval {formula}, exception: {e}") # it's ok ignore wrong calculator usage
         return None
 
@@ -79,6 +89,54 @@ def use_calculator(expr):
     # Evaluate with timeout
     return eval_with_timeout(expr)
 
+class ToolRunner:
+    """
+    Runs the tool calls of the rows off of the decode loop, on a thread pool, so that a row waiting
+    for its tool output doesn't hold up the others. Results are memoized per expression (LRU), and
+    identical calls in flight at the same time (e.g. the samples of one prompt) share one evaluation.
+    With python=True, expressions the calculator rejects run as real Python in the nanochat.execution
+    sandbox (a separate process, with time and memory limits), and their stdout is the output. Python
+    outputs are not memoized: the code need not be deterministic, and it may come from different users.
+    A tool that fails outputs the error (e.g. "Error: ..."), it never takes the decode loop down with it.
+    """
+
+    def __init__(self, max_workers=4, python=False, cache_size=4096):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self.python = python
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # expression -> Future of its result
+        self.lock = threading.Lock()
+
+    def submit(self, expr):
+        """Start evaluating expr (unless it was already) and return the Future of its result (None if it failed)."""
+        with self.lock:
+            future = self.cache.get(expr)
+            if future is not None:
+                self.cache.move_to_end(expr)
+                return future
+            future = self.executor.submit(self.run, expr)
+            self.cache[expr] = future
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return future
+
+    def run(self, expr):
+        try:
+            result = use_calculator(expr)
+            if result is None and self.python:
+                with self.lock:
+                    self.cache.pop(expr, None) # the calls from now on run the code again
+                from nanochat.execution import execute_code
+                outcome = execute_code(expr)
+                output = outcome.stdout.strip()
+                result = output if outcome.success and output else None
+        except Exception as e:
+            result = f"Error: {type(e).__name__}: {e}"
+        return result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
 # -----------------------------------------------------------------------------
 class KVCache:
     """
@@ -91,6 +149,7 @@ class KVCache:
         self.kv_shape = (num_layers, 2, batch_size, num_heads, seq_len, head_dim)
         self.kv_cache = None
         self.pos = 0 # current position in time in the cache
+        self.attn_mask = None # all rows move in lockstep, so the model builds its own causal mask
 
     def reset(self):
         self.pos = 0
@@ -98,6 +157,9 @@ class KVCache:
     def get_pos(self):
         return self.pos
 
+    def get_row_pos(self):
+        return None # all rows are at the same position
+
     def prefill(self, other):
         """
         Prefill given another KV cache. Optionally expand along batch dim.
@@ -159,6 +221,444 @@ class KVCache:
             self.pos = t1
         return key_view, value_view
 
+# -----------------------------------------------------------------------------
+# Paged KV cache: fixed-size blocks from a shared arena, per-row block tables
+
+class KVBlockPool:
+    """
+    An arena of fixed-size KV blocks that many rows (sequences) allocate from.
+    A block holds block_size consecutive positions of K and V for every layer of the
+    Transformer, i.e. the arena is of shape (num_layers, 2, num_blocks, block_size, H, D).
+    Blocks are reference counted so that rows can share them (copy-on-write), e.g. the
+    prompt blocks across the samples of Engine.generate. The arena is allocated lazily
+    (to know the dtype/device) and doubles in size if it ever runs out of blocks, up to
+    max_blocks (None = no limit). With num_blocks == max_blocks, it is allocated once and
+    for all. Out of blocks at max_blocks, reclaim gets a chance to free some (the prefix
+    cache evicts its least recently used ones), then allocate raises a RuntimeError.
+    The storage dtype of the KV (kv_dtype) is independent of the activations:
+    - None: same dtype as the activations
+    - "bfloat16": half the memory of fp32 activations (e.g. on CPU)
+    - "int8": a quarter of fp32, with a scale per (token, head) in a side arena
+    """
+
+    def __init__(self, num_heads, head_dim, num_layers, block_size=16, num_blocks=256, kv_dtype=None, max_blocks=None):
+        assert kv_dtype in (None, "bfloat16", "int8"), f"Unsupported kv_dtype: {kv_dtype}"
+        assert max_blocks is None or max_blocks >= num_blocks, "max_blocks can't be less than num_blocks"
+        self.block_size = block_size
+        self.shape = (num_layers, 2, num_blocks, block_size, num_heads, head_dim)
+        self.kv_dtype = kv_dtype
+        self.max_blocks = max_blocks
+        self.reclaim = None # called when out of blocks at max_blocks, e.g. PrefixCache.reclaim
+        self.arena = None
+        self.scales = None # (num_layers, 2, num_blocks, block_size, H), for int8 only
+        self.refcount = [0] * num_blocks
+        self.free_blocks = list(range(num_blocks - 1, -1, -1)) # stack, pops the lowest block id first
+        self._scratch = None
+
+    def init_arena(self, dtype, device):
+        if self.arena is None:
+            storage_dtype = {None: dtype, "bfloat16": torch.bfloat16, "int8": torch.int8}[self.kv_dtype]
+            # zeroed, not empty: masked attention still reads the unwritten slots, and garbage there (NaN/inf) leaks through
+            self.arena = torch.zeros(self.shape, dtype=storage_dtype, device=device)
+            if self.kv_dtype == "int8":
+                self.scales = torch.zeros(self.shape[:-1], dtype=torch.float32, device=device)
+
+    def store(self, layer_idx, k, v, blocks, offsets):
+        """Write k, v of shape (B, T, H, D) at the (blocks, offsets) of shape (B, T), quantizing if need be."""
+        for kv_idx, x in ((0, k), (1, v)):
+            if self.kv_dtype == "int8":
+                # symmetric quantization with one scale per token and head
+                scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / 127.0
+                self.arena[layer_idx, kv_idx][blocks, offsets] = (x.float() / scale).round().clamp(-127, 127).to(torch.int8)
+                self.scales[layer_idx, kv_idx][blocks, offsets] = scale.squeeze(-1)
+            else:
+                self.arena[layer_idx, kv_idx][blocks, offsets] = x.to(self.arena.dtype)
+
+    def load(self, layer_idx, tables, dtype):
+        """
+        Read K, V through block tables (B, num_blocks), as (B, num_blocks * block_size, H, D) of dtype.
+        The tables can also be a range of consecutive blocks (a single row): the read is then a view of
+        the arena instead of a gathered copy (unless it has to be dequantized/converted anyway).
+        """
+        index = slice(tables.start, tables.stop) if isinstance(tables, range) else tables
+        k, v = self.arena[layer_idx, 0][index], self.arena[layer_idx, 1][index] # (B, num_blocks, block_size, H, D)
+        if self.kv_dtype == "int8":
+            # dequantize as part of the gather: the full precision KV never exists outside of this read
+            k = k.to(dtype) * self.scales[layer_idx, 0][index].unsqueeze(-1).to(dtype)
+            v = v.to(dtype) * self.scales[layer_idx, 1][index].unsqueeze(-1).to(dtype)
+        if isinstance(tables, range):
+            k, v = k.unsqueeze(0), v.unsqueeze(0)
+        return k.flatten(1, 2).to(dtype), v.flatten(1, 2).to(dtype)
+
+    def bytes_per_block(self):
+        if self.arena is None:
+            return 0
+        num_bytes = self.arena[:, :, 0].numel() * self.arena.element_size()
+        if self.scales is not None:
+            num_bytes += self.scales[:, :, 0].numel() * self.scales.element_size()
+        return num_bytes
+
+    def num_blocks(self):
+        return self.shape[2]
+
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def _grow(self):
+        # (the old and the new arena are both alive during the copy: preallocate with max_blocks to avoid that)
+        num_old = self.num_blocks()
+        num_new = num_old if self.max_blocks is None else min(num_old, self.max_blocks - num_old)
+        shape = list(self.shape)
+        shape[2] = num_old + num_new
+        if self.arena is not None:
+            additional_arena = torch.zeros((*shape[:2], num_new, *shape[3:]), dtype=self.arena.dtype, device=self.arena.device)
+            self.arena = torch.cat([self.arena, additional_arena], dim=2)
+        if self.scales is not None:
+            additional_scales = torch.zeros((*shape[:2], num_new, *shape[3:-1]), dtype=self.scales.dtype, device=self.scales.device)
+            self.scales = torch.cat([self.scales, additional_scales], dim=2)
+        self.shape = tuple(shape)
+        self.refcount.extend([0] * num_new)
+        self.free_blocks = list(range(num_old + num_new - 1, num_old - 1, -1)) + self.free_blocks
+
+    def allocate(self, after=None):
+        """A free block, preferably the one right after block `after` (then a row's blocks are consecutive, see load)."""
+        if not self.free_blocks:
+            if self.max_blocks is None or self.num_blocks() < self.max_blocks:
+                self._grow()
+            elif self.reclaim is not None:
+                self.reclaim()
+            if not self.free_blocks:
+                raise RuntimeError(f"Out of KV cache blocks, all {self.num_blocks()} of them are in use")
+        if after is not None and after + 1 < self.num_blocks() and self.refcount[after + 1] == 0:
+            block = after + 1
+            self.free_blocks.remove(block)
+        else:
+            block = self.free_blocks.pop()
+        self.refcount[block] = 1
+        return block
+
+    def scratch_block(self):
+        """A block that belongs to no row: the padding of fixed-shape block tables can safely write into it."""
+        if self._scratch is None:
+            self._scratch = self.allocate()
+        return self._scratch
+
+    def incref(self, block):
+        self.refcount[block] += 1
+
+    def decref(self, block):
+        assert self.refcount[block] > 0, f"Block {block} is already free"
+        self.refcount[block] -= 1
+        if self.refcount[block] == 0:
+            self.free_blocks.append(block)
+
+    def copy_block(self, block):
+        """Allocate a new block holding a copy of the given one."""
+        new_block = self.allocate()
+        if self.arena is not None:
+            self.arena[:, :, new_block] = self.arena[:, :, block]
+        if self.scales is not None:
+            self.scales[:, :, new_block] = self.scales[:, :, block]
+        return new_block
+
+
+class BlockTable:
+    """
+    A single row of a paged KV cache: its blocks (in order) and how many positions are cached.
+    The length counts the tokens of the sequence the row went through. With a KV window (see Engine.evict),
+    num_evicted of them were evicted from position evict_start on, and the blocks hold kv_length() positions.
+    """
+
+    def __init__(self, pool, blocks=None, length=0):
+        self.pool = pool
+        self.blocks = blocks if blocks is not None else []
+        self.length = length
+        self.num_evicted = 0
+        self.evict_start = 0
+
+    def kv_length(self):
+        return self.length - self.num_evicted
+
+    def fork(self):
+        """A new row that shares all the blocks of this one (copy-on-write)."""
+        for block in self.blocks:
+            self.pool.incref(block)
+        row = BlockTable(self.pool, self.blocks.copy(), self.length)
+        row.num_evicted, row.evict_start = self.num_evicted, self.evict_start
+        return row
+
+    def prepare_write(self, num_new, start=None):
+        """Make sure that positions [start, start + num_new) (default: the end) map to blocks owned by this row only."""
+        block_size = self.pool.block_size
+        start = self.kv_length() if start is None else start
+        first, last = start // block_size, (start + num_new - 1) // block_size
+        for i in range(first, last + 1):
+            if i == len(self.blocks):
+                self.blocks.append(self.pool.allocate(after=self.blocks[-1] if self.blocks else None))
+            elif self.pool.refcount[self.blocks[i]] > 1:
+                # copy-on-write: the block is shared with other rows, make a private copy first
+                shared_block = self.blocks[i]
+                self.blocks[i] = self.pool.copy_block(shared_block)
+                self.pool.decref(shared_block)
+
+    def can_truncate(self, length):
+        """Rolling back is possible as long as it doesn't land on evicted tokens."""
+        return self.num_evicted == 0 or length <= self.evict_start or length - self.num_evicted >= self.evict_start
+
+    def truncate(self, length):
+        """Roll the row back to its first length positions, freeing the blocks that are no longer needed."""
+        assert 0 <= length <= self.length, f"Cannot truncate a row of length {self.length} to {length}"
+        assert self.can_truncate(length), f"Cannot truncate a row to {length}, its tokens were evicted"
+        if length <= self.evict_start:
+            self.num_evicted = 0 # back within the attention sinks, nothing after them is left
+        self.length = length
+        num_keep = -(-self.kv_length() // self.pool.block_size)
+        for block in self.blocks[num_keep:]:
+            self.pool.decref(block)
+        del self.blocks[num_keep:]
+
+    def release(self):
+        self.truncate(0)
+
+
+class PagedKVCache:
+    """
+    Works hand-in-hand with the GPT model just like KVCache, but the K/V of each row live in
+    blocks of a KVBlockPool and are read back through the row's block table. Rows can be at
+    different positions (ragged batch), in which case we also provide the attention mask.
+    A PagedKVCache is a cheap view over a list of BlockTables: build one for whichever rows
+    should be forwarded together, the rows themselves persist across forward passes.
+    Note that the row lengths advance automatically after the last layer of the Transformer inserts.
+    """
+
+    def __init__(self, pool, rows):
+        self.pool = pool
+        self.rows = rows
+        self.attn_mask = None
+
+    def get_pos(self):
+        return max(row.kv_length() for row in self.rows)
+
+    def get_row_pos(self):
+        lengths = [row.kv_length() for row in self.rows]
+        if all(n == lengths[0] for n in lengths):
+            return None # all rows are at the same position
+        return torch.tensor(lengths, dtype=torch.long, device=self.pool.arena.device)
+
+    def insert_kv(self, layer_idx, k, v):
+        B, H, T_add, D = k.size()
+        assert B == len(self.rows), f"Batch size mismatch: {B} != {len(self.rows)}"
+        # The block bookkeeping is the same for all layers, so only do it once at layer 0
+        if layer_idx == 0:
+            self._begin_forward(T_add, k.device, k.dtype)
+        # Write the new keys/values into each row's blocks
+        write_blocks, write_offsets = self._write_idx
+        self.pool.store(layer_idx, k.transpose(1, 2), v.transpose(1, 2), write_blocks, write_offsets)
+        # Read the keys/values back through the block tables: (B, num_blocks * block_size, H, D) -> (B, H, Tk, D)
+        key_view, value_view = self.pool.load(layer_idx, self._tables, k.dtype)
+        key_view = key_view.transpose(1, 2)[:, :, :self._Tk]
+        value_view = value_view.transpose(1, 2)[:, :, :self._Tk]
+        # Advance the rows after the last layer of the Transformer processes
+        if layer_idx == self.pool.shape[0] - 1:
+            for row in self.rows:
+                row.length += T_add
+        return key_view, value_view
+
+    def _begin_forward(self, T_add, device, dtype):
+        self.pool.init_arena(dtype, device)
+        block_size = self.pool.block_size
+        for row in self.rows:
+            row.prepare_write(T_add)
+        lengths = [row.kv_length() for row in self.rows]
+        self._Tk = max(lengths) + T_add
+        num_blocks = -(-self._Tk // block_size)
+        # Block tables, padded with block 0 (reads of the padding are never attended to)
+        tables = [row.blocks[:num_blocks] + [0] * (num_blocks - len(row.blocks)) for row in self.rows]
+        tables_tensor = torch.tensor(tables, dtype=torch.long, device=device) # (B, num_blocks)
+        row_pos = torch.tensor(lengths, dtype=torch.long, device=device)
+        pos = row_pos[:, None] + torch.arange(T_add, device=device) # (B, T) positions being written
+        self._write_idx = (tables_tensor.gather(1, pos // block_size), pos % block_size)
+        # a single row whose blocks are consecutive in the arena (the usual case) is read as a view, without a gather
+        first = tables[0][0]
+        consecutive = len(tables) == 1 and tables[0] == list(range(first, first + num_blocks))
+        self._tables = range(first, first + num_blocks) if consecutive else tables_tensor
+        if all(n == lengths[0] for n in lengths):
+            self.attn_mask = None # lockstep: the model builds the usual causal mask
+        else:
+            # query at time t of row b sees all the keys up to and including its own position
+            self.attn_mask = (torch.arange(self._Tk, device=device) <= pos[:, :, None]).unsqueeze(1) # (B, 1, T, Tk)
+
+
+class StaticKVCache:
+    """
+    A fixed-shape view over rows of a KVBlockPool, for decode steps that can be compiled with
+    torch.compile(fullgraph=True) (and captured as CUDA graphs). The block tables are padded to a
+    fixed number of blocks, the positions of the rows are a device tensor, and the attention mask
+    over the whole (padded) tables is computed from them on the device: nothing in insert_kv
+    depends on Python values that change from one step to the next. The caller (Engine) allocates
+    the blocks beforehand and advances the row lengths afterwards.
+    """
+
+    def __init__(self, pool, tables, pos):
+        self.pool = pool
+        self.tables = tables # (B, num_blocks) block tables, padded with a scratch block
+        self.pos = pos # (B,) the position at which each row writes
+        self.attn_mask = None
+
+    def get_row_pos(self):
+        return self.pos
+
+    def insert_kv(self, layer_idx, k, v):
+        B, H, T_add, D = k.size()
+        block_size = self.pool.block_size
+        if layer_idx == 0:
+            pos = self.pos[:, None] + torch.arange(T_add, device=k.device) # (B, T)
+            self._write_idx = (self.tables.gather(1, pos // block_size), pos % block_size)
+            Tk = self.tables.size(1) * block_size
+            self.attn_mask = (torch.arange(Tk, device=k.device) <= pos[:, :, None]).unsqueeze(1) # (B, 1, T, Tk)
+        write_blocks, write_offsets = self._write_idx
+        self.pool.store(layer_idx, k.transpose(1, 2), v.transpose(1, 2), write_blocks, write_offsets)
+        key_view, value_view = self.pool.load(layer_idx, self.tables, k.dtype)
+        return key_view.transpose(1, 2), value_view.transpose(1, 2)
+
+
+# -----------------------------------------------------------------------------
+# Prefix cache: radix tree from token ids to KV blocks
+
+class RadixNode:
+    def __init__(self, parent=None, tokens=(), blocks=None):
+        self.parent = parent
+        self.tokens = tokens # the token ids along the edge into this node (a whole number of blocks)
+        self.blocks = blocks if blocks is not None else [] # the KV blocks holding these tokens
+        self.children = {} # first block of tokens of the child's edge -> child node
+        self.last_access = 0
+
+class PrefixCache:
+    """
+    Radix tree over token ids whose edges map to the KV blocks of a KVBlockPool, so that a new
+    request only has to prefill the part of its prompt that was not seen before, e.g. the previous
+    turns of a multi-turn chat. Only full blocks are cached, and the tree holds a reference on each
+    of its blocks, so they stay alive (and immutable, thanks to copy-on-write) after the rows that
+    computed them are released. If the tree grows over max_bytes, the least recently used blocks
+    are evicted, from the tail of the least recently used leaves.
+    """
+
+    def __init__(self, pool, max_bytes):
+        self.pool = pool
+        self.max_bytes = max_bytes
+        self.root = RadixNode()
+        self.num_blocks = 0 # number of blocks referenced by the tree
+        self.clock = 0 # logical time for the LRU bookkeeping
+
+    def _key(self, tokens, start=0):
+        return tuple(tokens[start:start + self.pool.block_size])
+
+    def _num_matching_blocks(self, node, tokens, start):
+        # number of leading blocks of the node's edge that match tokens[start:]
+        block_size = self.pool.block_size
+        n = 0
+        while n < len(node.blocks):
+            i, j = n * block_size, start + n * block_size
+            if j + block_size > len(tokens) or tuple(node.tokens[i:i + block_size]) != tuple(tokens[j:j + block_size]):
+                break
+            n += 1
+        return n
+
+    def match(self, tokens):
+        """Returns a new BlockTable (a row of the paged cache) holding the longest cached prefix of tokens."""
+        self.clock += 1
+        node, blocks, start = self.root, [], 0
+        while True:
+            child = node.children.get(self._key(tokens, start))
+            if child is None:
+                break
+            n = self._num_matching_blocks(child, tokens, start)
+            child.last_access = self.clock
+            blocks.extend(child.blocks[:n])
+            start += n * self.pool.block_size
+            if n < len(child.blocks):
+                break
+            node = child
+        for block in blocks:
+            self.pool.incref(block)
+        return BlockTable(self.pool, blocks, start)
+
+    def _split(self, node, n):
+        # split the edge into node after its first n blocks, returns the new node in the middle
+        block_size = self.pool.block_size
+        mid = RadixNode(node.parent, node.tokens[:n * block_size], node.blocks[:n])
+        mid.last_access = node.last_access
+        node.parent.children[self._key(mid.tokens)] = mid
+        node.parent = mid
+        node.tokens, node.blocks = node.tokens[n * block_size:], node.blocks[n:]
+        mid.children[self._key(node.tokens)] = node
+        return mid
+
+    def insert(self, tokens, blocks):
+        """Cache the full blocks of a row, where blocks hold the KV of (a prefix of) tokens."""
+        self.clock += 1
+        block_size = self.pool.block_size
+        num_full = min(len(blocks), len(tokens) // block_size)
+        node, i = self.root, 0 # i counts blocks
+        while i < num_full:
+            child = node.children.get(self._key(tokens, i * block_size))
+            if child is None:
+                # new leaf for the rest of the row
+                leaf = RadixNode(node, tuple(tokens[i * block_size:num_full * block_size]), blocks[i:num_full])
+                leaf.last_access = self.clock
+                node.children[self._key(leaf.tokens)] = leaf
+                for block in leaf.blocks:
+                    self.pool.incref(block)
+                self.num_blocks += len(leaf.blocks)
+                break
+            n = self._num_matching_blocks(child, tokens[:num_full * block_size], i * block_size)
+            if n < len(child.blocks):
+                child = self._split(child, n)
+            child.last_access = self.clock
+            node, i = child, i + n
+        self._evict()
+
+    def num_bytes(self):
+        return self.num_blocks * self.pool.bytes_per_block()
+
+    def _evict(self):
+        bytes_per_block = self.pool.bytes_per_block()
+        while self.num_blocks > 0 and self.num_blocks * bytes_per_block > self.max_bytes:
+            self._drop_blocks(-(-(self.num_blocks * bytes_per_block - self.max_bytes) // bytes_per_block))
+
+    def num_reclaimable_blocks(self):
+        """Number of blocks that only the tree holds on to: reclaim can free them for the rows."""
+        num_blocks, stack = 0, [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            num_blocks += sum(self.pool.refcount[block] == 1 for block in node.blocks)
+        return num_blocks
+
+    def reclaim(self):
+        """Evict the least recently used blocks until the pool has a free block again (the tree may share its blocks with rows)."""
+        while self.num_blocks > 0 and self.pool.num_free_blocks() == 0:
+            self._drop_blocks(1)
+
+    def _drop_blocks(self, num_blocks):
+        # find the least recently used leaf and drop (up to num_blocks of) the last blocks of its edge
+        leaves, stack = [], [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if not node.children and node is not self.root:
+                leaves.append(node)
+        leaf = min(leaves, key=lambda node: node.last_access)
+        num_drop = min(len(leaf.blocks), num_blocks)
+        num_keep = len(leaf.blocks) - num_drop
+        for block in leaf.blocks[num_keep:]:
+            self.pool.decref(block)
+        self.num_blocks -= num_drop
+        if num_keep == 0:
+            del leaf.parent.children[self._key(leaf.tokens)]
+        leaf.blocks = leaf.blocks[:num_keep]
+        leaf.tokens = leaf.tokens[:num_keep * self.pool.block_size]
+
 
 # -----------------------------------------------------------------------------
 @torch.inference_mode()
@@ -179,128 +679,1048 @@ def sample_next_token(logits, rng, temperature=1.0, top_k=None):
         probs = F.softmax(logits, dim=-1)
         return torch.multinomial(probs, num_samples=1, generator=rng)
 
+def process_logits(logits, temperature=1.0, top_k=None, top_p=None, min_p=None,
+                   repetition_penalty=None, frequency_penalty=None, presence_penalty=None, token_counts=None):
+    """
+    The logits processor chain of sample_rows, vectorized over the rows of logits (B, vocab_size).
+    Every parameter is either a number (same for all rows) or a (B,) tensor (one value per row), None
+    turns it off, and so does top_k <= 0. The penalties need token_counts (B, vocab_size): how many
+    times each row already generated each token. Rows with a temperature of 0 are greedy.
+    Returns the processed logits, with -inf for the tokens that were filtered out.
+    """
+    B, V = logits.shape
+    device = logits.device
+    logits = logits.float()
+    per_row = lambda x: torch.as_tensor(x, dtype=torch.float32, device=device).expand(B)[:, None] # (B, 1)
+    # 1) Penalties for the tokens that each row generated already
+    if token_counts is not None:
+        counts = token_counts.float()
+        seen = counts > 0
+        if repetition_penalty is not None: # https://arxiv.org/abs/1909.05858
+            penalty = per_row(repetition_penalty)
+            logits = torch.where(seen, torch.where(logits > 0, logits / penalty, logits * penalty), logits)
+        if frequency_penalty is not None:
+            logits = logits - per_row(frequency_penalty) * counts
+        if presence_penalty is not None:
+            logits = logits - per_row(presence_penalty) * seen.float()
+    # 2) Temperature (the greedy rows keep their logits, all but the argmax gets filtered out below)
+    temperature = per_row(temperature)
+    greedy = temperature == 0
+    logits = logits / torch.where(greedy, torch.ones_like(temperature), temperature)
+    # 3) Truncation: top-k, then top-p and min-p on what's left, all on the sorted logits
+    sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+    ranks = torch.arange(V, device=device)[None, :]
+    remove = greedy & (ranks > 0)
+    if top_k is not None:
+        k = per_row(top_k)
+        remove |= (k > 0) & (ranks >= k)
+    if top_p is not None or min_p is not None:
+        probs = F.softmax(sorted_logits.masked_fill(remove, float("-inf")), dim=-1)
+        if top_p is not None: # smallest set of tokens with a total probability of at least top_p
+            remove |= probs.cumsum(dim=-1) - probs > per_row(top_p)
+        if min_p is not None: # tokens at least min_p times as likely as the most likely one
+            remove |= probs < per_row(min_p) * probs[:, :1]
+    sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+    return torch.full_like(logits, float("-inf")).scatter(1, sorted_idx, sorted_logits)
+
+def sample_rows(logits, generators, **kwargs):
+    """
+    Sample a next token for each row of logits (B, vocab_size) after process_logits(logits, **kwargs),
+    each row with its own generator, so that it samples the same tokens whatever else is in the batch.
+    Returns (B, 1).
+    """
+    probs = F.softmax(process_logits(logits, **kwargs), dim=-1)
+    # exponential race: argmax(probs / E) with E ~ Exp(1) is a sample from probs, only the noise is per row
+    noise = torch.stack([torch.empty(probs.size(-1), device=probs.device).exponential_(generator=g) for g in generators])
+    return (probs / noise).argmax(dim=-1, keepdim=True)
+
+def sampling_probs(logits, temperature=1.0, top_k=None):
+    """The distribution that sample_next_token samples from (temperature > 0), as probs of shape (..., vocab_size)."""
+    assert temperature > 0.0, "greedy decoding has no distribution to speak of"
+    if top_k is not None:
+        k = min(top_k, logits.size(-1))
+        vals, _ = torch.topk(logits, k, dim=-1)
+        logits = logits.masked_fill(logits < vals[..., -1:], -float('inf'))
+    return F.softmax(logits / temperature, dim=-1)
+
+def prompt_lookup(tokens, max_ngram_size, num_tokens):
+    """
+    Prompt lookup decoding (https://github.com/apoorvumang/prompt-lookup-decoding): find the most
+    recent earlier occurrence of the trailing n-gram of tokens (longest n first) and propose the
+    (at most num_tokens) tokens that followed it. Returns an empty list if there is no match.
+    """
+    for n in range(min(max_ngram_size, len(tokens) - 1), 0, -1):
+        ngram = tokens[-n:]
+        for start in range(len(tokens) - n - 1, -1, -1):
+            if tokens[start:start + n] == ngram:
+                return tokens[start + n:start + n + num_tokens]
+    return []
+
 # -----------------------------------------------------------------------------
 
+class CancelToken:
+    """
+    Cancels the generation(s) it's handed to, e.g. when the client went away, or once a deadline (in
+    time.monotonic() seconds) has passed. Safe to cancel from another thread, it's checked every decode step.
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_cancelled(self):
+        return self.cancelled or (self.deadline is not None and time.monotonic() >= self.deadline)
+
 class RowState:
     # Per-row state tracking during generation
     def __init__(self, current_tokens=None):
         self.current_tokens = current_tokens or [] # Current token sequence for this row
         self.forced_tokens = deque() # Queue of tokens to force inject
+        self.lookahead = deque() # sampled tokens the row emits next, already verified (speculative decoding) and in its KV cache
         self.in_python_block = False # Whether we are inside a python block
         self.python_expr_tokens = [] # Tokens of the current python expression
         self.completed = False # Whether this row has completed generation
+        self.pending_tool = None # Future of the output of a tool call that is still running (with a ToolRunner)
+        self.grammar = None # Grammar that constrains the tokens of this row, if any (see nanochat/grammar.py)
+        self.grammar_state = None # state of the row in the DFA of its grammar
+
+    def set_grammar(self, grammar):
+        self.grammar = grammar
+        self.grammar_state = grammar.start
+        self.forced_tokens.extend(grammar.jump_forward(grammar.start)) # e.g. the opening of a JSON object
+
+    def tokens_from(self, start):
+        """The tokens of the row from position start on, its lookahead included."""
+        num_current = len(self.current_tokens)
+        return self.current_tokens[start:] + list(self.lookahead)[max(start - num_current, 0):]
+
+    def may_force(self):
+        """Are there tokens to force next, or a tool call in flight whose output may have to be?"""
+        return len(self.forced_tokens) > 0 or self.pending_tool is not None
+
+    def tool_ready(self):
+        """False while the row waits for the output of its tool call: it can't choose its next token yet."""
+        return self.pending_tool is None or self.pending_tool.done()
+
+    def fork(self):
+        """An independent copy of this state, e.g. for a beam that branches off of this one."""
+        state = RowState(self.current_tokens.copy())
+        state.forced_tokens = deque(self.forced_tokens)
+        state.lookahead = deque(self.lookahead)
+        state.in_python_block = self.in_python_block
+        state.python_expr_tokens = self.python_expr_tokens.copy()
+        state.completed = self.completed
+        state.pending_tool = self.pending_tool # futures can be shared
+        state.grammar = self.grammar
+        state.grammar_state = self.grammar_state
+        return state
+
+class GenerationStats:
+    """
+    Aggregates the records that the Engine emits to its hooks (see Engine.add_hook): prefill throughput,
+    time to first token, decode step latency, batch occupancy, sampled vs forced tokens, KV bytes in use.
+    Latencies are kept for the last `window` steps/generations, for the percentiles.
+    """
+
+    def __init__(self, window=10000):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.num_prefills = 0
+        self.prefill_tokens = 0
+        self.prefill_cached_tokens = 0
+        self.prefill_time = 0.0
+        self.num_steps = 0
+        self.step_time = 0.0
+        self.step_rows = 0 # sum of the batch sizes, for the occupancy
+        self.step_columns = 0 # tokens per row emitted by the steps (> 1 with speculation or sync_every)
+        self.sampled_tokens = 0
+        self.forced_tokens = 0
+        self.kv_bytes = 0
+        self.kv_bytes_peak = 0
+        self.num_finished = 0
+        self.generated_tokens = 0
+        self.step_latencies = deque(maxlen=self.window)
+        self.ttfts = deque(maxlen=self.window)
+
+    def on_prefill(self, record):
+        self.num_prefills += 1
+        self.prefill_tokens += record["num_tokens"]
+        self.prefill_cached_tokens += record["num_cached_tokens"]
+        self.prefill_time += record["time"]
+
+    def on_step(self, record):
+        self.num_steps += 1
+        self.step_time += record["time"]
+        self.step_rows += record["batch_size"]
+        self.step_columns += record["num_columns"]
+        self.sampled_tokens += record["num_sampled"]
+        self.forced_tokens += record["num_forced"]
+        self.kv_bytes = record["kv_bytes"]
+        self.kv_bytes_peak = max(self.kv_bytes_peak, record["kv_bytes"])
+        self.step_latencies.append(record["time"])
+
+    def on_finish(self, record):
+        self.num_finished += record["num_rows"]
+        self.generated_tokens += record["num_generated_tokens"]
+        if record["time_to_first_token"] is not None:
+            self.ttfts.append(record["time_to_first_token"])
+
+    def summary(self):
+        """The aggregates as a flat dict of numbers, e.g. to log or to serve as JSON."""
+        percentile = lambda xs, q: sorted(xs)[min(int(q * len(xs)), len(xs) - 1)] if xs else 0.0
+        mean = lambda total, n: total / n if n else 0.0
+        return {
+            "num_prefills": self.num_prefills,
+            "prefill_tokens": self.prefill_tokens,
+            "prefill_cached_tokens": self.prefill_cached_tokens,
+            "prefill_tokens_per_sec": mean(self.prefill_tokens, self.prefill_time),
+            "num_steps": self.num_steps,
+            "step_latency_mean": mean(self.step_time, self.num_steps),
+            "step_latency_p50": percentile(self.step_latencies, 0.5),
+            "step_latency_p99": percentile(self.step_latencies, 0.99),
+            "batch_occupancy": mean(self.step_rows, self.num_steps),
+            "tokens_per_step": mean(self.step_columns, self.num_steps),
+            "decode_tokens_per_sec": mean(self.sampled_tokens + self.forced_tokens, self.step_time),
+            "sampled_tokens": self.sampled_tokens,
+            "forced_tokens": self.forced_tokens,
+            "kv_bytes": self.kv_bytes,
+            "kv_bytes_peak": self.kv_bytes_peak,
+            "num_finished": self.num_finished,
+            "generated_tokens": self.generated_tokens,
+            "ttft_mean": mean(sum(self.ttfts), len(self.ttfts)),
+            "ttft_p50": percentile(self.ttfts, 0.5),
+            "ttft_p99": percentile(self.ttfts, 0.99),
+        }
 
 class Engine:
 
-    def __init__(self, model, tokenizer):
+    def __init__(self, model, tokenizer, kv_block_size=16, prefix_cache_bytes=0, draft_model=None, num_draft_tokens=4, prompt_lookup_ngram=0, prefill_chunk_size=None, kv_dtype=None, sync_every=1, compile_decode=False, tool_runner=None, kv_window=None, kv_sink_tokens=4, kv_pool_blocks=None):
         self.model = model
         self.tokenizer = tokenizer # needed for tool use
+        self.tool_runner = tool_runner # None = tool calls run inline, in the decode loop
+        self.kv_block_size = kv_block_size
+        self.kv_pool_blocks = kv_pool_blocks # None = the KV pool starts small and grows on demand, else it's allocated once with this many blocks
+        self.kv_dtype = kv_dtype # storage dtype of the KV cache: None (activations dtype) | "bfloat16" | "int8"
+        self.prefill_chunk_size = prefill_chunk_size # None = forward whole prompts at once, else bounds the memory of prefill
+        # None = rows keep all of their KV, else each row keeps its first kv_sink_tokens positions and (at most)
+        # the kv_window most recent ones, i.e. bounded memory and attention cost for unbounded conversations
+        self.kv_window = kv_window
+        self.kv_sink_tokens = kv_sink_tokens
+        self.sync_every = sync_every # decode steps between device->host syncs in generate (tokens stay on the device in between)
+        self.compile_decode = compile_decode # compile the decode step, with static shapes (see StaticKVCache)
+        self._compiled_forward = None
+        self._static_buffers = {} # (batch size, num blocks) bucket -> the (tables, pos) device buffers of the compiled step
+        self._static_arena = None # the arena that was marked as a static input of the compiled step
+        self.prefix_cache_bytes = prefix_cache_bytes # 0 = don't reuse the KV of previously seen prefixes
+        self.kv_pool = None # paged KV cache arena, shared by all the generations of this Engine
+        self.prefix_cache = None
+        self._special = None
+        self._token_vocab = None # byte-trie of the vocab, for constrained decoding
+        self._grammars = OrderedDict() # regex -> compiled Grammar (with its cached token masks)
+        self.hooks = [] # see add_hook, nothing gets timed or recorded while it's empty
+        # Speculative decoding: a smaller model (same tokenizer) proposes tokens, this model verifies them.
+        # Without a draft model, prompt_lookup_ngram > 0 proposes tokens by n-gram matching against the row itself.
+        self.draft = None
+        self.num_draft_tokens = num_draft_tokens
+        self.prompt_lookup_ngram = prompt_lookup_ngram
+        if draft_model is not None:
+            assert draft_model.config.vocab_size == model.config.vocab_size, "draft model must share the vocabulary"
+            self.draft = Engine(draft_model, tokenizer, kv_block_size=kv_block_size, prefill_chunk_size=prefill_chunk_size, kv_dtype=kv_dtype,
+                                kv_window=kv_window, kv_sink_tokens=kv_sink_tokens, kv_pool_blocks=kv_pool_blocks)
+
+    def get_kv_model_kwargs(self):
+        m = self.model.config
+        return {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer}
+
+    def get_kv_pool(self):
+        if self.kv_pool is None:
+            num_blocks = self.kv_pool_blocks or 4 * (-(-self.model.config.sequence_len // self.kv_block_size)) # grows on demand
+            self.kv_pool = KVBlockPool(block_size=self.kv_block_size, num_blocks=num_blocks, kv_dtype=self.kv_dtype, max_blocks=self.kv_pool_blocks, **self.get_kv_model_kwargs())
+            if self.prefix_cache_bytes > 0:
+                self.prefix_cache = PrefixCache(self.kv_pool, self.prefix_cache_bytes)
+                self.kv_pool.reclaim = self.prefix_cache.reclaim
+        return self.kv_pool
+
+    def release(self):
+        """
+        Free the KV pool and the prefix cache (and those of the draft), e.g. once an eval is done in the middle
+        of training, or after a failure left some rows unaccounted for. The next generation starts a new pool.
+        """
+        self.kv_pool = None
+        self.prefix_cache = None
+        self._static_buffers = {}
+        self._static_arena = None
+        if self.draft is not None:
+            self.draft.release()
+
+    def add_hook(self, hook):
+        """
+        Register a hook: an object with (any of) the methods on_prefill, on_step and on_finish, each called
+        with a record (a dict). on_prefill after each prefill: num_rows, num_tokens (forwarded), num_cached_tokens
+        (from the prefix cache), time. on_step after each decode step (or speculative round): batch_size,
+        num_columns (tokens per row), num_sampled, num_forced, kv_bytes, time. on_finish when a generation (or a
+        Scheduler request) is done: num_rows, num_prompt_tokens, num_generated_tokens, time_to_first_token, time.
+        Times are in seconds. While there are hooks, the device gets synchronized to time the prefills on their own.
+        Returns the hook, e.g. stats = engine.add_hook(GenerationStats()).
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def emit(self, event, **record):
+        for hook in self.hooks:
+            callback = getattr(hook, event, None)
+            if callback is not None:
+                callback(record)
+
+    def synchronize(self):
+        device = self.model.get_device()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def kv_bytes_in_use(self):
+        """Bytes of the KV pool held by rows or by the prefix cache."""
+        pool = self.get_kv_pool()
+        return (pool.num_blocks() - pool.num_free_blocks()) * pool.bytes_per_block()
+
+    def make_room(self, rows, num_new):
+        """With a KV window, evict from the rows that would outgrow it to make room for num_new more positions."""
+        if self.kv_window is None:
+            return
+        assert num_new <= self.kv_window, f"Cannot forward {num_new} positions at once through a KV window of {self.kv_window}"
+        capacity = self.kv_sink_tokens + self.kv_window
+        for row in rows:
+            excess = row.kv_length() + num_new - capacity
+            if excess > 0:
+                # evict (at least) an eighth of the window at a time, moving the window around is what costs
+                self.evict(row, min(max(excess, self.kv_window // 8), row.kv_length() - self.kv_sink_tokens))
+
+    def evict(self, row, num_evict):
+        """
+        Evict num_evict positions of a row, the oldest ones after its first kv_sink_tokens (the attention sinks,
+        https://arxiv.org/abs/2309.17453). The positions after them move down, and their keys get rotated back by
+        num_evict positions, so that the rotary embeddings are those of contiguous positions again (RoPE is
+        relative, and the QK norm after it commutes with the rotation). The row keeps its length, in tokens.
+        """
+        pool = row.pool
+        sink, length = self.kv_sink_tokens, row.kv_length()
+        assert row.num_evicted == 0 or row.evict_start == sink, "the attention sinks of a row can't change"
+        num_keep = length - sink - num_evict
+        # the positions written to must belong to this row only (copy-on-write), the ones read from may be shared
+        row.prepare_write(num_keep, start=sink)
+        device = pool.arena.device
+        block_size = pool.block_size
+        tables = torch.tensor([row.blocks], dtype=torch.long, device=device)
+        src = torch.arange(sink + num_evict, length, device=device)
+        dst = torch.arange(sink, sink + num_keep, device=device)
+        dst_blocks, dst_offsets = tables[:, dst // block_size], (dst % block_size)[None]
+        # rotation by +num_evict positions (same frequencies as GPT._precompute_rotary_embeddings, in fp32)
+        head_dim = pool.shape[-1]
+        inv_freq = 1.0 / (10000 ** (torch.arange(0, head_dim, 2, dtype=torch.float32, device=device) / head_dim))
+        cos, sin = (num_evict * inv_freq).cos(), (num_evict * inv_freq).sin()
+        for layer_idx in range(pool.shape[0]):
+            k, v = pool.load(layer_idx, tables, torch.float32) # (1, num_blocks * block_size, H, D)
+            k = apply_rotary_emb(k[:, src], cos, -sin) # undoes num_evict positions of the rotation of each key
+            pool.store(layer_idx, k, v[:, src], dst_blocks, dst_offsets)
+        row.num_evicted += num_evict
+        row.evict_start = sink
+        row.truncate(row.length) # frees the blocks past the new end
+
+    def forward_rows(self, rows, seqs, targets=None):
+        """
+        Forward a ragged batch: append the tokens seqs[i] (any number of them) to rows[i], where the
+        rows can be at different positions. The sequences get padded on the right to a common length
+        and each row is truncated back to its real length afterwards (dropping the KV of the padding).
+        Long sequences are forwarded in chunks of prefill_chunk_size tokens, so that the activations,
+        the attention mask and the logits stay bounded no matter the length of the prompts.
+        Returns the logits (B, vocab_size) at the last real token of each sequence.
+        With targets (a target token for every token of seqs), the logits are computed at every position
+        instead, and it returns the logprob of each target and whether it is the argmax, as lists of tensors.
+        """
+        device = self.model.get_device()
+        pool = self.get_kv_pool()
+        lengths = [len(seq) for seq in seqs]
+        T = max(lengths)
+        padded = [seq + [seq[-1]] * (T - len(seq)) for seq in seqs]
+        starts = [row.length for row in rows]
+        chunk_size = self.prefill_chunk_size or T
+        if self.kv_window is not None:
+            chunk_size = min(chunk_size, self.kv_window)
+        last_logits = [None] * len(rows)
+        logprobs, greedy = [[] for _ in rows], [[] for _ in rows]
+        for c in range(0, T, chunk_size):
+            # only the rows that still have tokens left take part in this chunk
+            active = [i for i, n in enumerate(lengths) if n > c]
+            ids = torch.tensor([padded[i][c:c + chunk_size] for i in active], dtype=torch.long, device=device)
+            # each row makes room for its real tokens only: the KV of the padding is dropped again at the end
+            for i in active:
+                self.make_room([rows[i]], min(lengths[i] - c, chunk_size))
+            kv_cache = PagedKVCache(pool, [rows[i] for i in active])
+            if targets is None:
+                # only the logits at the last real token of each row in the chunk can be of use
+                positions = torch.tensor([[min(lengths[i] - c, chunk_size) - 1] for i in active], dtype=torch.long, device=device)
+                logits = self.model.forward(ids, kv_cache=kv_cache, logits_positions=positions) # (B, 1, vocab_size)
+                for j, i in enumerate(active):
+                    if lengths[i] <= c + chunk_size:
+                        last_logits[i] = logits[j, 0]
+                continue
+            logits = self.model.forward(ids, kv_cache=kv_cache) # (B, chunk, vocab_size)
+            chunk_targets = torch.tensor([(targets[i] + [0] * T)[c:c + ids.size(1)] for i in active], dtype=torch.long, device=device)
+            chunk_logprobs = F.log_softmax(logits.float(), dim=-1).gather(2, chunk_targets.unsqueeze(2)).squeeze(2)
+            chunk_greedy = logits.argmax(dim=-1) == chunk_targets
+            for j, i in enumerate(active):
+                n = min(lengths[i] - c, ids.size(1))
+                logprobs[i].append(chunk_logprobs[j, :n])
+                greedy[i].append(chunk_greedy[j, :n])
+        for row, start, n in zip(rows, starts, lengths):
+            row.truncate(start + n)
+        if targets is not None:
+            return [torch.cat(lp) for lp in logprobs], [torch.cat(g) for g in greedy]
+        return torch.stack(last_logits)
+
+    def decode_forward(self, rows, ids):
+        """
+        Forward one token per row, ids (B, 1), and return the logits (B, vocab_size) that follow.
+        With compile_decode, the step runs through the compiled model over a StaticKVCache, with
+        the batch size and the number of blocks rounded up to powers of two (padding rows write into
+        the scratch block), so that only a handful of shapes ever get compiled. The arena is a static
+        input of the compiled step: every time it grows the step recompiles, preallocate it with
+        kv_pool_blocks to avoid that.
+        """
+        self.make_room(rows, 1)
+        if not self.compile_decode:
+            return self.model.forward(ids, kv_cache=PagedKVCache(self.get_kv_pool(), rows))[:, -1, :]
+        B = len(rows)
+        kv_cache = self._static_cache(rows, 1)
+        ids = torch.cat([ids, ids.new_zeros((kv_cache.pos.size(0) - B, 1))])
+        logits = self._static_forward(ids, kv_cache)[:B, -1, :]
+        for row in rows:
+            row.length += 1
+        return logits
+
+    def _static_cache(self, rows, num_new):
+        """
+        A StaticKVCache over the rows, with the blocks of their next num_new positions allocated beforehand.
+        With compile_decode, the batch size and the number of blocks are rounded up to powers of two (padding
+        rows write into the scratch block at position 0), and the tables and the positions go into persistent
+        device buffers (one pair per bucket), static inputs for the CUDA graphs. Either way they are copied to the
+        device without a sync (from pinned memory), from then on the positions can be advanced on the device.
+        """
+        pool = self.get_kv_pool()
+        assert pool.arena is not None, "the rows must have been prefilled"
+        device = pool.arena.device
+        for row in rows:
+            row.prepare_write(num_new)
+        B, num_blocks = len(rows), max(len(row.blocks) for row in rows)
+        if self.compile_decode:
+            B, num_blocks = 1 << (B - 1).bit_length(), 1 << (num_blocks - 1).bit_length()
+        scratch = pool.scratch_block()
+        tables = [row.blocks + [scratch] * (num_blocks - len(row.blocks)) for row in rows] + [[scratch] * num_blocks] * (B - len(rows))
+        pos = [row.kv_length() for row in rows] + [0] * (B - len(rows))
+        pin_memory = device.type == "cuda"
+        tables = torch.tensor(tables, dtype=torch.long, pin_memory=pin_memory)
+        pos = torch.tensor(pos, dtype=torch.long, pin_memory=pin_memory)
+        if not self.compile_decode:
+            return StaticKVCache(pool, tables.to(device, non_blocking=True), pos.to(device, non_blocking=True))
+        if (B, num_blocks) not in self._static_buffers:
+            buffers = (torch.empty((B, num_blocks), dtype=torch.long, device=device), torch.empty(B, dtype=torch.long, device=device))
+            for buffer in buffers:
+                torch._dynamo.mark_static_address(buffer)
+            self._static_buffers[(B, num_blocks)] = buffers
+        tables_buffer, pos_buffer = self._static_buffers[(B, num_blocks)]
+        tables_buffer.copy_(tables, non_blocking=True)
+        pos_buffer.copy_(pos, non_blocking=True)
+        return StaticKVCache(pool, tables_buffer, pos_buffer)
+
+    def _static_forward(self, ids, kv_cache):
+        """Forward ids (B, 1) over a StaticKVCache, through the compiled model with compile_decode."""
+        if not self.compile_decode:
+            return self.model.forward(ids, kv_cache=kv_cache)
+        pool = kv_cache.pool
+        if pool.arena is not self._static_arena:
+            # the arena is written in place by every step: as a static input, CUDA graphs can still capture the step
+            torch._dynamo.mark_static_address(pool.arena)
+            if pool.scales is not None:
+                torch._dynamo.mark_static_address(pool.scales)
+            self._static_arena = pool.arena
+        if self._compiled_forward is None:
+            mode = "reduce-overhead" if ids.device.type == "cuda" else None # reduce-overhead = CUDA graphs
+            self._compiled_forward = torch.compile(self.model.forward, fullgraph=True, dynamic=False, mode=mode)
+        return self._compiled_forward(ids, kv_cache=kv_cache)
 
     @torch.inference_mode()
-    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42):
-        """Same as generate, but does single prefill and then clones the KV cache."""
+    def score(self, contexts, continuations, batch_size=32):
+        """
+        Score each continuations[i] as the continuation of contexts[i] (lists of token ids), e.g. for
+        multiple choice evals or reward-model style scoring. Returns a list with, for each pair, the
+        sum of the logprobs of the continuation tokens, their mean, and whether every one of them is the
+        greedy (argmax) prediction. The pairs are packed by length into batches of batch_size rows, each
+        distinct context is prefilled once and its continuations fork its row (sharing its KV), and the
+        lm_head only runs at the positions that predict continuation tokens.
+        """
+        assert len(contexts) == len(continuations), "expecting one continuation per context"
+        assert all(len(context) > 0 and len(continuation) > 0 for context, continuation in zip(contexts, continuations))
+        groups = {} # context -> indices of its pairs
+        for i, context in enumerate(contexts):
+            groups.setdefault(tuple(context), []).append(i)
+        longest = lambda context: len(context) + max(len(continuations[i]) for i in groups[context])
+        ordered = sorted(groups, key=longest)
+        results = [None] * len(contexts)
+        batch = []
+        for g, context in enumerate(ordered):
+            batch.append(context)
+            if g < len(ordered) - 1 and sum(len(groups[c]) for c in batch) < batch_size:
+                continue
+            context_rows, context_logits = self.prefill_rows([list(c) for c in batch])
+            rows = []
+            try:
+                # the first token of each continuation comes from the last logits of its context
+                context_logprobs = F.log_softmax(context_logits.float(), dim=-1)
+                context_argmax = context_logits.argmax(dim=-1)
+                pairs = [(k, i) for k, c in enumerate(batch) for i in groups[c]]
+                owners = torch.tensor([k for k, _ in pairs], device=context_logits.device)
+                firsts = torch.tensor([continuations[i][0] for _, i in pairs], device=context_logits.device)
+                first_logprobs = context_logprobs[owners, firsts]
+                first_greedy = context_argmax[owners] == firsts
+                # the rest of each continuation goes through a fork of its context's row
+                longer = [j for j, (_, i) in enumerate(pairs) if len(continuations[i]) > 1]
+                rows = [context_rows[pairs[j][0]].fork() for j in longer]
+                logprobs, greedy = [], []
+                if rows:
+                    seqs = [continuations[pairs[j][1]][:-1] for j in longer]
+                    targets = [continuations[pairs[j][1]][1:] for j in longer]
+                    logprobs, greedy = self.forward_rows(rows, seqs, targets)
+                rest = dict(zip(longer, zip(logprobs, greedy)))
+                totals = []
+                for j in range(len(pairs)):
+                    lp, gr = rest.get(j, (first_logprobs[j:j], first_greedy[j:j]))
+                    totals.append(torch.stack([first_logprobs[j] + lp.sum(), (first_greedy[j] & gr.all()).float()]))
+                totals = torch.stack(totals).tolist() # single device->host sync per batch
+                for (_, i), (logprob, all_greedy) in zip(pairs, totals):
+                    results[i] = (logprob, logprob / len(continuations[i]), bool(all_greedy))
+            finally:
+                for row in context_rows + rows:
+                    row.release()
+            batch = []
+        return results
+
+    def forward_pending(self, rows, row_states):
+        """
+        Forward the tokens of each row that are not in its KV cache yet and return the logits (B, vocab_size)
+        that follow. That's the last token of the row, plus the tokens it was forced to emit since it last took
+        part in a forward pass. One token per row is a plain decode step, otherwise a ragged chunked forward.
+        """
+        seqs = [state.tokens_from(row.length) for row, state in zip(rows, row_states)]
+        if all(len(seq) == 1 for seq in seqs):
+            ids = torch.tensor(seqs, dtype=torch.long, device=self.model.get_device())
+            return self.decode_forward(rows, ids)
+        return self.forward_rows(rows, seqs)
+
+    def new_row(self, tokens):
+        """A new row for a prompt: starts out with the longest cached prefix of tokens, if any."""
+        # always leave at least one token to forward, we need its logits
+        return BlockTable(self.get_kv_pool()) if self.prefix_cache is None else self.prefix_cache.match(tokens[:-1])
+
+    def prefill_rows(self, prompts):
+        """
+        Prefill a new row of the paged KV cache for each of the prompts, in one ragged batch. Returns
+        the rows and the logits (B, vocab_size) for the token that comes next after each prompt.
+        With a prefix cache, each row starts out with the longest cached prefix of its prompt and
+        only the remaining tokens get forwarded.
+        """
+        t0 = time.perf_counter()
+        rows = [self.new_row(tokens) for tokens in prompts]
+        num_cached = sum(row.length for row in rows)
+        try:
+            logits = self.forward_rows(rows, [tokens[row.length:] for tokens, row in zip(prompts, rows)])
+        except BaseException:
+            for row in rows:
+                row.release()
+            raise
+        if self.hooks:
+            self.synchronize()
+            num_tokens = sum(len(tokens) for tokens in prompts) - num_cached
+            self.emit("on_prefill", num_rows=len(prompts), num_tokens=num_tokens, num_cached_tokens=num_cached, time=time.perf_counter() - t0)
+        for tokens, row in zip(prompts, rows):
+            self.cache_prefix(tokens, row)
+        return rows, logits
+
+    def prefill_row(self, tokens):
+        """Same as prefill_rows, for a single prompt. Returns the row and the logits (1, vocab_size)."""
+        rows, logits = self.prefill_rows([tokens])
+        return rows[0], logits
+
+    def cache_prefix(self, tokens, row):
+        """Offer the full blocks of a row (holding the KV of tokens) to the prefix cache, if any."""
+        if self.prefix_cache is not None and row.num_evicted == 0: # (evicted rows don't hold a prefix anymore)
+            self.prefix_cache.insert(tokens[:row.length], row.blocks)
+
+    def special_tokens(self):
+        """The special tokens we need to coordinate the tool use state machine."""
+        if self._special is None:
+            get_special = lambda s: self.tokenizer.encode_special(s)
+            self._special = {
+                "python_start": get_special("<|python_start|>"),
+                "python_end": get_special("<|python_end|>"),
+                "output_start": get_special("<|output_start|>"),
+                "output_end": get_special("<|output_end|>"),
+                "assistant_end": get_special("<|assistant_end|>"), # if sampled, ends row
+                "bos": self.tokenizer.get_bos_token_id(), # if sampled, ends row
+            }
+        return self._special
+
+    def advance_row(self, state, sampled_token):
+        """
+        Choose the next token of a row (forced tokens take priority, then the lookahead, then the sampled one),
+        update the state of the row, and run the tool use state machine.
+        Returns the next token and its mask (was it sampled (1) or forced (0)?).
+        """
+        special = self.special_tokens()
+        self.wait_tool(state)
+        # Select the next token in this row
+        is_forced = len(state.forced_tokens) > 0 # are there tokens waiting to be forced in deque?
+        if is_forced:
+            next_token = state.forced_tokens.popleft()
+        elif state.lookahead:
+            next_token = state.lookahead.popleft()
+        else:
+            next_token = sampled_token
+        # Update the state of this row to include the next token
+        state.current_tokens.append(next_token)
+        # On <|assistant_end|> or <|bos|>, mark the row as completed
+        if next_token == special["assistant_end"] or next_token == special["bos"]:
+            state.completed = True
+        # Step the grammar, if any, and force what has only one legal continuation
+        if state.grammar is not None:
+            state.grammar_state = state.grammar.advance(state.grammar_state, next_token)
+            if not state.completed and not state.forced_tokens:
+                state.forced_tokens.extend(state.grammar.jump_forward(state.grammar_state))
+        # Handle tool logic
+        if next_token == special["python_start"]:
+            state.in_python_block = True
+            state.python_expr_tokens = []
+        elif next_token == special["python_end"] and state.in_python_block:
+            state.in_python_block = False
+            if state.python_expr_tokens:
+                expr = self.tokenizer.decode(state.python_expr_tokens)
+                if self.tool_runner is None:
+                    self.force_tool_output(state, use_calculator(expr))
+                else:
+                    # the output is only needed to choose the token after the next forward pass
+                    state.pending_tool = self.tool_runner.submit(expr)
+            state.python_expr_tokens = []
+        elif state.in_python_block:
+            state.python_expr_tokens.append(next_token)
+        # the lookahead was sampled without the tokens to force (and past the end): it's void, the caller rolls the KV back
+        if state.completed or state.may_force():
+            state.lookahead.clear()
+        return next_token, 0 if is_forced else 1 # mask is 0 if forced, 1 if sampled
+
+    def get_grammar(self, regex=None, json_schema=None):
+        """Compile a grammar for constrained decoding, from a regex or a JSON schema. Compiled grammars are cached."""
+        from nanochat.grammar import Grammar, json_schema_to_regex
+        assert (regex is None) != (json_schema is None), "expecting either a regex or a JSON schema"
+        pattern = regex if json_schema is None else json_schema_to_regex(json_schema)
+        if pattern in self._grammars:
+            self._grammars.move_to_end(pattern)
+            return self._grammars[pattern]
+        return self.add_grammar(Grammar(pattern, self.token_vocab()))
+
+    def add_grammar(self, grammar):
+        """
+        Cache a grammar compiled elsewhere (e.g. by a server, off the decode loop), returns the cached grammar of
+        its pattern. A grammar that comes from another process (without its vocab) gets the vocab of this Engine.
+        """
+        if grammar.pattern not in self._grammars:
+            if grammar.vocab is None:
+                grammar.vocab = self.token_vocab()
+            self._grammars[grammar.pattern] = grammar
+            if len(self._grammars) > 64:
+                self._grammars.popitem(last=False)
+        self._grammars.move_to_end(grammar.pattern)
+        return self._grammars[grammar.pattern]
+
+    def token_vocab(self):
+        """The byte-trie of the vocab that the grammars walk, built once."""
+        from nanochat.grammar import TokenVocab
+        if self._token_vocab is None:
+            self._token_vocab = TokenVocab.from_tokenizer(self.tokenizer)
+        return self._token_vocab
+
+    def constrain(self, logits, row_states):
+        """Mask out of logits (B, vocab_size) the tokens that the grammar of each row doesn't allow in its current state."""
+        constrained = [i for i, state in enumerate(row_states) if state.grammar is not None]
+        if not constrained:
+            return logits
+        masks = torch.stack([row_states[i].grammar.token_mask(row_states[i].grammar_state, logits.size(-1), logits.device) for i in constrained])
+        logits = logits.clone()
+        logits[constrained] = logits[constrained].masked_fill(~masks, float("-inf"))
+        return logits
+
+    def wait_tool(self, state):
+        """Wait for the output of the tool call of a row, if there is one in flight, and queue it up to be forced."""
+        if state.pending_tool is not None:
+            result = state.pending_tool.result()
+            state.pending_tool = None
+            self.force_tool_output(state, result)
+
+    def force_tool_output(self, state, result):
+        if result is not None:
+            special = self.special_tokens()
+            state.forced_tokens.append(special["output_start"])
+            state.forced_tokens.extend(self.tokenizer.encode(str(result)))
+            state.forced_tokens.append(special["output_end"])
+
+    @torch.inference_mode()
+    def generate(self, tokens, num_samples=1, **kwargs):
+        """Same as generate, but does single prefill and then shares the prompt KV across the samples."""
         assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        yield from self.generate_many([tokens], num_samples, **kwargs)
+
+    @torch.inference_mode()
+    def generate_many(self, prompts, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42, grammar=None, cancel=None):
+        """
+        Generate num_samples continuations of each of the prompts, all in one batch. The rows are
+        ordered prompt-major (row i * num_samples + j is sample j of prompt i) and every step yields
+        a column with a token (and mask) for each row. The prompts can have different lengths.
+        Completed rows leave the batch (and release their KV blocks), from then on they yield
+        assistant_end with a mask of 0. With a grammar (see get_grammar), the outputs are constrained
+        to match it, and what it leaves no choice about is forced (mask 0). With a cancel token (see CancelToken),
+        the generation stops at the next step once it's cancelled, and the rows give their KV back.
+        """
+        assert all(isinstance(tokens, list) and isinstance(tokens[0], int) for tokens in prompts), "expecting lists of ints"
         device = self.model.get_device()
         rng = torch.Generator(device=device)
         rng.manual_seed(seed)
+        t_start = time.perf_counter()
+        time_to_first_token = None
 
-        # Get the special tokens we need to coordinate the tool use state machine
-        get_special = lambda s: self.tokenizer.encode_special(s)
-        python_start = get_special("<|python_start|>")
-        python_end = get_special("<|python_end|>")
-        output_start = get_special("<|output_start|>")
-        output_end = get_special("<|output_end|>")
-        assistant_end = get_special("<|assistant_end|>") # if sampled, ends row
-        bos = self.tokenizer.get_bos_token_id() # if sampled, ends row
+        # 1) Run a ragged prefill of the prompts (only the uncached part of each with a prefix cache)
+        prompt_rows, logits = self.prefill_rows(prompts)
+        # 2) Fan out to one row per sample: the rows share the prompt blocks (copy-on-write, no copy here)
+        rows = [row for prompt_row in prompt_rows for row in [prompt_row] + [prompt_row.fork() for _ in range(num_samples - 1)]]
+        draft_rows = []
+        row_states = [RowState(tokens.copy()) for tokens in prompts for _ in range(num_samples)]
+        if grammar is not None:
+            for state in row_states:
+                state.set_grammar(grammar)
+        try:
+            # every row samples its own first token from the logits of its prompt
+            logits = self.constrain(logits.repeat_interleave(num_samples, dim=0), row_states) # (B, vocab_size)
+            next_ids = sample_next_token(logits, rng, temperature, top_k)  # (B, 1)
+            sampled_tokens = next_ids[:, 0].tolist()
+            time_to_first_token = time.perf_counter() - t_start
+            if self.draft is not None:
+                draft_prompt_rows, _ = self.draft.prefill_rows(prompts)
+                draft_rows = [row for prompt_row in draft_prompt_rows for row in [prompt_row] + [prompt_row.fork() for _ in range(num_samples - 1)]]
 
-        # 1) Run a batch 1 prefill of the prompt tokens
-        m = self.model.config
-        kv_model_kwargs = {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer}
-        kv_cache_prefill = KVCache(
-            batch_size=1,
-            seq_len=len(tokens),
-            **kv_model_kwargs,
-        )
-        ids = torch.tensor([tokens], dtype=torch.long, device=device)
-        logits = self.model.forward(ids, kv_cache=kv_cache_prefill)
-        logits = logits[:, -1, :]
-        next_ids = sample_next_token(logits, rng, temperature, top_k)  # (B, 1)
-        sampled_tokens = next_ids[:, 0].tolist()
-
-        # 2) Replicate the KV cache for each sample/row
-        kv_length_hint = (len(tokens) + max_tokens) if max_tokens is not None else self.model.config.sequence_len
-        kv_cache_decode = KVCache(
-            batch_size=num_samples,
-            seq_len=kv_length_hint,
-            **kv_model_kwargs,
-        )
-        kv_cache_decode.prefill(kv_cache_prefill)
-        del kv_cache_prefill # no need to keep this memory around
-
-        # 3) Initialize states for each sample
-        row_states = [RowState(tokens.copy()) for _ in range(num_samples)]
-
-        # 4) Main generation loop
-        num_generated = 0
-        first_iteration = True
-        while True:
-            # Stop condition: we've reached max tokens
-            if max_tokens is not None and num_generated >= max_tokens:
-                break
-            # Stop condition: all rows are completed
-            if all(state.completed for state in row_states):
+            # 3) Main generation loop
+            special = self.special_tokens()
+            assistant_end = special["assistant_end"]
+            run_ahead_stops = (special["python_end"], assistant_end, special["bos"])
+            num_generated = 0
+            first_iteration = True
+            speculative = self.draft is not None or self.prompt_lookup_ngram > 0
+            while True:
+                # Stop condition: we've reached max tokens
+                if max_tokens is not None and num_generated >= max_tokens:
+                    break
+                # Stop condition: all rows are completed
+                if all(state.completed for state in row_states):
+                    break
+                # Stop condition: cancelled, or past the deadline
+                if cancel is not None and cancel.is_cancelled():
+                    break
+
+                # Only the rows that are still generating take part in the forward passes
+                t_step = time.perf_counter()
+                from_prefill = first_iteration
+                active = [i for i, state in enumerate(row_states) if not state.completed]
+                active_rows = [rows[i] for i in active]
+                active_states = [row_states[i] for i in active]
+                active_draft_rows = [draft_rows[i] for i in active] if draft_rows else []
+
+                # Get columns of sampled tokens - from prefill, a speculative round, or a forward pass
+                # (the multi-column paths need every row caught up: all its tokens but the last one in the KV cache,
+                # plus its lookahead if it has one)
+                speculation = None
+                in_sync = all(row.length == len(state.current_tokens) - 1 + len(state.lookahead) and not state.may_force() and state.grammar is None for row, state in zip(active_rows, active_states))
+                caught_up = in_sync and not any(state.lookahead for state in active_states)
+                if not first_iteration and speculative and in_sync:
+                    # Propose, then verify: several tokens per row for the price of one forward pass. The rows that
+                    # still have a lookahead from an earlier round sit this one out, they have tokens to emit already
+                    speculating = [k for k, state in enumerate(active_states) if not state.lookahead]
+                    if speculating:
+                        speculation = self._speculate([active_rows[k] for k in speculating], [active_draft_rows[k] for k in speculating] if draft_rows else [],
+                                                      [active_states[k] for k in speculating], rng, temperature, top_k)
+                if first_iteration:
+                    # Use the tokens we already sampled from prefill
+                    columns = [sampled_tokens]
+                    first_iteration = False
+                elif speculation is not None:
+                    # every row accepted its own number of tokens: they go to its lookahead, and as many columns as
+                    # the shortest lookahead are emitted now. The rest is emitted in the next steps, its KV is kept
+                    runs, proposals = speculation
+                    for k, run in zip(speculating, runs):
+                        active_states[k].lookahead.extend(run)
+                    columns = [[None] * len(active_states)] * min(len(state.lookahead) for state in active_states)
+                elif self.sync_every > 1 and caught_up:
+                    # Several decode steps in a row on the device, then a single sync to drain their tokens
+                    num_steps = self.sync_every if max_tokens is None else min(self.sync_every, max_tokens - num_generated)
+                    ids = torch.tensor([[state.current_tokens[-1]] for state in active_states], dtype=torch.long, device=device)
+                    columns = self._decode_on_device(active_rows, active_states, ids, rng, temperature, top_k, num_steps)
+                elif not all(state.tool_ready() for state in active_states):
+                    # A row waits for the output of its tool call: instead of holding up the batch, the other rows
+                    # decode ahead (into their lookahead) and the next column comes out once the output is there.
+                    # A row stops running ahead at a tool call or at its end, the state machine only sees its tokens then
+                    ahead = [k for k, state in enumerate(active_states) if not state.may_force() and state.grammar is None
+                             and not (state.lookahead and state.lookahead[-1] in run_ahead_stops)
+                             and (max_tokens is None or num_generated + len(state.lookahead) < max_tokens)]
+                    if ahead:
+                        logits = self.forward_pending([active_rows[k] for k in ahead], [active_states[k] for k in ahead]) # (B, vocab_size)
+                        next_ids = sample_next_token(logits, rng, temperature, top_k) # (B, 1)
+                        for k, token in zip(ahead, next_ids[:, 0].tolist()):
+                            active_states[k].lookahead.append(token)
+                    else:
+                        pending = [state.pending_tool for state in active_states if not state.tool_ready()]
+                        concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    columns = []
+                else:
+                    # Forward the model and get the next token for each row. The rows with forced tokens
+                    # (a tool output) sit this out, they don't need logits to emit them: the whole forced
+                    # span then goes into the KV cache in a single chunk, once the row samples again
+                    column = [None] * len(active_states)
+                    forwarding = [k for k, state in enumerate(active_states) if not state.may_force() and not state.lookahead]
+                    if forwarding:
+                        logits = self.forward_pending([active_rows[k] for k in forwarding], [active_states[k] for k in forwarding]) # (B, vocab_size)
+                        logits = self.constrain(logits, [active_states[k] for k in forwarding])
+                        next_ids = sample_next_token(logits, rng, temperature, top_k)  # (B, 1)
+                        for k, token in zip(forwarding, next_ids[:, 0].tolist()):
+                            column[k] = token
+                    columns = [column]
+                step_time = time.perf_counter() - t_step # the columns are on the host: the step is done
+
+                num_columns = num_sampled = num_forced = 0
+                for j, sampled_tokens in enumerate(columns):
+                    # The rest of the columns are unusable once a row has tokens to force (they were sampled without them),
+                    # or a tool call in flight: stopping here gives the tool the next forward pass to finish
+                    if j > 0 and (any(state.may_force() for state in active_states) or all(state.completed for state in active_states)):
+                        break
+                    if max_tokens is not None and num_generated >= max_tokens:
+                        break
+                    # Process each row: choose the next token, update state, optional tool use
+                    # (the rows that completed before this step just get assistant_end, masked out)
+                    token_column = [assistant_end] * len(row_states) # contains the next token id along each row
+                    token_masks = [0] * len(row_states) # contains the mask (was it sampled (1) or forced (0)?) along each row
+                    for i, state, sampled_token in zip(active, active_states, sampled_tokens):
+                        if not state.completed:
+                            token_column[i], token_masks[i] = self.advance_row(state, sampled_token)
+                            num_sampled += token_masks[i]
+                            num_forced += 1 - token_masks[i]
+
+                    # Yield the token column
+                    yield token_column, token_masks
+                    num_generated += 1
+                    num_columns += 1
+                if self.hooks and not from_prefill and columns:
+                    self.emit("on_step", batch_size=len(active), num_columns=num_columns, num_sampled=num_sampled,
+                              num_forced=num_forced, kv_bytes=self.kv_bytes_in_use(), time=step_time)
+
+                if speculation is not None:
+                    self._rollback_speculation([active_rows[k] for k in speculating], [active_draft_rows[k] for k in speculating] if draft_rows else [],
+                                               [active_states[k] for k in speculating], proposals)
+                # roll the rows back to the tokens that were actually emitted (all but the last one) and their lookahead,
+                # e.g. after steps on the device past a tool call, or a lookahead voided by one
+                for row, state in zip(active_rows + active_draft_rows, active_states * (2 if draft_rows else 1)):
+                    num_keep = len(state.current_tokens) - 1 + len(state.lookahead)
+                    if row.length > num_keep:
+                        row.truncate(num_keep)
+                # Compact the batch: the rows that just completed leave it, and their blocks go back to the pool
+                for i in active:
+                    if row_states[i].completed:
+                        self.cache_prefix(row_states[i].current_tokens, rows[i])
+                        rows[i].release()
+                        if draft_rows:
+                            draft_rows[i].release()
+        finally:
+            # Return the blocks to the pool (also when the caller stops consuming early)
+            for row, state in zip(rows, row_states):
+                if row.length > 0: # the rows that completed were released already
+                    row.truncate(min(row.length, len(state.current_tokens))) # (drops the KV of a lookahead)
+                    self.cache_prefix(state.current_tokens, row)
+            for row in rows + draft_rows:
+                row.release()
+            if self.hooks:
+                num_prompt_tokens = num_samples * sum(len(tokens) for tokens in prompts)
+                num_generated_tokens = sum(len(state.current_tokens) for state in row_states) - num_prompt_tokens
+                self.emit("on_finish", num_rows=len(row_states), num_prompt_tokens=num_prompt_tokens, num_generated_tokens=num_generated_tokens,
+                          time_to_first_token=time_to_first_token, time=time.perf_counter() - t_start)
+
+    def _decode_on_device(self, rows, row_states, ids, rng, temperature, top_k, num_steps):
+        """
+        Run up to num_steps decode steps without a device->host sync: the blocks of all the steps are
+        allocated up front, the block tables and positions go to the device once and the positions
+        advance there, the sampled tokens feed the next step and are collected in a device buffer, and
+        the completion of the rows is tracked on the device too (completed rows keep emitting assistant_end).
+        The loop ends early once all rows completed or a row closed a tool call (python_end): the tokens
+        after that would be thrown away. The flag is read back asynchronously (pinned memory + an event
+        per step, polled without blocking), so on CUDA the loop notices it a step or two late at most.
+        The tool use state machine only sees the tokens when they are drained at the end.
+        Returns the columns of sampled tokens, in one sync.
+        """
+        special = self.special_tokens()
+        device = ids.device
+        B = len(rows)
+        stop_tokens = torch.tensor([special["assistant_end"], special["bos"]], dtype=torch.long, device=device)
+        completed = torch.tensor([state.completed for state in row_states], dtype=torch.bool, device=device)
+        buffer = torch.empty((B, num_steps), dtype=torch.long, device=device)
+        self.make_room(rows, num_steps)
+        kv_cache = self._static_cache(rows, num_steps)
+        padded_ids = torch.cat([ids, ids.new_zeros((kv_cache.pos.size(0) - B, 1))])
+        on_cuda = device.type == "cuda"
+        if on_cuda:
+            halted = torch.zeros(num_steps, dtype=torch.bool, pin_memory=True)
+            events, num_checked = [], 0
+        num_run = 0
+        while num_run < num_steps:
+            if on_cuda:
+                # the steps whose flag already landed on the host (no waiting on the others)
+                while num_checked < num_run and events[num_checked].query():
+                    num_checked += 1
+                if halted[:num_checked].any():
+                    break
+            logits = self._static_forward(padded_ids, kv_cache)[:B, -1, :] # (B, vocab_size)
+            kv_cache.pos[:B] += 1
+            ids = sample_next_token(logits, rng, temperature, top_k) # (B, 1)
+            ids = torch.where(completed[:, None], stop_tokens[0], ids)
+            completed |= torch.isin(ids[:, 0], stop_tokens)
+            buffer[:, num_run] = ids[:, 0]
+            padded_ids[:B] = ids
+            halt = completed.all() | (ids == special["python_end"]).any()
+            num_run += 1
+            if on_cuda:
+                halted[num_run - 1].copy_(halt, non_blocking=True)
+                events.append(torch.cuda.Event())
+                events[-1].record()
+            elif halt:
                 break
+        # the rows hold the KV of the steps that ran, and give back the blocks allocated for the others
+        for row in rows:
+            row.length += num_run
+            row.truncate(row.length)
+        return buffer[:, :num_run].t().tolist()
+
+    def _speculate(self, rows, draft_rows, row_states, rng, temperature, top_k):
+        """
+        One round of speculative decoding (https://arxiv.org/abs/2211.17192). Tokens are proposed for
+        each row (by the draft model, or by prompt lookup) and the model verifies all of them in a single
+        chunked forward, accepting each proposal with probability min(1, p/q) and resampling the first
+        rejected one from the residual max(0, p - q). Every row keeps its own accepted run, of any length.
+        Returns the run of each row (its accepted proposals, then the correction or bonus token) and the
+        proposals, as lists, or None if there was nothing to propose. The rows hold the KV of all proposals:
+        the caller emits the runs, then rolls the rows back with _rollback_speculation.
+        """
+        device = self.model.get_device()
+        # 1) Propose: draft_probs is the distribution each proposal was sampled from (None: deterministic)
+        # and valid which of the proposals are real, rows with fewer of them are padded (None: all of them)
+        draft_probs = valid = None
+        if self.draft is not None:
+            proposals, draft_probs = self._propose_draft(draft_rows, row_states, rng, temperature, top_k)
+        else:
+            lookup = self._propose_lookup(row_states)
+            if lookup is None:
+                return None
+            proposals, valid = lookup
+        num_draft = proposals.size(1)
+        # 2) The model scores the last token plus all proposals in one forward pass
+        last = torch.tensor([[state.current_tokens[-1]] for state in row_states], dtype=torch.long, device=device)
+        self.make_room(rows, num_draft + 1)
+        logits = self.model.forward(torch.cat([last, proposals], dim=1), kv_cache=PagedKVCache(self.get_kv_pool(), rows)) # (B, k+1, V)
+        B = logits.size(0)
+        if temperature == 0.0:
+            # greedy: accept proposals while they agree with the argmax, which is then also the correction/bonus token
+            tokens = torch.argmax(logits, dim=-1) # (B, k+1)
+            accepted = tokens[:, :num_draft] == proposals
+        else:
+            p = sampling_probs(logits, temperature, top_k) # (B, k+1, V)
+            q = torch.stack(draft_probs, dim=1) if draft_probs is not None else F.one_hot(proposals, p.size(-1)).to(p.dtype) # (B, k, V)
+            p_prop = p[:, :num_draft].gather(-1, proposals.unsqueeze(-1)).squeeze(-1)
+            q_prop = q.gather(-1, proposals.unsqueeze(-1)).squeeze(-1)
+            u = torch.rand(p_prop.shape, generator=rng, device=device)
+            accepted = u * q_prop <= p_prop # i.e. u <= p/q
+        if valid is not None:
+            # the padding is never accepted: a row without a proposal (k=0) gets the token of a plain decode step
+            accepted &= valid
+            if temperature > 0.0:
+                q = q * valid.unsqueeze(-1) # so that the residual at the padding is p itself
+        num_accepted = accepted.int().cumprod(dim=1).sum(dim=1) # (B,) length of the accepted run of each row
+        if temperature > 0.0:
+            # resample at the first rejected position from the residual, or the bonus token from p if all were accepted
+            residual = torch.cat([(p[:, :num_draft] - q).clamp(min=0.0), p[:, num_draft:]], dim=1) # (B, k+1, V)
+            residual = residual[torch.arange(B, device=device), num_accepted] # (B, V)
+            fallback = p[torch.arange(B, device=device), num_accepted] # guard against an all-zero residual
+            residual = torch.where(residual.sum(-1, keepdim=True) > 0, residual, fallback)
+            correction = torch.multinomial(residual, num_samples=1, generator=rng) # (B, 1)
+            tokens = torch.cat([proposals, correction], dim=1)
+            tokens.scatter_(1, num_accepted.unsqueeze(1), correction)
+        tokens = torch.cat([tokens, num_accepted.unsqueeze(1)], dim=1).tolist() # one device->host sync per round
+        runs = [row_tokens[:row_tokens[-1] + 1] for row_tokens in tokens]
+        return runs, proposals.tolist()
 
-            # Get sampled tokens - either from prefill or from forward pass
-            if first_iteration:
-                # Use the tokens we already sampled from prefill
-                sampled_tokens = [sampled_tokens[0]] * num_samples  # Broadcast first token to all rows
-                # TODO: we should sample a token for each row instead of broadcasting
-                first_iteration = False
+    def _propose_draft(self, draft_rows, row_states, rng, temperature, top_k):
+        """The draft model catches up on the tokens it has not seen yet, then proposes autoregressively."""
+        # (a ragged forward for the catch up: it can be a whole new turn of a Session, more than the KV window)
+        logits = self.draft.forward_rows(draft_rows, [state.current_tokens[row.length:] for row, state in zip(draft_rows, row_states)])
+        proposals, draft_probs = [], []
+        for i in range(self.num_draft_tokens):
+            if i > 0:
+                logits = self.draft.decode_forward(draft_rows, ids)
+            if temperature == 0.0:
+                ids = torch.argmax(logits, dim=-1, keepdim=True)
             else:
-                # Forward the model and get the next token for each row
-                logits = self.model.forward(ids, kv_cache=kv_cache_decode)  # (B, T, vocab_size)
-                logits = logits[:, -1, :]  # (B, vocab_size) at last time step
-                next_ids = sample_next_token(logits, rng, temperature, top_k)  # (B, 1)
-                sampled_tokens = next_ids[:, 0].tolist()
-
-            # Process each row: choose the next token, update state, optional tool use
-            token_column = [] # contains the next token id along each row
-            token_masks = [] # contains the mask (was it sampled (1) or forced (0)?) along each row
-            for i, state in enumerate(row_states):
-                # Select the next token in this row
-                is_forced = len(state.forced_tokens) > 0 # are there tokens waiting to be forced in deque?
-                token_masks.append(0 if is_forced else 1) # mask is 0 if forced, 1 if sampled
-                next_token = state.forced_tokens.popleft() if is_forced else sampled_tokens[i]
-                token_column.append(next_token)
-                # Update the state of this row to include the next token
-                state.current_tokens.append(next_token)
-                # On <|assistant_end|> or <|bos|>, mark the row as completed
-                if next_token == assistant_end or next_token == bos:
-                    state.completed = True
-                # Handle tool logic
-                if next_token == python_start:
-                    state.in_python_block = True
-                    state.python_expr_tokens = []
-                elif next_token == python_end and state.in_python_block:
-                    state.in_python_block = False
-                    if state.python_expr_tokens:
-                        expr = self.tokenizer.decode(state.python_expr_tokens)
-                        result = use_calculator(expr)
-                        if result is not None:
-                            result_tokens = self.tokenizer.encode(str(result))
-                            state.forced_tokens.append(output_start)
-                            state.forced_tokens.extend(result_tokens)
-                            state.forced_tokens.append(output_end)
-                    state.python_expr_tokens = []
-                elif state.in_python_block:
-                    state.python_expr_tokens.append(next_token)
-
-            # Yield the token column
-            yield token_column, token_masks
-            num_generated += 1
-            # Prepare ids for next iteration
-            ids = torch.tensor(token_column, dtype=torch.long, device=device).unsqueeze(1)
+                q = sampling_probs(logits, temperature, top_k)
+                ids = torch.multinomial(q, num_samples=1, generator=rng)
+                draft_probs.append(q)
+            proposals.append(ids)
+        proposals = torch.cat(proposals, dim=1) # (B, k)
+        return proposals, (draft_probs if temperature > 0.0 else None)
+
+    def _propose_lookup(self, row_states):
+        """
+        Prompt lookup: each row proposes what followed the last occurrence of its trailing n-gram.
+        Returns the proposals (B, k), padded to the longest, and which of them are real (B, k).
+        """
+        continuations = [prompt_lookup(state.current_tokens, self.prompt_lookup_ngram, self.num_draft_tokens) for state in row_states]
+        num_draft = max(len(c) for c in continuations)
+        if num_draft == 0:
+            return None # no row has anything to propose, a plain decode step is cheaper
+        # the forward is one dense batch, the rows with fewer proposals (or none) are padded with their last token
+        device = self.model.get_device()
+        padded = [c + [state.current_tokens[-1]] * (num_draft - len(c)) for c, state in zip(continuations, row_states)]
+        num_proposed = torch.tensor([len(c) for c in continuations], dtype=torch.long, device=device)
+        valid = torch.arange(num_draft, device=device) < num_proposed[:, None]
+        return torch.tensor(padded, dtype=torch.long, device=device), valid
+
+    def _rollback_speculation(self, rows, draft_rows, row_states, proposals):
+        """After a speculative round, roll the KV caches back to the tokens that were emitted (or are in the lookahead), row by row."""
+        # the model's rows hold every token but the last one
+        for row, state in zip(rows, row_states):
+            row.truncate(len(state.current_tokens) - 1 + len(state.lookahead))
+        # the draft rows fed the round's proposals (but the last one): keep them as far as they match what the row emits
+        for row, state, proposal in zip(draft_rows, row_states, proposals):
+            start = row.length - (len(proposal) - 1)
+            emitted = (state.current_tokens + list(state.lookahead))[start:-1] # leave at least the last token for the draft to catch up on
+            n = 0
+            while n < min(len(emitted), len(proposal) - 1) and emitted[n] == proposal[n]:
+                n += 1
+            row.truncate(start + n)
 
     def generate_batch(self, tokens, num_samples=1, **kwargs):
         """
@@ -308,12 +1728,21 @@ class Engine:
         Returns a list of token sequences (list of lists of ints).
         Terminal tokens (assistant_end, bos) are not included in the results.
         """
+        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        results, masks = self.generate_many_batch([tokens], num_samples, **kwargs)
+        return results[0], masks[0]
+
+    def generate_many_batch(self, prompts, num_samples=1, **kwargs):
+        """
+        Non-streaming version of generate_many. Returns the token sequences and masks
+        nested per prompt, i.e. results[i][j] is sample j of prompt i.
+        """
         assistant_end = self.tokenizer.encode_special("<|assistant_end|>")
         bos = self.tokenizer.get_bos_token_id()
-        results = [tokens.copy() for _ in range(num_samples)]
-        masks = [[0] * len(tokens) for _ in range(num_samples)]
-        completed = [False] * num_samples
-        for token_column, token_masks in self.generate(tokens, num_samples, **kwargs):
+        results = [tokens.copy() for tokens in prompts for _ in range(num_samples)]
+        masks = [[0] * len(tokens) for tokens in prompts for _ in range(num_samples)]
+        completed = [False] * len(results)
+        for token_column, token_masks in self.generate_many(prompts, num_samples, **kwargs):
             for i, (token, mask) in enumerate(zip(token_column, token_masks)):
                 if not completed[i]:
                     if token == assistant_end or token == bos:
@@ -324,8 +1753,433 @@ class Engine:
             # Stop if all rows are completed
             if all(completed):
                 break
+        results = [results[i:i + num_samples] for i in range(0, len(results), num_samples)]
+        masks = [masks[i:i + num_samples] for i in range(0, len(masks), num_samples)]
         return results, masks
 
+    def beam_search(self, tokens, beam_width=4, max_tokens=256, length_penalty=1.0):
+        """
+        Keep the beam_width most likely continuations of tokens at every step. Returns a list of
+        (tokens, logprob) sorted from best to worst by logprob / num_generated ** length_penalty.
+        Terminal tokens (assistant_end, bos) are not included in the results.
+        """
+        return self._search(tokens, beam_width, max_tokens, length_penalty, sample=False)
+
+    def best_of_n(self, tokens, n=4, max_tokens=256, temperature=1.0, top_k=None, seed=42, length_penalty=1.0):
+        """
+        Sample n continuations of tokens and rank them by their cumulative logprob under the model.
+        Returns the same list of (tokens, logprob) as beam_search.
+        """
+        return self._search(tokens, n, max_tokens, length_penalty, sample=True, temperature=temperature, top_k=top_k, seed=seed)
+
+    @torch.inference_mode()
+    def _search(self, tokens, num_beams, max_tokens, length_penalty, sample, temperature=1.0, top_k=None, seed=42):
+        # The beams are rows of the paged KV cache: they share the blocks of their common prefix, and
+        # reordering the beams after each step only forks the block tables of the surviving parents
+        # (copy-on-write, at most the last partial block ever gets copied), nothing is re-prefilled.
+        # Forced tokens (tool outputs) cost nothing: a beam with pending forced tokens just takes them.
+        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        device = self.model.get_device()
+        rng = torch.Generator(device=device)
+        rng.manual_seed(seed)
+        prompt_row, logits = self.prefill_row(tokens)
+        # with sampling, the n rows evolve independently from the start, a beam search starts from one
+        num_rows = num_beams if sample else 1
+        beams = [(row, RowState(tokens.copy()), 0.0) for row in [prompt_row] + [prompt_row.fork() for _ in range(num_rows - 1)]]
+        finished = [] # (state, logprob)
+        try:
+            for step in range(max_tokens):
+                forwarding = list(range(len(beams)))
+                if step > 0:
+                    # beams with forced tokens emit them without a forward pass, like the rows of generate_many
+                    forwarding = [b for b, (_, state, _) in enumerate(beams) if not state.forced_tokens]
+                    if forwarding:
+                        logits = self.forward_pending([beams[b][0] for b in forwarding], [beams[b][1] for b in forwarding])
+                if forwarding:
+                    logprobs = F.log_softmax(logits.float(), dim=-1)
+                    if sample:
+                        if logprobs.size(0) < len(forwarding): # the prompt logits, shared by all the rows
+                            logprobs = logprobs.expand(len(forwarding), -1)
+                            logits = logits.expand(len(forwarding), -1)
+                        next_ids = sample_next_token(logits, rng, temperature, top_k) # (B, 1)
+                        next_logprobs = logprobs.gather(1, next_ids)
+                    else:
+                        next_logprobs, next_ids = logprobs.topk(num_beams, dim=-1) # (B, num_beams)
+                    next_ids, next_logprobs = next_ids.tolist(), next_logprobs.tolist()
+                slot = {b: k for k, b in enumerate(forwarding)}
+                # candidates (logprob, beam index, sampled token), where None stands for a forced token
+                candidates = []
+                for b, (_, state, logprob) in enumerate(beams):
+                    self.wait_tool(state) # the forward pass above overlapped with it
+                    if state.forced_tokens:
+                        candidates.append((logprob, b, None))
+                    else:
+                        k = slot[b]
+                        candidates.extend((logprob + lp, b, token) for lp, token in zip(next_logprobs[k], next_ids[k]))
+                if not sample:
+                    candidates.sort(key=lambda c: c[0], reverse=True)
+                new_beams = []
+                for rank, (logprob, b, token) in enumerate(candidates):
+                    if len(new_beams) == num_rows:
+                        break
+                    row, state, _ = beams[b]
+                    state = state.fork()
+                    self.advance_row(state, token)
+                    if state.completed:
+                        # only finish beams that made the cut, not the whole tail of the candidates
+                        if sample or rank < num_beams:
+                            finished.append((state, logprob))
+                    else:
+                        new_beams.append((row.fork(), state, logprob))
+                # the old rows go away, their blocks live on in the rows that forked them
+                for row, _, _ in beams:
+                    row.release()
+                beams = new_beams
+                # samples that finish are not replaced, the beams widen to num_beams after the prompt step
+                num_rows = len(beams) if sample else num_beams
+                if not beams or (not sample and len(finished) >= num_beams):
+                    break
+        finally:
+            for row, _, _ in beams:
+                row.release()
+        # beams still going at max_tokens are ranked along with the finished ones
+        special = self.special_tokens()
+        hypotheses = []
+        for state, logprob in finished + [(state, logprob) for _, state, logprob in beams]:
+            generated = state.current_tokens[len(tokens):]
+            if generated and generated[-1] in (special["assistant_end"], special["bos"]):
+                generated = generated[:-1]
+            score = logprob / max(len(state.current_tokens) - len(tokens), 1) ** length_penalty
+            hypotheses.append((score, tokens + generated, logprob))
+        hypotheses.sort(key=lambda h: h[0], reverse=True)
+        return [(result, logprob) for _, result, logprob in hypotheses[:num_beams]]
+
+# -----------------------------------------------------------------------------
+# Multi-turn sessions: the KV cache of a conversation carries over from one turn to the next
+
+class Session:
+    """
+    A conversation on top of the Engine that keeps its row of the paged KV cache (and its rng) between calls
+    to generate: each turn only forwards the tokens appended since the previous one, so its cost depends on the
+    new input, not on the length of the history. Editing the history (truncate, or set_tokens with an edited
+    conversation) rolls the row back to the common prefix, and only what comes after it gets recomputed.
+    With a KV window on the Engine, the memory of a session stays bounded however long it goes on.
+    Call close() to give the blocks back to the pool.
+    """
+
+    def __init__(self, engine, tokens=(), seed=42):
+        self.engine = engine
+        self.tokens = list(tokens) # the whole conversation, the KV cache holds a prefix of it
+        self.row = BlockTable(engine.get_kv_pool())
+        self.draft_row = BlockTable(engine.draft.get_kv_pool()) if engine.draft is not None else None
+        self.rng = torch.Generator(device=engine.model.get_device())
+        self.rng.manual_seed(seed)
+
+    def extend(self, tokens):
+        """Append tokens to the conversation (e.g. a user turn), the next generate forwards them."""
+        self.tokens.extend(tokens)
+
+    def truncate(self, length):
+        """Roll the conversation back to its first length tokens, e.g. to regenerate the last response."""
+        del self.tokens[length:]
+        for row in (self.row, self.draft_row):
+            if row is not None and row.length > length:
+                if row.can_truncate(length):
+                    row.truncate(length)
+                else:
+                    row.release() # rolled back to tokens that were evicted (KV window), start over
+
+    def set_tokens(self, tokens):
+        """Replace the conversation, e.g. with an edited one: the KV of the common prefix is kept."""
+        n = 0
+        while n < min(len(tokens), len(self.tokens)) and tokens[n] == self.tokens[n]:
+            n += 1
+        self.truncate(n)
+        self.extend(tokens[n:])
+
+    def close(self):
+        for row in (self.row, self.draft_row):
+            if row is not None:
+                row.release()
+
+    @torch.inference_mode()
+    def generate(self, max_tokens=None, temperature=1.0, top_k=None, cancel=None):
+        """
+        Continue the conversation, yielding (token, mask) like Engine.generate does for a single row, until it's done
+        or the cancel token (if any) is cancelled.
+        The tokens are appended to the conversation as they go, tool use included. With a draft model
+        or prompt lookup on the Engine, the decode steps are speculative.
+        """
+        assert len(self.tokens) > 0, "nothing to continue"
+        engine = self.engine
+        # the last token always gets forwarded again, we need its logits
+        for row in (self.row, self.draft_row):
+            if row is not None and row.length == len(self.tokens):
+                row.truncate(row.length - 1)
+        state = RowState(self.tokens) # shares the list: advance_row appends to the conversation
+        rows, draft_rows = [self.row], [self.draft_row] if self.draft_row is not None else []
+        speculative = engine.draft is not None or engine.prompt_lookup_ngram > 0
+        num_generated = 0
+        while not state.completed and (max_tokens is None or num_generated < max_tokens):
+            if cancel is not None and cancel.is_cancelled():
+                break
+            # Speculate once the row is caught up (after the first step of a turn, which forwards the new input)
+            speculation = None
+            if speculative and self.row.length == len(self.tokens) - 1 and not state.may_force():
+                speculation = engine._speculate(rows, draft_rows, [state], self.rng, temperature, top_k)
+            if speculation is not None:
+                (run,), proposals = speculation
+                state.lookahead.extend(run)
+                columns = [[None]] * len(run)
+            elif state.forced_tokens:
+                columns = [[None]] # forced tokens need no forward pass, they get forwarded in one chunk later
+            else:
+                logits = engine.forward_pending(rows, [state])
+                columns = [sample_next_token(logits, self.rng, temperature, top_k)[:, 0].tolist()]
+            try:
+                for j, (sampled_token,) in enumerate(columns):
+                    if j > 0 and (state.may_force() or state.completed):
+                        break
+                    if max_tokens is not None and num_generated >= max_tokens:
+                        break
+                    yield engine.advance_row(state, sampled_token)
+                    num_generated += 1
+            finally:
+                # (also when the caller stops early: the row must not keep KV past the conversation)
+                if speculation is not None:
+                    state.lookahead.clear()
+                    engine._rollback_speculation(rows, draft_rows, [state], proposals)
+
+
+# -----------------------------------------------------------------------------
+# Continuous batching: many independent requests share one decode batch
+
+class Request(RowState):
+    """A single generation request: a RowState with its own prompt, sampling params, rng and budget."""
+    def __init__(self, request_id, tokens, max_tokens=None, temperature=1.0, top_k=None, seed=42, device=None,
+                 top_p=None, min_p=None, repetition_penalty=None, frequency_penalty=None, presence_penalty=None, grammar=None, cancel=None):
+        super().__init__(tokens.copy())
+        if grammar is not None:
+            self.set_grammar(grammar)
+        self.request_id = request_id
+        self.prompt_len = len(tokens)
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty # the penalties only count the generated tokens, not the prompt
+        self.frequency_penalty = frequency_penalty
+        self.presence_penalty = presence_penalty
+        self.token_counts = None # (vocab_size,) how many times each token was generated, kept up to date by the penalties
+        self.num_counted = 0 # generated tokens already in token_counts
+        self.rng = torch.Generator(device=device)
+        self.rng.manual_seed(seed)
+        self.num_generated = 0
+        self.kv = None # BlockTable of this request in the paged KV cache, once admitted
+        self.paused = False # set by the caller to hold the request back for a while, e.g. while its client catches up
+        self.cancel = cancel # CancelToken: the request is dropped at the next step once it's cancelled (or past its deadline)
+        self.cancelled = False
+        self.arrival_time = time.perf_counter()
+        self.first_token_time = None
+
+class Scheduler:
+    """
+    Continuous batching on top of the Engine. Requests are admitted into the running
+    decode batch as soon as there is room (after a ragged prefill of their prompts),
+    every step forwards all the running rows together, and finished rows are retired
+    right away so that their slot frees up for the next waiting request.
+    With engine.prefill_chunk_size set, a long prompt is prefilled one chunk per step,
+    interleaved with the decode steps of the running requests, so they don't stall.
+    The rows of the batch sit at different positions, so the (paged) KV cache is ragged.
+    Admitting and retiring a row only touches its block table, no KV is ever copied.
+    Invariant: the KV cache of a running row holds all of its tokens except the last one, and except
+    the forced tokens it emitted since it last took part in a forward pass (see Engine.forward_pending).
+    """
+
+    def __init__(self, engine, max_batch_size=32):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.waiting = deque() # requests that were added but are not yet in the batch
+        self.running = [] # requests in the batch
+        self.prefilling = [] # admitted requests whose prompt is still being prefilled
+        self.next_request_id = 0
+
+    def add_request(self, tokens, max_tokens=None, temperature=1.0, top_k=None, seed=42, **sampling):
+        """Queue up a request. The other params (top_p, min_p, the penalties, grammar, cancel) are those of Request."""
+        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        device = self.engine.model.get_device()
+        request = Request(self.next_request_id, tokens, max_tokens, temperature, top_k, seed, device, **sampling)
+        self.next_request_id += 1
+        self.waiting.append(request)
+        return request
+
+    def num_requests(self):
+        return len(self.waiting) + len(self.prefilling) + len(self.running)
+
+    def has_work(self):
+        return self.num_requests() > 0
+
+    def can_step(self):
+        """Is there anything for step to do, i.e. anything but paused requests (that are not cancelled)?"""
+        return bool(self.waiting or self.prefilling) or any(not r.paused or (r.cancel is not None and r.cancel.is_cancelled()) for r in self.running)
+
+    # sampling params of Request, and the value that turns each of them off
+    SAMPLING_PARAMS = [("temperature", 1.0), ("top_k", 0), ("top_p", 1.0), ("min_p", 0.0),
+                       ("repetition_penalty", 1.0), ("frequency_penalty", 0.0), ("presence_penalty", 0.0)]
+
+    def _sample(self, logits, requests):
+        # one vectorized pass over the batch, with the params of every request as (B,) tensors and its own rng
+        device = logits.device
+        kwargs = {}
+        for name, off in self.SAMPLING_PARAMS:
+            values = [getattr(r, name) for r in requests]
+            if any(value is not None for value in values):
+                kwargs[name] = torch.tensor([off if value is None else value for value in values], dtype=torch.float32, device=device)
+        if any(name in kwargs for name in ("repetition_penalty", "frequency_penalty", "presence_penalty")):
+            # how many times each request generated each token so far: every request keeps its counts, and only
+            # the tokens it generated since the last time get added, in one scatter (sampled and forced alike)
+            counts = torch.stack([torch.zeros(logits.size(-1), dtype=torch.float32, device=device) if r.token_counts is None else r.token_counts for r in requests])
+            rows = [i for i, r in enumerate(requests) for _ in range(len(r.current_tokens) - r.prompt_len - r.num_counted)]
+            tokens = [token for r in requests for token in r.current_tokens[r.prompt_len + r.num_counted:]]
+            if tokens:
+                counts.index_put_((torch.tensor(rows, device=device), torch.tensor(tokens, device=device)), torch.ones(len(tokens), device=device), accumulate=True)
+            for r, request_counts in zip(requests, counts):
+                r.token_counts, r.num_counted = request_counts, len(r.current_tokens) - r.prompt_len
+            kwargs["token_counts"] = counts
+        logits = self.engine.constrain(logits, requests)
+        return sample_rows(logits, [r.rng for r in requests], **kwargs)
+
+    def _max_blocks(self, request):
+        # the most blocks the row of a request can hold: all of its tokens (up to the KV window, plus a chunk of
+        # padding), and a block copied on write. Without max_tokens only the prompt is known, that's a best effort
+        engine = self.engine
+        num_tokens = request.prompt_len + (request.max_tokens or 0)
+        if engine.kv_window is not None:
+            num_tokens = min(num_tokens, engine.kv_sink_tokens + 2 * engine.kv_window)
+        return -(-num_tokens // engine.kv_block_size) + 1
+
+    def _block_budget(self):
+        # blocks left for new requests in a capped KV pool (None: the pool grows on demand), once the admitted
+        # requests are guaranteed the blocks they may still need to complete
+        pool = self.engine.get_kv_pool()
+        if pool.max_blocks is None:
+            return None
+        budget = pool.num_free_blocks() + pool.max_blocks - pool.num_blocks() - (pool._scratch is None)
+        if self.engine.prefix_cache is not None:
+            budget += self.engine.prefix_cache.num_reclaimable_blocks()
+        for request in (*self.prefilling, *self.running):
+            budget -= max(self._max_blocks(request) - len(request.kv.blocks), 0)
+        return budget
+
+    def _drop_cancelled(self):
+        cancelled = [r for r in (*self.waiting, *self.prefilling, *self.running) if r.cancel is not None and r.cancel.is_cancelled()]
+        if cancelled:
+            for request in cancelled:
+                request.completed = request.cancelled = True
+                if request.kv is not None:
+                    request.kv.release()
+            self.waiting = deque(r for r in self.waiting if not r.cancelled)
+            self.prefilling = [r for r in self.prefilling if not r.cancelled]
+            self.running = [r for r in self.running if not r.cancelled]
+        return cancelled
+
+    @torch.inference_mode()
+    def step(self):
+        """
+        Advance every running request by one token, admit waiting requests and prefill (a chunk of) their prompts.
+        Returns a list of (request, token, mask) tuples for all the tokens produced in this step, and a
+        (request, None, 0) for each request that got cancelled (see CancelToken) before it completed.
+        """
+        hooks = self.engine.hooks
+        t_start = time.perf_counter()
+        next_ids = []
+        # 0) Drop the cancelled requests (or past their deadline) wherever they are, their slot and KV free up right away
+        emitted = [(r, None, 0) for r in self._drop_cancelled()]
+        # 1) Forward all the running rows on their last token, in one batch. A row that waits for the
+        # output of its tool call (with a ToolRunner) is paused until it's there, the others go on.
+        # A row with forced tokens just emits the next one, they get forwarded in one chunk afterwards.
+        # A paused request just sits in the batch, with its KV, until it's resumed
+        stepping = [r for r in self.running if r.tool_ready() and not r.paused]
+        forcing = [r for r in stepping if r.forced_tokens]
+        decoding = [r for r in stepping if not r.forced_tokens]
+        if decoding:
+            logits = self.engine.forward_pending([r.kv for r in decoding], decoding) # (B, vocab_size)
+            next_ids.append(self._sample(logits, decoding))
+        batch_size = len(decoding) + len(forcing)
+        if hooks:
+            self.engine.synchronize() # time the decode step apart from the prefill
+        # 2) Admit waiting requests into fresh rows (past their cached prefixes). With a capped KV pool, only
+        # the ones that the blocks left can see through to the end, the others wait their turn (first come, first
+        # served). A request alone in the scheduler is always admitted, it would wait forever otherwise
+        num_cached = 0
+        budget = self._block_budget() if self.waiting else None
+        while self.waiting and len(self.running) + len(self.prefilling) < self.max_batch_size:
+            if budget is not None:
+                num_blocks = self._max_blocks(self.waiting[0])
+                if num_blocks > budget and (self.running or self.prefilling):
+                    break
+                budget -= num_blocks
+            request = self.waiting.popleft()
+            request.kv = self.engine.new_row(request.current_tokens)
+            num_cached += request.kv.length
+            self.prefilling.append(request)
+        # 3) Prefill the admitted requests, one ragged batch of (at most) a chunk per request
+        prefill_time = 0.0
+        if self.prefilling:
+            t_prefill = time.perf_counter()
+            chunk_size = self.engine.prefill_chunk_size or max(len(r.current_tokens) for r in self.prefilling)
+            seqs = [r.current_tokens[r.kv.length:r.kv.length + chunk_size] for r in self.prefilling]
+            num_prefill_rows = len(seqs)
+            logits = self.engine.forward_rows([r.kv for r in self.prefilling], seqs)
+            # the requests done with their prompt sample their first token and join the batch
+            done = [i for i, r in enumerate(self.prefilling) if r.kv.length == len(r.current_tokens)]
+            if done:
+                admitted = [self.prefilling[i] for i in done]
+                for request in admitted:
+                    self.engine.cache_prefix(request.current_tokens, request.kv)
+                next_ids.append(self._sample(logits[done], admitted))
+                self.running.extend(admitted)
+                decoding.extend(admitted)
+                self.prefilling = [r for r in self.prefilling if r.kv.length < len(r.current_tokens)]
+            if hooks:
+                self.engine.synchronize()
+                prefill_time = time.perf_counter() - t_prefill
+                self.engine.emit("on_prefill", num_rows=num_prefill_rows, num_tokens=sum(len(seq) for seq in seqs),
+                                 num_cached_tokens=num_cached, time=prefill_time)
+        if not next_ids and not forcing:
+            # only paused rows: give their tool calls a moment instead of spinning
+            pending = [r.pending_tool for r in self.running if not r.tool_ready() and not r.paused]
+            if pending:
+                concurrent.futures.wait(pending, timeout=0.01, return_when=concurrent.futures.FIRST_COMPLETED)
+            return emitted
+        sampled_tokens = torch.cat(next_ids, dim=0)[:, 0].tolist() if next_ids else [] # single device->host sync
+        # 4) Update the state of each row, optional tool use
+        for request, sampled_token in list(zip(decoding, sampled_tokens)) + [(r, None) for r in forcing]:
+            token, mask = self.engine.advance_row(request, sampled_token)
+            request.num_generated += 1
+            if request.first_token_time is None:
+                request.first_token_time = time.perf_counter()
+            if request.max_tokens is not None and request.num_generated >= request.max_tokens:
+                request.completed = True
+            emitted.append((request, token, mask))
+        if hooks and batch_size > 0:
+            # the first tokens of the requests that were just admitted come from their prefill, not from this step
+            masks = [mask for request, token, mask in emitted if token is not None and request.num_generated > 1]
+            self.engine.emit("on_step", batch_size=batch_size, num_columns=1, num_sampled=sum(masks), num_forced=len(masks) - sum(masks),
+                             kv_bytes=self.engine.kv_bytes_in_use(), time=time.perf_counter() - t_start - prefill_time)
+        # 5) Retire the finished rows, their blocks go back to the pool (or stay in the prefix cache)
+        now = time.perf_counter()
+        for request in self.running:
+            if request.completed:
+                self.engine.cache_prefix(request.current_tokens, request.kv)
+                request.kv.release()
+                if hooks:
+                    self.engine.emit("on_finish", num_rows=1, num_prompt_tokens=request.prompt_len, num_generated_tokens=request.num_generated,
+                                     time_to_first_token=request.first_token_time - request.arrival_time, time=now - request.arrival_time)
+        self.running = [r for r in self.running if not r.completed]
+        return emitted
+
 
 if __name__ == "__main__":
     """
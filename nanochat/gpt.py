@@ -85,7 +85,12 @@ class CausalSelfAttention(nn.Module):
 
         # Attention: queries attend to keys/values autoregressively. A few cases to handle:
         enable_gqa = self.n_head != self.n_kv_head # Group Query Attention (GQA): duplicate key/value heads to match query heads if desired
-        if kv_cache is None or Tq == Tk:
+        attn_mask = None if kv_cache is None else kv_cache.attn_mask
+        if attn_mask is not None:
+            # During inference with a ragged batch, i.e. rows sit at different positions in the cache:
+            # the KV cache hands us the (B, 1, Tq, Tk) mask that accounts for each row's own prefix
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, enable_gqa=enable_gqa)
+        elif kv_cache is None or Tq == Tk:
             # During training (no KV cache), attend as usual with causal attention
             # And even if there is KV cache, we can still use this simple version when Tq == Tk
             y = F.scaled_dot_product_attention(q, k, v, is_causal=True, enable_gqa=enable_gqa)
@@ -240,7 +245,14 @@ class GPT(nn.Module):
                 group["initial_lr"] = group["lr"]
         return optimizers
 
-    def forward(self, idx, targets=None, kv_cache=None, loss_reduction='mean'):
+    def forward(self, idx, targets=None, kv_cache=None, loss_reduction='mean', logits_positions=None, vocab_subset=None):
+        """
+        Returns the loss if targets are given, otherwise the logits (B, T, vocab_size).
+        At inference, the lm_head can be restricted to what the caller actually reads:
+        - logits_positions: time positions to compute the logits at, either (P,) shared by all
+          rows (negative indices ok) or (B, P) per row, the logits are then (B, P, vocab_size)
+        - vocab_subset: (S,) token ids, the logits are then only over these columns (..., S)
+        """
         B, T = idx.size()
 
         # Grab the rotary embeddings for the current sequence length (they are of shape (1, seq_len, 1, head_dim/2))
@@ -248,8 +260,14 @@ class GPT(nn.Module):
         assert idx.device == self.cos.device, f"Rotary embeddings and idx are on different devices: {idx.device} != {self.cos.device}"
         assert self.cos.dtype == torch.bfloat16, "Rotary embeddings must be in bfloat16"
         # if kv cache exists, we need to offset the rotary embeddings to the current position in the cache
-        T0 = 0 if kv_cache is None else kv_cache.get_pos()
-        cos_sin = self.cos[:, T0:T0+T], self.sin[:, T0:T0+T] # truncate cache to current sequence length
+        row_pos = None if kv_cache is None else kv_cache.get_row_pos()
+        if row_pos is None:
+            T0 = 0 if kv_cache is None else kv_cache.get_pos()
+            cos_sin = self.cos[:, T0:T0+T], self.sin[:, T0:T0+T] # truncate cache to current sequence length
+        else:
+            # ragged batch: every row continues from its own position in the cache
+            pos = row_pos[:, None] + torch.arange(T, device=idx.device) # (B, T)
+            cos_sin = self.cos[0, pos], self.sin[0, pos] # (B, T, 1, head_dim/2)
 
         # Forward the trunk of the Transformer
         x = self.transformer.wte(idx)
@@ -258,9 +276,25 @@ class GPT(nn.Module):
             x = block(x, cos_sin, kv_cache)
         x = norm(x)
 
+        # Only keep the positions we need the logits for
+        if logits_positions is not None:
+            assert targets is None, "logits_positions is for inference only"
+            logits_positions = torch.as_tensor(logits_positions, dtype=torch.long, device=x.device)
+            if logits_positions.ndim == 1:
+                x = x[:, logits_positions] # (B, P, n_embd)
+            else:
+                x = x.gather(1, logits_positions.unsqueeze(-1).expand(-1, -1, x.size(-1))) # (B, P, n_embd)
+
         # Forward the lm_head (compute logits)
         softcap = 15 # smoothly cap the logits to the range [-softcap, softcap]
-        logits = self.lm_head(x) # (B, T, vocab_size) <- very big tensor, large amount of memory
+        if vocab_subset is not None:
+            assert targets is None, "vocab_subset is for inference only"
+            vocab_subset = torch.as_tensor(vocab_subset, dtype=torch.long, device=x.device)
+            # (a quantized lm_head dequantizes just these rows of its weights)
+            weight = self.lm_head.dequantize(x.dtype, rows=vocab_subset) if hasattr(self.lm_head, "dequantize") else self.lm_head.weight[vocab_subset]
+            logits = F.linear(x, weight) # (B, T, S)
+        else:
+            logits = self.lm_head(x) # (B, T, vocab_size) <- very big tensor, large amount of memory
         logits = logits.float() # switch to fp32 for logit softcap and loss computation
         logits = softcap * torch.tanh(logits / softcap) # squash the logits
 
@@ -289,7 +323,7 @@ class GPT(nn.Module):
             rng.manual_seed(seed)
         ids = torch.tensor([tokens], dtype=torch.long, device=device) # add batch dim
         for _ in range(max_tokens):
-            logits = self.forward(ids) # (B, T, vocab_size)
+            logits = self.forward(ids, logits_positions=[-1]) # (B, 1, vocab_size)
             logits = logits[:, -1, :] # (B, vocab_size)
             if top_k is not None:
                 v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
@@ -0,0 +1,497 @@
+"""
+Constrained decoding: the tokens a row may sample are restricted so that its output matches a regex,
+or a JSON schema (which gets compiled to a regex). The regex becomes a byte-level DFA, and the tokens
+that are allowed in each state of the DFA are found by walking a byte-trie of the vocabulary along the
+DFA (the whole vocab in one walk, pruned as soon as the DFA dies), then cached as a boolean mask.
+When there is only one legal continuation (e.g. the keys and punctuation of a JSON object), it is
+forced in one go instead of being sampled one token at a time ("jump-forward",
+https://lmsys.org/blog/2024-02-05-compressed-fsm/).
+
+Example:
+vocab = TokenVocab.from_tokenizer(tokenizer) # once per tokenizer, shared by all the grammars
+grammar = Grammar.from_json_schema({"type": "object", "properties": {"answer": {"type": "integer"}}}, vocab)
+results, masks = engine.generate_batch(tokens, grammar=grammar)
+
+Supported regex syntax: literals, escapes (\\d \\w \\s and their negations, \\n \\t \\xhh \\uhhhh ...), classes
+[a-z] [^...], ., groups (...) (?:...), alternation |, quantifiers * + ? {n} {n,} {n,m}. The whole
+output has to match (anchors are ignored). Classes only take ASCII characters, negated classes and .
+match any non-ASCII byte, i.e. they let multi-byte UTF-8 characters through one byte at a time.
+"""
+
+import re
+import json
+import torch
+
+ALL_BYTES = (1 << 256) - 1 # byte sets are 256-bit masks
+
+def _byte_set(*ranges):
+    mask = 0
+    for lo, hi in ranges:
+        for b in range(ord(lo), ord(hi) + 1):
+            mask |= 1 << b
+    return mask
+
+DIGITS = _byte_set("09")
+WORD = _byte_set("az", "AZ", "09", "__")
+SPACE = _byte_set("  ", "\t\r") # space, \t \n \v \f \r
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+CLASS_ESCAPES = {"d": DIGITS, "w": WORD, "s": SPACE}
+
+# limits on what a regex may cost to compile (they come from clients): past them, compile_dfa raises a ValueError
+MAX_REPEAT = 1000 # bounds of the {n,m} quantifiers
+MAX_NESTING = 100 # depth of the groups and quantifiers nested in each other (a chain like a??? nests too)
+MAX_NFA_STATES = 50_000
+MAX_DFA_STATES = 10_000
+
+# -----------------------------------------------------------------------------
+# Regex -> syntax tree -> NFA (Thompson) -> DFA (subset construction), all over bytes
+
+class _RegexParser:
+    # nodes: ("bytes", mask) | ("seq", [nodes]) | ("alt", [nodes]) | ("repeat", node, min, max or None)
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.i = 0
+        self.depth = 0 # groups open at the current position
+        self.deepest = 0 # nesting of the groups and quantifiers parsed so far in the current item
+
+    def parse(self):
+        node = self.alternation()
+        if self.i != len(self.pattern):
+            raise ValueError(f"Unexpected {self.pattern[self.i]!r} at position {self.i} in regex {self.pattern!r}")
+        return node
+
+    def peek(self):
+        return self.pattern[self.i] if self.i < len(self.pattern) else None
+
+    def alternation(self):
+        branches = [self.sequence()]
+        while self.peek() == "|":
+            self.i += 1
+            branches.append(self.sequence())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def sequence(self):
+        items = []
+        while self.peek() not in (None, "|", ")"):
+            items.append(self.quantified())
+        return ("seq", items)
+
+    def quantified(self):
+        outer = self.deepest
+        self.deepest = self.depth
+        node = self.atom()
+        # the quantifiers nest on top of whatever the atom nests: the NFA is built recursively along that
+        nesting = self.deepest
+        while True:
+            c = self.peek()
+            if c in ("*", "+", "?"):
+                lo, hi = {"*": (0, None), "+": (1, None), "?": (0, 1)}[c]
+                self.i += 1
+            elif c == "{" and (m := re.match(r"\{(\d+)(,(\d*))?\}", self.pattern[self.i:])):
+                lo = int(m.group(1))
+                hi = lo if m.group(2) is None else (int(m.group(3)) if m.group(3) else None)
+                if max(lo, hi or 0) > MAX_REPEAT:
+                    raise ValueError(f"Repeat counts above {MAX_REPEAT} are not supported, in regex {self.pattern!r}")
+                if hi is not None and hi < lo:
+                    raise ValueError(f"Bad repeat {m.group(0)} in regex {self.pattern!r}")
+                self.i += m.end()
+            else:
+                self.deepest = max(outer, nesting)
+                return node
+            if self.peek() in ("?", "+"): # lazy/possessive quantifiers match the same strings
+                self.i += 1
+            nesting += 1
+            if nesting > MAX_NESTING:
+                raise ValueError(f"Groups and quantifiers nested deeper than {MAX_NESTING} are not supported, in regex {self.pattern!r}")
+            node = ("repeat", node, lo, hi)
+
+    def atom(self):
+        c = self.pattern[self.i]
+        self.i += 1
+        if c == "(":
+            if self.pattern.startswith("?:", self.i):
+                self.i += 2
+            self.depth += 1
+            if self.depth > MAX_NESTING:
+                raise ValueError(f"Groups and quantifiers nested deeper than {MAX_NESTING} are not supported, in regex {self.pattern!r}")
+            self.deepest = max(self.deepest, self.depth)
+            node = self.alternation()
+            if self.peek() != ")":
+                raise ValueError(f"Unbalanced parenthesis in regex {self.pattern!r}")
+            self.depth -= 1
+            self.i += 1
+            return node
+        if c == "[":
+            return ("bytes", self.char_class())
+        if c == ".":
+            return ("bytes", ALL_BYTES & ~(1 << ord("\n")))
+        if c in "^$": # the whole output has to match anyway
+            return ("seq", [])
+        if c == "\\":
+            escaped = self.escape()
+            return ("bytes", escaped) if isinstance(escaped, int) else self.literal(escaped)
+        return self.literal(c)
+
+    def literal(self, text):
+        return ("seq", [("bytes", 1 << b) for b in text.encode("utf-8")])
+
+    def escape(self):
+        # returns a byte set for the class escapes, otherwise the escaped character
+        c = self.peek()
+        if c is None:
+            raise ValueError(f"Trailing backslash in regex {self.pattern!r}")
+        self.i += 1
+        if c.lower() in CLASS_ESCAPES:
+            mask = CLASS_ESCAPES[c.lower()]
+            return mask if c.islower() else ALL_BYTES & ~mask
+        if c in ESCAPES:
+            return ESCAPES[c]
+        if c in "xu":
+            n = 2 if c == "x" else 4
+            code = self.pattern[self.i:self.i + n]
+            if not re.fullmatch(f"[0-9a-fA-F]{{{n}}}", code):
+                raise ValueError(f"Bad escape \\{c}{code} in regex {self.pattern!r}")
+            self.i += n
+            return chr(int(code, 16))
+        return c
+
+    def char_class(self):
+        negate = self.peek() == "^"
+        if negate:
+            self.i += 1
+        mask = 0
+        first = True
+        while True:
+            c = self.peek()
+            if c is None:
+                raise ValueError(f"Unterminated character class in regex {self.pattern!r}")
+            if c == "]" and not first:
+                self.i += 1
+                break
+            first = False
+            self.i += 1
+            lo = self.escape() if c == "\\" else c
+            if isinstance(lo, int): # \d, \w, ...
+                mask |= lo
+                continue
+            hi = lo
+            if self.peek() == "-" and self.pattern[self.i + 1:self.i + 2] not in ("]", ""):
+                self.i += 1
+                c = self.pattern[self.i]
+                self.i += 1
+                hi = self.escape() if c == "\\" else c
+            if isinstance(hi, int) or ord(lo) > 127 or ord(hi) > 127:
+                raise ValueError(f"Only ASCII characters are supported in character classes, in regex {self.pattern!r}")
+            mask |= _byte_set((lo, hi))
+        return ALL_BYTES & ~mask if negate else mask
+
+
+class _NFA:
+
+    def __init__(self):
+        self.eps = [] # state -> states reachable without consuming a byte
+        self.edges = [] # state -> [(byte set, state)]
+
+    def new_state(self):
+        if len(self.eps) >= MAX_NFA_STATES:
+            raise ValueError(f"Regex too large, it needs more than {MAX_NFA_STATES} NFA states")
+        self.eps.append([])
+        self.edges.append([])
+        return len(self.eps) - 1
+
+    def build(self, node, start):
+        """Add the states for node, starting from start. Returns the end state."""
+        kind = node[0]
+        if kind == "bytes":
+            end = self.new_state()
+            self.edges[start].append((node[1], end))
+            return end
+        if kind == "seq":
+            for item in node[1]:
+                start = self.build(item, start)
+            return start
+        if kind == "alt":
+            end = self.new_state()
+            for branch in node[1]:
+                self.eps[self.build(branch, start)].append(end)
+            return end
+        _, item, lo, hi = node
+        for _ in range(lo):
+            start = self.build(item, start)
+        if hi is None:
+            loop = self.new_state()
+            self.eps[start].append(loop)
+            self.eps[self.build(item, loop)].append(loop)
+            return loop
+        # x{0,k} as (x(x(...)?)?)?: each copy can skip straight to the end, which keeps the closures small
+        end = self.new_state()
+        for _ in range(hi - lo):
+            self.eps[start].append(end)
+            start = self.build(item, start)
+        self.eps[start].append(end)
+        return end
+
+    def closure(self, states):
+        stack = list(states)
+        closed = set(states)
+        while stack:
+            for t in self.eps[stack.pop()]:
+                if t not in closed:
+                    closed.add(t)
+                    stack.append(t)
+        return frozenset(closed)
+
+
+def compile_dfa(pattern):
+    """
+    Compile a regex to a byte-level DFA. Returns (transitions, accepting, start): transitions[state]
+    is a list of 256 next states, -1 when the byte is not allowed, or when no match is possible anymore
+    after it (the DFA only keeps the states from which an accepting state can still be reached).
+    Raises a ValueError for the regexes that are not supported, or too costly (see MAX_REPEAT ...).
+    """
+    nfa = _NFA()
+    nfa_start = nfa.new_state()
+    nfa_end = nfa.build(_RegexParser(pattern).parse(), nfa_start)
+    # bytes that no edge tells apart behave the same, only one of each class needs to be stepped
+    masks = list({mask for edges in nfa.edges for mask, _ in edges})
+    classes = {}
+    byte_class = [classes.setdefault(tuple(mask >> b & 1 for mask in masks), len(classes)) for b in range(256)]
+    representatives = [byte_class.index(c) for c in range(len(classes))]
+    # subset construction
+    start = nfa.closure([nfa_start])
+    ids = {start: 0}
+    subsets = [start]
+    class_transitions = []
+    while len(class_transitions) < len(subsets):
+        subset = subsets[len(class_transitions)]
+        row = []
+        for b in representatives:
+            targets = nfa.closure([t for s in subset for mask, t in nfa.edges[s] if mask >> b & 1])
+            if not targets:
+                row.append(-1)
+                continue
+            if targets not in ids:
+                if len(subsets) >= MAX_DFA_STATES:
+                    raise ValueError(f"Regex {pattern!r} is too complex, it needs more than {MAX_DFA_STATES} DFA states")
+                ids[targets] = len(subsets)
+                subsets.append(targets)
+            row.append(ids[targets])
+        class_transitions.append(row)
+    accepting = [nfa_end in subset for subset in subsets]
+    # prune the states from which no accepting state is reachable
+    reverse = [set() for _ in subsets]
+    for s, row in enumerate(class_transitions):
+        for t in row:
+            if t >= 0:
+                reverse[t].add(s)
+    live = {s for s, accept in enumerate(accepting) if accept}
+    stack = list(live)
+    while stack:
+        for s in reverse[stack.pop()]:
+            if s not in live:
+                live.add(s)
+                stack.append(s)
+    if 0 not in live:
+        raise ValueError(f"Regex {pattern!r} does not match anything")
+    transitions = [[row[c] if row[c] in live else -1 for c in byte_class] for row in class_transitions]
+    return transitions, accepting, 0
+
+# -----------------------------------------------------------------------------
+# JSON schema -> regex (compact JSON: no whitespace around the separators)
+
+JSON_STRING_CHAR = r'([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+JSON_INTEGER = r"-?(0|[1-9][0-9]*)"
+JSON_NUMBER = JSON_INTEGER + r"(\.[0-9]+)?([eE][+-]?[0-9]+)?"
+
+def json_schema_to_regex(schema):
+    """
+    The regex of the compact JSON documents that a (subset of) JSON schema accepts. Supported: type
+    object (all the properties, in order), array (items, minItems, maxItems), string (minLength,
+    maxLength, pattern), integer, number, boolean, null, as well as enum, const, anyOf and oneOf.
+    Raises a ValueError for the schemas that are not supported (or not valid).
+    """
+    return _schema_to_regex(schema, depth=0)
+
+def _schema_to_regex(schema, depth):
+    if not isinstance(schema, dict):
+        raise ValueError(f"Expecting a JSON schema object, got {schema!r}")
+    if depth > MAX_NESTING:
+        raise ValueError(f"JSON schemas nested deeper than {MAX_NESTING} are not supported")
+    subschema = lambda s: _schema_to_regex(s, depth + 1)
+    literal = lambda value: re.escape(json.dumps(value, separators=(",", ":")))
+    if "const" in schema:
+        return literal(schema["const"])
+    if "enum" in schema:
+        if not isinstance(schema["enum"], list) or not schema["enum"]:
+            raise ValueError(f"enum must be a non-empty list, in {schema}")
+        return "(" + "|".join(literal(value) for value in schema["enum"]) + ")"
+    if "anyOf" in schema or "oneOf" in schema:
+        options = schema.get("anyOf", schema.get("oneOf"))
+        if not isinstance(options, list) or not options:
+            raise ValueError(f"anyOf/oneOf must be a non-empty list, in {schema}")
+        return "(" + "|".join(subschema(s) for s in options) + ")"
+    kind = schema.get("type")
+    if kind == "object":
+        properties = schema.get("properties", {})
+        if not isinstance(properties, dict):
+            raise ValueError(f"properties must be an object, in {schema}")
+        members = [literal(name) + ":" + subschema(s) for name, s in properties.items()]
+        return r"\{" + ",".join(members) + r"\}"
+    if kind == "array":
+        item = subschema(schema.get("items", {"type": "string"}))
+        lo, hi = _bounds(schema, "minItems", "maxItems")
+        if hi == 0:
+            return r"\[\]"
+        items = f"{item}(,{item}){{{max(lo - 1, 0)},{'' if hi is None else hi - 1}}}"
+        return r"\[" + (items if lo > 0 else f"({items})?") + r"\]"
+    if kind == "string":
+        if "pattern" in schema:
+            if not isinstance(schema["pattern"], str):
+                raise ValueError(f"pattern must be a string, in {schema}")
+            # grouped: an alternation in the pattern must stay between the quotes
+            return '"(' + schema["pattern"].lstrip("^").rstrip("$") + ')"'
+        lo, hi = _bounds(schema, "minLength", "maxLength")
+        return '"' + JSON_STRING_CHAR + (f"{{{lo},}}" if hi is None else f"{{{lo},{hi}}}") + '"'
+    if kind == "integer":
+        return JSON_INTEGER
+    if kind == "number":
+        return JSON_NUMBER
+    if kind == "boolean":
+        return "(true|false)"
+    if kind == "null":
+        return "null"
+    raise ValueError(f"Unsupported JSON schema: {schema}")
+
+def _bounds(schema, min_key, max_key):
+    lo, hi = schema.get(min_key, 0), schema.get(max_key)
+    if not isinstance(lo, int) or lo < 0 or not (hi is None or isinstance(hi, int) and hi >= lo):
+        raise ValueError(f"Bad {min_key}/{max_key}, in {schema}")
+    return lo, hi
+
+# -----------------------------------------------------------------------------
+# Token level: the DFA steps over the bytes of the tokens
+
+class TokenVocab:
+    """The bytes of the tokens of a tokenizer, in a byte-trie. Build it once, all the grammars share it."""
+
+    def __init__(self, token_bytes, encode, stop_token):
+        self.token_bytes = token_bytes # token id -> bytes, None for the special tokens
+        self.encode = encode # text -> token ids, for jump-forward
+        self.stop_token = stop_token # allowed once the output matches, ends the row
+        self.trie = ({}, []) # node: (children by byte, ids of the tokens that end here)
+        for token, data in enumerate(token_bytes):
+            if data:
+                node = self.trie
+                for b in data:
+                    node = node[0].setdefault(b, ({}, []))
+                node[1].append(token)
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer):
+        return cls(tokenizer.get_token_byte_strings(), tokenizer.encode, tokenizer.encode_special("<|assistant_end|>"))
+
+
+class Grammar:
+    """
+    A regex over the bytes of the output, compiled to a DFA over tokens. A row keeps its DFA state
+    (an int, -1 once it went off the rails, e.g. through a forced token: then it can only stop).
+    The allowed tokens of a state are computed the first time the state is seen, or all of them
+    upfront with precompute(), and cached.
+    """
+
+    def __init__(self, pattern, vocab):
+        self.pattern = pattern
+        self.vocab = vocab
+        self.transitions, self.accepting, self.start = compile_dfa(pattern)
+        self._allowed = {} # state -> token ids
+        self._masks = {} # (state, device) -> bool tensor (vocab_size,)
+        self._jumps = {} # state -> token ids to force
+
+    @classmethod
+    def from_json_schema(cls, schema, vocab):
+        return cls(json_schema_to_regex(schema), vocab)
+
+    def precompute(self):
+        """Compute the allowed tokens (and jumps) of all the states upfront, e.g. when a server registers a grammar."""
+        for state in range(len(self.transitions)):
+            self.allowed_tokens(state)
+            self.jump_forward(state)
+        return self
+
+    def __getstate__(self):
+        # sent to another process without the vocab (it has its own, see Engine.add_grammar) nor the device masks
+        return dict(self.__dict__, vocab=None, _masks={})
+
+    def advance_bytes(self, state, data):
+        for b in data:
+            if state < 0:
+                break
+            state = self.transitions[state][b]
+        return state
+
+    def advance(self, state, token):
+        """The DFA state after a token. Special tokens leave it as is."""
+        data = self.vocab.token_bytes[token] if token < len(self.vocab.token_bytes) else None
+        return state if data is None else self.advance_bytes(state, data)
+
+    def is_accepting(self, state):
+        return state >= 0 and self.accepting[state]
+
+    def allowed_tokens(self, state):
+        """The tokens that keep the output on track from a state: one walk of the trie along the DFA."""
+        if state not in self._allowed:
+            allowed = []
+            if state >= 0:
+                stack = [(self.vocab.trie, state)]
+                while stack:
+                    (children, _), s = stack.pop()
+                    row = self.transitions[s]
+                    for b, child in children.items():
+                        t = row[b]
+                        if t >= 0:
+                            allowed.extend(child[1])
+                            if child[0]:
+                                stack.append((child, t))
+            if state < 0 or self.accepting[state]:
+                allowed.append(self.vocab.stop_token)
+            self._allowed[state] = allowed
+        return self._allowed[state]
+
+    def token_mask(self, state, vocab_size, device):
+        """Boolean mask (vocab_size,) of the allowed tokens of a state, cached per device."""
+        key = (state, str(device))
+        mask = self._masks.get(key)
+        if mask is None or mask.size(0) != vocab_size:
+            mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+            mask[torch.tensor(self.allowed_tokens(state), dtype=torch.long, device=device)] = True
+            self._masks[key] = mask
+        return mask
+
+    def jump_forward(self, state):
+        """
+        The tokens to force from a state: the bytes that are the only legal continuation (tokenized as
+        text), plus the stop token if the output then can't go on. Empty if there's a choice to be made.
+        """
+        if state not in self._jumps:
+            data = bytearray()
+            s = state
+            while s >= 0 and not self.accepting[s]:
+                nexts = {b: t for b, t in enumerate(self.transitions[s]) if t >= 0}
+                if len(nexts) != 1:
+                    break
+                (b, s), = nexts.items()
+                data.append(b)
+            # only jump over whole UTF-8 characters, the tokenizer works on text
+            n = len(data)
+            while n > 0:
+                try:
+                    text = data[:n].decode("utf-8")
+                    break
+                except UnicodeDecodeError:
+                    n -= 1
+            tokens = self.vocab.encode(text) if n > 0 else []
+            if n == len(data) and s >= 0 and self.accepting[s] and all(t < 0 for t in self.transitions[s]):
+                tokens.append(self.vocab.stop_token) # the match is complete, nothing more can follow
+            self._jumps[state] = tokens
+        return self._jumps[state]
@@ -0,0 +1,144 @@
+"""
+Weight-only quantization of the GPT for inference, e.g. CPU serving, which is memory-bandwidth bound.
+- int8: symmetric, one scale per output channel
+- int4: symmetric, one scale per group of group_size input channels, two weights packed per byte
+The activations stay in floating point. The matmuls avoid dequantizing the weights on every forward:
+- int8 on CPU/MPS: the fused int8 weight-only matmul of PyTorch
+- int4 on CUDA with bfloat16 activations, and on CPU: the fused int4 matmuls of PyTorch (tinygemm, and its CPU
+  port in PyTorch >= 2.6), when they support the layer. On CPU int4 is refused without them (quantize_model
+  raises): dequantizing the weights on every forward would be slower than not quantizing at all
+- int8 elsewhere: a dequantized copy of the weights, made once (so the savings are only at rest)
+- int4 elsewhere (e.g. MPS): int4 is a memory-only format there, the weights are dequantized (one layer at
+  a time) right before each matmul
+
+Example:
+model = quantize_model(model, bits=4, group_size=128)
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class QuantizedLinear(nn.Module):
+    """Drop-in inference replacement for a bias-free nn.Linear, with quantized weights."""
+
+    def __init__(self, weight, bits=8, group_size=128):
+        super().__init__()
+        assert bits in (8, 4), f"Unsupported number of bits: {bits}"
+        self.out_features, self.in_features = weight.shape
+        self.bits = bits
+        self.dtype = weight.dtype # the dtype the weights dequantize to
+        w = weight.detach().float()
+        if bits == 8:
+            scales = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0 # (out,)
+            qweight = (w / scales[:, None]).round().clamp(-127, 127).to(torch.int8) # (out, in)
+            self.group_size = self.in_features
+        else:
+            assert self.in_features % group_size == 0, f"in_features {self.in_features} is not divisible by group_size {group_size}"
+            assert group_size % 2 == 0, "two int4 weights are packed per byte"
+            self.group_size = group_size
+            w = w.view(self.out_features, -1, group_size) # (out, num_groups, group_size)
+            scales = w.abs().amax(dim=-1).clamp(min=1e-8) / 7.0 # (out, num_groups)
+            q = ((w / scales[..., None]).round().clamp(-8, 7) + 8).to(torch.uint8) # offset to [0, 15]
+            qweight = q[..., 0::2] | (q[..., 1::2] << 4) # (out, num_groups, group_size // 2)
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("scales", scales)
+        self._dequantized = None # int8 without a fused kernel: the dequantized weights, made once
+        self._int4pack = {} # int4: (device, dtype) -> (packed weights, scales and zeros) of the fused kernel, False if it's not supported
+
+    @property
+    def weight(self):
+        return self.dequantize()
+
+    def dequantize(self, dtype=None, rows=None):
+        """The weights in floating point, or only some rows of them, e.g. the columns of the logits of GPT.forward(vocab_subset=...)."""
+        dtype = self.dtype if dtype is None else dtype
+        qweight, scales = (self.qweight, self.scales) if rows is None else (self.qweight[rows], self.scales[rows])
+        if self.bits == 8:
+            return qweight.to(dtype) * scales[:, None].to(dtype)
+        low = (qweight & 0x0F).to(torch.int8) - 8
+        high = (qweight >> 4).to(torch.int8) - 8
+        q = torch.stack([low, high], dim=-1).flatten(-2) # (out, num_groups, group_size)
+        w = q.to(dtype) * scales[..., None].to(dtype)
+        return w.view(-1, self.in_features)
+
+    def int4_kernel(self, device, dtype):
+        """The weights in the layout of the fused int4 matmul of the device for activations of dtype, or False if there's none."""
+        key = (str(device), dtype)
+        if key not in self._int4pack:
+            self._int4pack[key] = self._pack_int4(torch.device(device), dtype)
+        return self._int4pack[key]
+
+    def _int4_mm(self, x2d, packed, scales_and_zeros):
+        mm = torch.ops.aten._weight_int4pack_mm_for_cpu if x2d.device.type == "cpu" else torch._weight_int4pack_mm
+        return mm(x2d, packed, self.group_size, scales_and_zeros)
+
+    def _pack_int4(self, device, dtype):
+        # checked once against the dequantized matmul, the kernels have their constraints on the shapes and group sizes
+        if not (device.type == "cuda" and dtype == torch.bfloat16 or device.type == "cpu"):
+            return False
+        try:
+            q = torch.stack([self.qweight & 0x0F, self.qweight >> 4], dim=-1).view(self.out_features, self.in_features) # [0, 15]
+            if device.type == "cpu":
+                packed = torch.ops.aten._convert_weight_to_int4pack_for_cpu(q.to(torch.int32), 1)
+            else:
+                packed = torch.ops.aten._convert_weight_to_int4pack(((q[:, 0::2] << 4) | q[:, 1::2]).contiguous(), 8)
+            scales = self.scales.t().to(dtype) # (num_groups, out)
+            scales_and_zeros = torch.stack([scales, torch.zeros_like(scales)], dim=-1).contiguous() # w = (q - 8) * scale + 0
+            probe = torch.randn(8, self.in_features, dtype=dtype, device=device)
+            y = self._int4_mm(probe, packed, scales_and_zeros).float()
+            expected = F.linear(probe, self.dequantize(dtype)).float()
+            if (y - expected).abs().max() <= 0.02 * expected.abs().max():
+                return packed, scales_and_zeros
+        except (RuntimeError, AttributeError, NotImplementedError):
+            pass # e.g. a shape or group size the kernel doesn't support, an older PyTorch, or an older layout of the packed weights
+        return False
+
+    def forward(self, x):
+        x2d = x.reshape(-1, self.in_features)
+        if self.bits == 8 and x.device.type in ("cpu", "mps"):
+            # fused int8 weight-only matmul: the weights are never materialized in floating point
+            y = torch._weight_int8pack_mm(x2d, self.qweight, self.scales.to(x.dtype))
+            return y.view(*x.shape[:-1], self.out_features)
+        if self.bits == 4:
+            kernel = self.int4_kernel(x.device, x.dtype)
+            if kernel:
+                y = self._int4_mm(x2d.contiguous(), *kernel)
+                return y.view(*x.shape[:-1], self.out_features)
+            if x.device.type == "cpu":
+                raise RuntimeError(f"No fused int4 matmul on CPU for this layer ({self.extra_repr()}) in {x.dtype}, use int8")
+        if self.bits == 8:
+            if self._dequantized is None or self._dequantized.dtype != x.dtype or self._dequantized.device != x.device:
+                self._dequantized = self.dequantize(x.dtype)
+            return F.linear(x, self._dequantized)
+        return F.linear(x, self.dequantize(x.dtype)) # int4 without a fused kernel (e.g. MPS): memory-only
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, group_size={self.group_size}"
+
+
+def quantize_model(model, bits=8, group_size=128, include_lm_head=False):
+    """
+    Replace (in place) the nn.Linear layers of the Transformer blocks of a GPT with QuantizedLinear,
+    and optionally the lm_head too (most sensitive to quantization, and a large share of the weights).
+    The token embedding stays as is: it is a lookup, not a matmul. Returns the model, for inference only.
+    int4 on CPU raises a ValueError if the fused int4 matmul of PyTorch doesn't support the layers.
+    """
+    targets = [(block, name, module) for block in model.transformer.h for name, module in block.named_modules() if isinstance(module, nn.Linear)]
+    if include_lm_head:
+        targets.append((model, "lm_head", model.lm_head))
+    for root, name, module in targets:
+        assert module.bias is None, "only bias-free linear layers are supported"
+        parent_name, _, child_name = name.rpartition(".")
+        parent = root.get_submodule(parent_name) if parent_name else root
+        layer = QuantizedLinear(module.weight, bits=bits, group_size=group_size)
+        if bits == 4 and layer.qweight.device.type == "cpu" and not layer.int4_kernel("cpu", layer.dtype):
+            raise ValueError(f"int4 on CPU needs the fused int4 matmul of PyTorch (>= 2.6) and a layer it supports, not {layer.extra_repr()} in {layer.dtype}: use int8")
+        setattr(parent, child_name, layer)
+    return model
+
+
+def model_size_bytes(model):
+    """Total size of the parameters and buffers of a model, e.g. to report the savings of quantization."""
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
@@ -211,6 +211,11 @@ class RustBPETokenizer:
     def encode_special(self, text):
         return self.enc.encode_single_token(text)
 
+    def get_token_byte_strings(self):
+        # the bytes of every token, None for the special tokens (e.g. for constrained decoding)
+        special_ids = {self.enc.encode_single_token(token) for token in self.enc.special_tokens_set}
+        return [None if i in special_ids else self.enc.decode_single_token_bytes(i) for i in range(self.enc.n_vocab)]
+
     def get_bos_token_id(self):
         return self.bos_token_id
 
@@ -22,6 +22,8 @@ split_tokens = 20*524288  # number of tokens to evaluate per split
 model_tag = None # optional model tag for the output directory name
 model_step = None # optional model step for the output directory name
 device_type = "" # cuda|cpu|mps (empty => autodetect)
+quantize = "" # int8|int4 (empty => off): also evaluate the bpb of the weight-only quantized model, to check its accuracy
+quantize_lm_head = False # whether the quantized model also quantizes the lm_head
 exec(open(os.path.join('nanochat', 'configurator.py')).read()) # overrides from command line or config file
 
 # Load the base model and the tokenizer
@@ -44,6 +46,21 @@ for split_name in ["train", "val"]:
     print0(f"{split_name} bpb: {bpb:.4f}")
     bpb_results[split_name] = bpb
 
+# Evaluate the loss of the quantized model as well, which should only be a little bit worse
+# (note that the samples below then come from the quantized model too)
+quantized_bpb_results = {}
+if quantize:
+    from nanochat.quantize import quantize_model, model_size_bytes
+    size_before = model_size_bytes(model)
+    quantize_model(model, bits={"int8": 8, "int4": 4}[quantize], include_lm_head=quantize_lm_head)
+    print0(f"Quantized the model to {quantize}: {size_before / 1024**2:.2f}MB -> {model_size_bytes(model) / 1024**2:.2f}MB")
+    for split_name in ["train", "val"]:
+        loader = tokenizing_distributed_data_loader(device_batch_size, sequence_len, split_name, device=device)
+        with autocast_ctx:
+            bpb = evaluate_bpb(model, loader, steps, token_bytes)
+        print0(f"{split_name} bpb ({quantize}): {bpb:.4f} (delta: {bpb - bpb_results[split_name]:+.4f})")
+        quantized_bpb_results[f"{split_name} bpb ({quantize})"] = bpb
+
 # Master process also samples from the model
 samples = []
 if ddp_rank == 0:
@@ -57,10 +74,10 @@ if ddp_rank == 0:
         "If 5*x + 3 = 13, then x is",
     ]
     engine = Engine(model, tokenizer)
-    for prompt in prompts:
-        tokens = tokenizer(prompt, prepend="<|bos|>")
-        with autocast_ctx:
-            sample, _ = engine.generate_batch(tokens, num_samples=1, max_tokens=16, temperature=0)
+    tokens = tokenizer(prompts, prepend="<|bos|>")
+    with autocast_ctx:
+        results, _ = engine.generate_many_batch(tokens, num_samples=1, max_tokens=16, temperature=0)
+    for sample in results:
         sample_str = tokenizer.decode(sample[0])
         print0(sample_str)
         samples.append(sample_str)
@@ -71,6 +88,7 @@ get_report().log(section="Base model loss", data=[
     {
         "train bpb": bpb_results["train"],
         "val bpb": bpb_results["val"],
+        **quantized_bpb_results,
     },
     {f"sample {i}": sample for i, sample in enumerate(samples)},
 ])
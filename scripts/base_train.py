@@ -264,11 +264,12 @@ while True:
             "If 5*x + 3 = 13, then x is",
         ]
         engine = Engine(orig_model, tokenizer) # use orig_model to avoid recompilation
-        for prompt in prompts:
-            tokens = tokenizer(prompt, prepend="<|bos|>")
-            with autocast_ctx:
-                sample, _ = engine.generate_batch(tokens, num_samples=1, max_tokens=16, temperature=0)
+        tokens = tokenizer(prompts, prepend="<|bos|>")
+        with autocast_ctx:
+            samples, _ = engine.generate_many_batch(tokens, num_samples=1, max_tokens=16, temperature=0)
+        for sample in samples:
             print0(tokenizer.decode(sample[0]))
+        engine.release()
         model.train()
 
     # save checkpoint: at the end of the run, or every save_every steps, except at the first step or the resume step
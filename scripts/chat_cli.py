@@ -8,7 +8,7 @@ import argparse
 import torch
 from nanochat.common import compute_init, autodetect_device_type
 from contextlib import nullcontext
-from nanochat.engine import Engine
+from nanochat.engine import Engine, Session
 from nanochat.checkpoint_manager import load_model
 
 parser = argparse.ArgumentParser(description='Chat with the model')
@@ -20,6 +20,14 @@ parser.add_argument('-t', '--temperature', type=float, default=0.6, help='Temper
 parser.add_argument('-k', '--top-k', type=int, default=50, help='Top-k sampling parameter')
 parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
 parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
+parser.add_argument('-q', '--quantize', type=str, default=None, choices=['int8', 'int4'], help='Weight-only quantization of the model, e.g. for CPU inference')
+parser.add_argument('--quantize-lm-head', action='store_true', help='Also quantize the lm_head (more savings, less accuracy)')
+parser.add_argument('--compile', action='store_true', help='Compile the decode step (static shapes, CUDA graphs on GPU)')
+parser.add_argument('--kv-window', type=int, default=0, help='Keep only the KV of this many recent tokens of a conversation (plus the sinks), for bounded memory. 0 = keep everything')
+parser.add_argument('--kv-sink-tokens', type=int, default=4, help='With --kv-window, the first tokens of a conversation whose KV is always kept (attention sinks)')
+parser.add_argument('--draft-model-tag', type=str, default=None, help='Model tag of a smaller model (same source) to use as draft for speculative decoding')
+parser.add_argument('--draft-step', type=int, default=None, help='Step of the draft model to load')
+parser.add_argument('--num-draft-tokens', type=int, default=4, help='Number of tokens the draft model proposes per step')
 args = parser.parse_args()
 
 # Init the model and tokenizer
@@ -28,7 +36,10 @@ device_type = autodetect_device_type() if args.device_type == "" else args.devic
 ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
 ptdtype = torch.float32 if args.dtype == 'float32' else torch.bfloat16
 autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
-model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step)
+model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step, quantize=args.quantize, quantize_lm_head=args.quantize_lm_head)
+draft_model = None
+if args.draft_model_tag is not None:
+    draft_model, _, _ = load_model(args.source, device, phase="eval", model_tag=args.draft_model_tag, step=args.draft_step)
 
 # Special tokens for the chat state machine
 bos = tokenizer.get_bos_token_id()
@@ -36,15 +47,18 @@ user_start, user_end = tokenizer.encode_special("<|user_start|>"), tokenizer.enc
 assistant_start, assistant_end = tokenizer.encode_special("<|assistant_start|>"), tokenizer.encode_special("<|assistant_end|>")
 
 # Create Engine for efficient generation
-engine = Engine(model, tokenizer)
+engine = Engine(model, tokenizer, draft_model=draft_model, num_draft_tokens=args.num_draft_tokens, compile_decode=args.compile, kv_window=args.kv_window or None, kv_sink_tokens=args.kv_sink_tokens)
 
 print("\nNanoChat Interactive Mode")
 print("-" * 50)
 print("Type 'quit' or 'exit' to end the conversation")
 print("Type 'clear' to start a new conversation")
+print("Type 'undo' to take back your last message, 'retry' to get another response to it")
 print("-" * 50)
 
-conversation_tokens = [bos]
+# The session keeps the KV cache of the conversation, each turn only prefills the new message
+session = Session(engine, [bos])
+turn_starts = [] # length of the conversation before each of the user messages
 
 while True:
 
@@ -65,22 +79,37 @@ while True:
         break
 
     if user_input.lower() == 'clear':
-        conversation_tokens = [bos]
+        session.truncate(1)
+        turn_starts = []
         print("Conversation cleared.")
         continue
 
+    if user_input.lower() == 'undo' and not turn_starts:
+        print("Nothing to undo.")
+        continue
+
+    if user_input.lower() == 'undo':
+        session.truncate(turn_starts.pop())
+        print("Took back the last message.")
+        continue
+
     if not user_input:
         continue
 
-    # Add User message to the conversation
-    conversation_tokens.append(user_start)
-    conversation_tokens.extend(tokenizer.encode(user_input))
-    conversation_tokens.append(user_end)
+    if user_input.lower() == 'retry' and not turn_starts:
+        print("Nothing to retry.")
+        continue
 
-    # Kick off the assistant
-    conversation_tokens.append(assistant_start)
+    if user_input.lower() == 'retry':
+        # roll back to the start of the last response, the KV of everything before it is kept
+        session.truncate(session.tokens.index(assistant_start, turn_starts[-1]) + 1)
+    else:
+        # Add User message to the conversation
+        turn_starts.append(len(session.tokens))
+        session.extend([user_start, *tokenizer.encode(user_input), user_end])
+        # Kick off the assistant
+        session.extend([assistant_start])
     generate_kwargs = {
-        "num_samples": 1,
         "max_tokens": 256,
         "temperature": args.temperature,
         "top_k": args.top_k,
@@ -88,8 +117,7 @@ while True:
     response_tokens = []
     print("\nAssistant: ", end="", flush=True)
     with autocast_ctx:
-        for token_column, token_masks in engine.generate(conversation_tokens, **generate_kwargs):
-            token = token_column[0] # pop the batch dimension (num_samples=1)
+        for token, mask in session.generate(**generate_kwargs):
             response_tokens.append(token)
             token_text = tokenizer.decode([token])
             print(token_text, end="", flush=True)
@@ -97,8 +125,7 @@ while True:
     # we have to ensure that the assistant end token is the last token
     # so even if generation ends due to max tokens, we have to append it to the end
     if response_tokens[-1] != assistant_end:
-        response_tokens.append(assistant_end)
-    conversation_tokens.extend(response_tokens)
+        session.extend([assistant_end])
 
     # In the prompt mode, we only want a single response and exit
     if args.prompt:
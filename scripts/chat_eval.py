@@ -17,7 +17,7 @@ import torch.distributed as dist
 
 from nanochat.common import compute_init, compute_cleanup, get_dist_info, print0, autodetect_device_type
 from nanochat.checkpoint_manager import load_model
-from nanochat.engine import Engine
+from nanochat.engine import Engine, GenerationStats
 
 from tasks.humaneval import HumanEval
 from tasks.mmlu import MMLU
@@ -28,38 +28,44 @@ from tasks.spellingbee import SpellingBee
 # -----------------------------------------------------------------------------
 # Generative evaluation loop (we go one problem at a time, sample, evaluate)
 
-def run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=None):
+def run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=None, batch_size=1, beam_search=False):
 
     ddp, ddp_rank, ddp_local_rank, ddp_world_size = get_dist_info()
     device = model.get_device()
 
     num_problems = len(task_object) if max_problems is None else min(len(task_object), max_problems)
 
-    # Run the evaluation
+    # Run the evaluation, batch_size problems at a time (their prompts are prefilled and sampled together)
     num_passed, total = 0, 0
-    for i in range(ddp_rank, num_problems, ddp_world_size):
-        conversation = task_object[i]
+    problem_indices = list(range(ddp_rank, num_problems, ddp_world_size))
+    for b in range(0, len(problem_indices), batch_size):
+        conversations = [task_object[i] for i in problem_indices[b:b + batch_size]]
 
-        # Tokenize the prompt
-        encoded_prompt = tokenizer.render_for_completion(conversation)
+        # Tokenize the prompts
+        encoded_prompts = [tokenizer.render_for_completion(conversation) for conversation in conversations]
         # Get the completions
-        results, _ = engine.generate_batch(
-            encoded_prompt,
-            num_samples=num_samples,
-            max_tokens=max_new_tokens,
-            temperature=temperature,
-            top_k=top_k,
-        )
-        # Decode the completions as text
-        prefix_length = len(encoded_prompt)
-        completions = [tokenizer.decode(result_tokens[prefix_length:]) for result_tokens in results]
-        # Evaluate success criteria
-        outcomes = [task_object.evaluate(conversation, completion) for completion in completions]
-        passed = any(outcomes)
-
-        # Keep stats
-        total += 1
-        num_passed += int(passed)
+        if beam_search:
+            # the num_samples best beams of each problem stand in for the samples (one problem at a time)
+            results = [[tokens for tokens, _ in engine.beam_search(encoded_prompt, beam_width=num_samples, max_tokens=max_new_tokens)] for encoded_prompt in encoded_prompts]
+        else:
+            results, _ = engine.generate_many_batch(
+                encoded_prompts,
+                num_samples=num_samples,
+                max_tokens=max_new_tokens,
+                temperature=temperature,
+                top_k=top_k,
+            )
+        for conversation, encoded_prompt, prompt_results in zip(conversations, encoded_prompts, results):
+            # Decode the completions as text
+            prefix_length = len(encoded_prompt)
+            completions = [tokenizer.decode(result_tokens[prefix_length:]) for result_tokens in prompt_results]
+            # Evaluate success criteria
+            outcomes = [task_object.evaluate(conversation, completion) for completion in completions]
+            passed = any(outcomes)
+
+            # Keep stats
+            total += 1
+            num_passed += int(passed)
 
         # Logging (overwrite the same line in the console)
         print(f"\r\033[KRank {ddp_rank} | {num_passed}/{total} ({100*num_passed/total:.2f}%)", end='', flush=True)
@@ -87,11 +93,10 @@ def run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_
 # A lot easier because we don't have to sample. Therefore, we can actually go
 # batches at a time and just check the logits for correct answer choices.
 
-def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems=None):
+def run_categorical_eval(task_object, tokenizer, model, engine, batch_size, max_problems=None):
 
     ddp, ddp_rank, ddp_local_rank, ddp_world_size = get_dist_info()
     device = model.get_device()
-    bos = tokenizer.get_bos_token_id() # use BOS as pad token is ok, these positions are ignored
 
     # We'll process batches of independent problems at a time because there is no sampling needed
     num_problems = len(task_object) if max_problems is None else min(len(task_object), max_problems)
@@ -104,38 +109,39 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
     for i in range(ddp_rank, num_batches, ddp_world_size):
         i0, i1 = i * batch_size, min((i + 1) * batch_size, num_problems)
 
-        # Prepare the batch of problems. They might all be of different length, so we pad/collate them.
+        # Prepare the batch of problems, they might all be of different length (the Engine deals with that)
         conversations = [task_object[ii] for ii in range(i0, i1)]
         prompt_ids = [tokenizer.render_for_completion(conversation) for conversation in conversations] # TODO: remake the way this works
-        max_length = max(len(ids) for ids in prompt_ids)
-        answer_time_positions = [len(ids) - 1 for ids in prompt_ids] # where the last token is (and the predicted answer)
-        padded_prompt_ids = [ids + [bos] * (max_length - len(ids)) for ids in prompt_ids]
-        prompt_ids = torch.tensor(padded_prompt_ids, dtype=torch.long, device=device)
 
-        # Get the logits for the whole batch of conversations in parallel (efficiency win here)
-        with torch.no_grad():
-            logits = model(prompt_ids) # (B, T, V)
+        # get the token ids of all the available letters of each problem
+        letter_ids = []
+        for conversation in conversations:
+            letter_ids.append([])
+            for letter in conversation['letters']:
+                if not letter in letter_to_id_cache:
+                    encoded_letter = tokenizer.encode(letter)
+                    assert len(encoded_letter) == 1, "Each letter must be a single token"
+                    letter_to_id_cache[letter] = encoded_letter[0]
+                letter_ids[-1].append(letter_to_id_cache[letter])
+
+        # Score every letter as the continuation of its prompt, for the whole batch of conversations in parallel
+        # (each prompt is forwarded once for all of its letters, and the lm_head only runs at the answer position)
+        contexts = [ids for ids, letters in zip(prompt_ids, letter_ids) for _ in letters]
+        continuations = [[letter_id] for letters in letter_ids for letter_id in letters]
+        scores = engine.score(contexts, continuations, batch_size=len(contexts))
 
         # Focus on the available answer on just the letters corresponding to choices
         # Note that this helps the evaluation a lot because it specifically narrows the focus to only the available letters
         # The much harder alternative would be to just generate from the Assistant and check if it responded with the correct
         # letter (e.g. A, B, C, D), but evaluations typically make the task easier in this way.
+        offset = 0
         for idx, conversation in enumerate(conversations):
-            # get the token ids of all the available letters of this problem
             letters = conversation['letters']
-            letter_ids = []
-            for letter in letters:
-                if not letter in letter_to_id_cache:
-                    encoded_letter = tokenizer.encode(letter)
-                    assert len(encoded_letter) == 1, "Each letter must be a single token"
-                    letter_to_id_cache[letter] = encoded_letter[0]
-                letter_ids.append(letter_to_id_cache[letter])
-            # focus logits just down to the answer position and the available letters of the answer
-            answer_pos = answer_time_positions[idx]
-            focus_logits = logits[idx, answer_pos, letter_ids]
+            # the logprobs of the available letters of the answer
+            letter_logprobs = [logprob for logprob, _, _ in scores[offset:offset + len(letters)]]
+            offset += len(letters)
             # get the argmax letter (the predicted answer)
-            argmax_letter_id = focus_logits.argmax(dim=-1).item()
-            predicted_letter = letters[argmax_letter_id]
+            predicted_letter = letters[letter_logprobs.index(max(letter_logprobs))]
             # evaluate the outcome
             outcome = task_object.evaluate(conversation, predicted_letter)
             num_passed += int(outcome)
@@ -158,7 +164,7 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
 
 def run_chat_eval(task_name, model, tokenizer, engine,
                    batch_size=1, num_samples=1, max_new_tokens=512, temperature=0.0, top_k=50,
-                   max_problems=None):
+                   max_problems=None, beam_search=False, gen_batch_size=1):
     # Create the evaluation object
     task_module = {
         'HumanEval': HumanEval,
@@ -171,9 +177,9 @@ def run_chat_eval(task_name, model, tokenizer, engine,
     task_object = task_module()
     # Run the evaluation
     if task_object.eval_type == 'generative':
-        acc = run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=max_problems)
+        acc = run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=max_problems, batch_size=gen_batch_size, beam_search=beam_search)
     elif task_object.eval_type == 'categorical':
-        acc = run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems=max_problems)
+        acc = run_categorical_eval(task_object, tokenizer, model, engine, batch_size, max_problems=max_problems)
     else:
         raise ValueError(f"Unsupported task evaluation type: {task_object.eval_type}")
     return acc
@@ -190,10 +196,15 @@ if __name__ == "__main__":
     parser.add_argument('-m', '--max-new-tokens', type=int, default=512)
     parser.add_argument('-n', '--num-samples', type=int, default=1)
     parser.add_argument('-k', '--top-k', type=int, default=50)
-    parser.add_argument('-b', '--batch-size', type=int, default=8, help='Batch size for categorical evaluation')
+    parser.add_argument('-b', '--batch-size', type=int, default=8, help='Batch size (problems at a time) for categorical evaluation')
+    parser.add_argument('--gen-batch-size', type=int, default=1, help='Batch size (problems at a time) for generative evaluation')
     parser.add_argument('-g', '--model-tag', type=str, default=None, help='Model tag to load')
     parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
     parser.add_argument('-x', '--max-problems', type=int, default=None, help='Max problems to evaluate')
+    parser.add_argument('--sync-every', type=int, default=1, help='Decode steps between device->host syncs during generation')
+    parser.add_argument('--prompt-lookup', type=int, default=0, help='Max n-gram size for prompt lookup speculative decoding (0 = off)')
+    parser.add_argument('--beam-search', action='store_true', help='Generative tasks: use the num_samples best beams of a beam search instead of sampling')
+    parser.add_argument('--stats', action='store_true', help='Collect and print the generation stats (prefill/decode timings, batch occupancy, ...) of each task')
     parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
     args = parser.parse_args()
 
@@ -203,7 +214,8 @@ if __name__ == "__main__":
     autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
 
     model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step)
-    engine = Engine(model, tokenizer)
+    engine = Engine(model, tokenizer, prompt_lookup_ngram=args.prompt_lookup, sync_every=args.sync_every)
+    stats = engine.add_hook(GenerationStats()) if args.stats else None
 
     # Get the tasks to evaluate on
     all_tasks = ['ARC-Easy', 'ARC-Challenge', 'MMLU', 'GSM8K', 'HumanEval', 'SpellingBee']
@@ -225,14 +237,19 @@ if __name__ == "__main__":
                 task_name,
                 model, tokenizer, engine,
                 batch_size=args.batch_size,
+                gen_batch_size=args.gen_batch_size,
                 num_samples=args.num_samples,
                 max_new_tokens=args.max_new_tokens,
                 temperature=args.temperature,
                 top_k=args.top_k,
                 max_problems=args.max_problems,
+                beam_search=args.beam_search,
             )
             results[task_name] = acc
             print0(f"{task_name} accuracy: {100 * acc:.2f}%")
+            if stats is not None:
+                print0(f"{task_name} generation stats: " + ", ".join(f"{k}: {v:.4g}" for k, v in stats.summary().items()))
+                stats.reset()
 
     # Log to report
     from nanochat.report import get_report
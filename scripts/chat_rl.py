@@ -25,7 +25,7 @@ import torch.distributed as dist
 
 from nanochat.common import compute_init, compute_cleanup, print0, get_base_dir, DummyWandb
 from nanochat.checkpoint_manager import save_checkpoint, load_model
-from nanochat.engine import Engine
+from nanochat.engine import Engine, ToolRunner, GenerationStats
 from tasks.gsm8k import GSM8K
 
 # RL hyperparameters
@@ -38,6 +38,10 @@ num_samples = 16 # number of samples per example (/question)
 max_new_tokens = 256
 temperature = 1.0
 top_k = 50 # TODO: try None?
+prompt_lookup = 0 # max n-gram size for prompt lookup speculative decoding of the rollouts (0 = off)
+kv_dtype = "" # storage dtype of the KV cache of the rollouts: ""(same as activations)|bfloat16|int8
+sync_every = 16 # decode steps of the rollouts between device->host syncs (the sampled tokens stay on the GPU in between)
+generation_stats = True # log the stats of the rollout generation (prefill/decode timings, batch occupancy, ...), of rank 0
 unembedding_lr = 0.004
 embedding_lr = 0.2
 matrix_lr = 0.02
@@ -65,7 +69,8 @@ wandb_run = DummyWandb() if use_dummy_wandb else wandb.init(project="nanochat-rl
 
 # Init model and tokenizer
 model, tokenizer, meta = load_model(source, device, phase="eval")
-engine = Engine(model, tokenizer) # for sampling rollouts
+engine = Engine(model, tokenizer, prompt_lookup_ngram=prompt_lookup, kv_dtype=kv_dtype or None, sync_every=sync_every, tool_runner=ToolRunner()) # for sampling rollouts (the samples of a prompt often make the same calculator calls)
+stats = engine.add_hook(GenerationStats()) if generation_stats else None
 
 # -----------------------------------------------------------------------------
 # Rollout / sampling generator loop that yields batches of examples for training
@@ -238,6 +243,8 @@ for step in range(num_steps):
             **log_passk,
         })
 
+    if stats is not None:
+        stats.reset() # only count the training rollouts below, not the eval
     # Forward/Backward on rollouts over multiple examples in the dataset
     rewards_list = []
     sequence_lengths = []
@@ -288,6 +295,7 @@ for step in range(num_steps):
         "step": step,
         "reward": mean_reward,
         "sequence_length": mean_sequence_length,
+        **({f"generation/{k}": v for k, v in stats.summary().items()} if stats is not None else {}),
     })
 
     # Update the model parameters
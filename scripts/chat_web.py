@@ -3,7 +3,9 @@
 Unified web chat server - serves both UI and API from a single FastAPI instance.
 
 Uses data parallelism to distribute requests across multiple GPUs. Each GPU loads
-a full copy of the model, and incoming requests are distributed to available workers.
+a full copy of the model, and incoming requests are distributed to the least loaded worker.
+On CPU, the workers can instead be processes that share the weights, each on its own cores.
+Each worker runs continuous batching: all of its in-flight conversations share one decode batch.
 
 Launch examples:
 
@@ -13,13 +15,16 @@ python -m scripts.chat_web
 - 4 GPUs
 python -m scripts.chat_web --num-gpus 4
 
+- CPU, 4 worker processes pinned to their own cores (and NUMA nodes), sharing one copy of the weights
+python -m scripts.chat_web --device-type cpu --cpu-workers 4
+
 To chat, open the URL printed in the console. (If on cloud box, make sure to use public IP)
 
 Endpoints:
   GET  /           - Chat UI
   POST /chat/completions - Chat API (streaming only)
   GET  /health     - Health check with worker pool status
-  GET  /stats      - Worker pool statistics and GPU utilization
+  GET  /stats      - Worker pool statistics and generation stats (latencies, batch occupancy, KV in use)
 
 Abuse Prevention:
   - Maximum 500 messages per request
@@ -35,8 +40,14 @@ import json
 import os
 import torch
 import asyncio
+import itertools
 import logging
+import multiprocessing
+import queue
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
@@ -45,9 +56,11 @@ from pydantic import BaseModel
 from typing import List, Optional, AsyncGenerator
 from dataclasses import dataclass
 from contextlib import nullcontext
-from nanochat.common import compute_init, autodetect_device_type
+from functools import lru_cache
+from nanochat.common import compute_init, autodetect_device_type, cpu_partitions
 from nanochat.checkpoint_manager import load_model
-from nanochat.engine import Engine
+from nanochat.grammar import Grammar, TokenVocab, json_schema_to_regex
+from nanochat.engine import Engine, Scheduler, ToolRunner, GenerationStats, CancelToken
 
 # Abuse prevention limits
 MAX_MESSAGES_PER_REQUEST = 500
@@ -59,20 +72,39 @@ MIN_TOP_K = 1
 MAX_TOP_K = 200
 MIN_MAX_TOKENS = 1
 MAX_MAX_TOKENS = 4096
+MAX_PENALTY = 2.0 # repetition penalty in [1/MAX_PENALTY, MAX_PENALTY], frequency/presence penalties in [-MAX_PENALTY, MAX_PENALTY]
+MAX_CONSTRAINT_COMPILE_TIME = 5.0 # seconds to compile a regex/json_schema output constraint before rejecting it
+MAX_STREAM_LAG = 64 # tokens a client can fall behind before its request is paused (backpressure), resumed at half of that
 
 parser = argparse.ArgumentParser(description='NanoChat Web Server')
 parser.add_argument('-n', '--num-gpus', type=int, default=1, help='Number of GPUs to use (default: 1)')
+parser.add_argument('--cpu-workers', type=int, default=0, help='With --device-type cpu: number of worker processes, each pinned to its own share of the cores, all sharing the weights loaded once (0 = a single worker thread)')
 parser.add_argument('-i', '--source', type=str, default="sft", help="Source of the model: sft|mid|rl")
 parser.add_argument('-t', '--temperature', type=float, default=0.8, help='Default temperature for generation')
 parser.add_argument('-k', '--top-k', type=int, default=50, help='Default top-k sampling parameter')
 parser.add_argument('-m', '--max-tokens', type=int, default=512, help='Default max tokens for generation')
+parser.add_argument('-b', '--max-batch-size', type=int, default=32, help='Max number of conversations decoded together on a worker')
+parser.add_argument('--prefill-chunk-size', type=int, default=512, help='Prefill prompts this many tokens at a time, interleaved with decoding (0 = whole prompt at once)')
+parser.add_argument('--kv-dtype', type=str, default=None, choices=['bfloat16', 'int8'], help='Storage dtype of the KV cache (default: same as the activations)')
+parser.add_argument('--prefix-cache-mb', type=int, default=512, help='KV memory budget (MB) per worker for reusing the prefill of earlier turns, 0 = off')
 parser.add_argument('-g', '--model-tag', type=str, default=None, help='Model tag to load')
 parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
 parser.add_argument('-p', '--port', type=int, default=8000, help='Port to run the server on')
 parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
+parser.add_argument('-q', '--quantize', type=str, default=None, choices=['int8', 'int4'], help='Weight-only quantization of the model, e.g. for CPU inference')
+parser.add_argument('--quantize-lm-head', action='store_true', help='Also quantize the lm_head (more savings, less accuracy)')
+parser.add_argument('--compile', action='store_true', help='Compile the decode step (static shapes, CUDA graphs on GPU), best with --kv-pool-blocks')
+parser.add_argument('--kv-pool-blocks', type=int, default=0, help='Preallocate the KV cache of each worker with this many blocks (of 16 tokens), it never grows then (0 = start small and grow on demand)')
+parser.add_argument('--kv-window', type=int, default=0, help='Keep only the KV of this many recent tokens of a conversation (plus the sinks), for bounded memory. 0 = keep everything')
+parser.add_argument('--kv-sink-tokens', type=int, default=4, help='With --kv-window, the first tokens of a conversation whose KV is always kept (attention sinks)')
+parser.add_argument('--unsafe-python-tool', action='store_true', help='UNSAFE: run the python blocks the calculator rejects as real Python on this machine, for anyone who can reach the server. The sandbox of nanochat.execution only limits time and memory, it is no isolation')
+parser.add_argument('--request-timeout', type=float, default=0, help='Seconds after which a generation is cut short and its slot freed, 0 = no deadline')
+parser.add_argument('--no-stats', action='store_true', help='Do not collect the generation stats (prefill/decode timings, batch occupancy, ...) served at /stats')
 parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
 parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to bind the server to')
 args = parser.parse_args()
+if args.unsafe_python_tool and args.cpu_workers > 0:
+    parser.error("--unsafe-python-tool runs the code in child processes, which the (daemonic) --cpu-workers processes can't start")
 
 # Configure logging for conversation traffic
 logging.basicConfig(
@@ -86,33 +118,145 @@ device_type = autodetect_device_type() if args.device_type == "" else args.devic
 ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
 ptdtype = torch.float32 if args.dtype == 'float32' else torch.bfloat16
 
+class Stream:
+    """The tokens of a request, on their way from the decode loop of a worker to the event loop."""
+
+    def __init__(self, stream_id, deadline=None):
+        self.stream_id = stream_id
+        self.queue = asyncio.Queue() # generated tokens, None marks the end
+        self.deadline = deadline # time.monotonic() after which the request is cut short, None = never
+        self.num_sent = 0 # tokens put in the queue
+        self.num_received = 0 # tokens taken out of the queue by the consumer
+        self.throttled = False # the request is paused until the consumer catches up
+
+    def lag(self):
+        return self.num_sent - self.num_received
+
 @dataclass
 class Worker:
-    """A worker with a model loaded on a specific GPU."""
-    gpu_id: int
-    device: torch.device
-    engine: Engine
-    tokenizer: object
-    autocast_ctx: torch.amp.autocast
+    """A model replica with its decode loop, on a thread (one per GPU) or a process of its own (--cpu-workers)."""
+    worker_id: int
+    device: str # e.g. cuda:1, or cpu[0, 1, 2, 3] for a process pinned to these cpus
+    inbox: object # queue.Queue (thread) or multiprocessing Queue (process) of the messages to the decode loop
+    streams: dict # stream_id -> Stream of the requests in flight, only touched on the event loop
+    status: Optional[dict] = None # latest status sent by the decode loop, for /stats
+    alive: bool = True # False once its process died, it gets no more requests
+
+def make_engine(model, tokenizer):
+    return Engine(model, tokenizer, prefix_cache_bytes=args.prefix_cache_mb * 1024 * 1024, prefill_chunk_size=args.prefill_chunk_size or None, kv_dtype=args.kv_dtype, compile_decode=args.compile, tool_runner=ToolRunner(python=args.unsafe_python_tool), kv_window=args.kv_window or None, kv_sink_tokens=args.kv_sink_tokens, kv_pool_blocks=args.kv_pool_blocks or None)
+
+def decode_loop(engine, inbox, send, autocast_ctx):
+    """
+    Decode loop of a worker: runs a Scheduler and talks to the event loop through messages only, so that it
+    can run on a thread or in a process of its own. The inbox brings ("add", stream_id, tokens, sampling),
+    ("cancel", stream_id), ("pause", stream_id) and ("resume", stream_id). Out go ("tokens", [(stream_id, token)])
+    with all the tokens of a step, a None token marking the end of a stream, and every second ("status", dict).
+    """
+    device = engine.model.get_device()
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+    stats = None if args.no_stats else engine.add_hook(GenerationStats())
+    scheduler = Scheduler(engine, max_batch_size=args.max_batch_size)
+    requests = {} # stream_id -> Request
+    stream_ids = {} # request_id -> stream_id
+    last_status = 0.0
+    while True:
+        # Take in the messages, waiting for one if there is nothing to step (but wake up once in a while,
+        # for the status and the deadlines of the paused requests)
+        messages = []
+        try:
+            messages.append(inbox.get(block=not scheduler.can_step(), timeout=1.0))
+            while True:
+                messages.append(inbox.get_nowait())
+        except queue.Empty:
+            pass
+        for kind, stream_id, *payload in messages:
+            if kind == "add":
+                tokens, sampling = payload
+                sampling = dict(sampling)
+                deadline = sampling.pop("deadline", None)
+                grammar = sampling.pop("grammar", None) # compiled by the server (see compile_grammar), not on this loop
+                if grammar is not None:
+                    grammar = engine.add_grammar(grammar) # (cached per worker, with its token masks)
+                request = scheduler.add_request(tokens, grammar=grammar, cancel=CancelToken(deadline), **sampling)
+                requests[stream_id] = request
+                stream_ids[request.request_id] = stream_id
+            elif stream_id in requests:
+                request = requests[stream_id]
+                if kind == "cancel":
+                    request.cancel.cancel() # the request leaves the batch at the next step (a no-op if it completed)
+                else:
+                    # backpressure: a request whose client fell behind sits out the steps (it keeps its KV)
+                    request.paused = kind == "pause"
+
+        now = time.monotonic()
+        if now - last_status >= 1.0:
+            last_status = now
+            send(("status", {
+                "running_requests": len(scheduler.running),
+                "waiting_requests": len(scheduler.waiting),
+                "paused_requests": sum(r.paused for r in scheduler.running), # clients that fell behind
+                "prefilling_requests": len(scheduler.prefilling),
+                "prefix_cache_mb": engine.prefix_cache.num_bytes() / 1024**2 if engine.prefix_cache else 0,
+                "generation": stats.summary() if stats else None,
+            }))
+        if not scheduler.can_step():
+            continue
+
+        try:
+            with autocast_ctx:
+                emitted = scheduler.step()
+        except Exception:
+            logger.exception(f"Generation failed on {device}, dropping all of its requests")
+            send(("tokens", [(stream_id, None) for stream_id in requests]))
+            requests.clear()
+            stream_ids.clear()
+            engine.release() # the blocks of the dropped requests are lost, start from a fresh pool
+            scheduler = Scheduler(engine, max_batch_size=args.max_batch_size)
+            continue
+        items = []
+        for request, token, mask in emitted:
+            stream_id = stream_ids[request.request_id]
+            if token is not None: # (None: the request was cancelled)
+                items.append((stream_id, token))
+            if request.completed:
+                items.append((stream_id, None))
+                del requests[stream_id], stream_ids[request.request_id]
+        if items:
+            send(("tokens", items))
+
+def run_cpu_worker(model, tokenizer, cpus, num_threads, inbox, outbox):
+    """Entry point of a CPU worker process (forked): pin it to its own cpus, then run the decode loop."""
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads) # one thread per physical core, its memory allocations stay on its NUMA node
+    decode_loop(make_engine(model, tokenizer), inbox, outbox.put, nullcontext())
 
 class WorkerPool:
-    """Pool of workers, each with a model replica on a different GPU."""
+    """Pool of workers, each with a model replica on a different GPU, or a share of the CPU cores."""
 
-    def __init__(self, num_gpus: Optional[int] = None):
+    def __init__(self, num_gpus: Optional[int] = None, num_cpu_workers: int = 0):
         if num_gpus is None:
             if device_type == "cuda":
                 num_gpus = torch.cuda.device_count()
             else:
                 num_gpus = 1 # e.g. cpu|mps
         self.num_gpus = num_gpus
+        self.num_cpu_workers = num_cpu_workers # > 0: CPU worker processes instead of one worker per GPU
         self.workers: List[Worker] = []
-        self.available_workers: asyncio.Queue = asyncio.Queue()
+        self.tokenizer = None
+        self.token_vocab = None # byte-trie of the vocab, for compiling the output constraints
+        self.stream_ids = itertools.count()
+        self.loop = None # the event loop that the streams live on
 
     async def initialize(self, source: str, model_tag: Optional[str] = None, step: Optional[int] = None):
-        """Load model on each GPU."""
+        """Load the model on each GPU, or once for all the CPU worker processes."""
+        self.loop = asyncio.get_running_loop()
+        if self.num_cpu_workers > 0:
+            self.start_cpu_workers(source, model_tag, step)
+            return
         print(f"Initializing worker pool with {self.num_gpus} GPUs...")
         if self.num_gpus > 1:
-            assert device_type == "cuda", "Only CUDA supports multiple workers/GPUs. cpu|mps does not."
+            assert device_type == "cuda", "Only CUDA supports multiple workers/GPUs. cpu|mps does not, see --cpu-workers."
 
         for gpu_id in range(self.num_gpus):
 
@@ -123,29 +267,108 @@ class WorkerPool:
                 device = torch.device(device_type) # e.g. cpu|mps
                 print(f"Loading model on {device_type}...")
 
-            model, tokenizer, _ = load_model(source, device, phase="eval", model_tag=model_tag, step=step)
-            engine = Engine(model, tokenizer)
+            model, self.tokenizer, _ = load_model(source, device, phase="eval", model_tag=model_tag, step=step, quantize=args.quantize, quantize_lm_head=args.quantize_lm_head)
             autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
-
-            worker = Worker(
-                gpu_id=gpu_id,
-                device=device,
-                engine=engine,
-                tokenizer=tokenizer,
-                autocast_ctx=autocast_ctx
-            )
+            worker = Worker(worker_id=gpu_id, device=str(device), inbox=queue.Queue(), streams={})
             self.workers.append(worker)
-            await self.available_workers.put(worker)
+            # the forward passes run on a thread of their own (torch releases the GIL), the event loop stays responsive
+            send = lambda message, worker=worker: self.loop.call_soon_threadsafe(self.receive, worker, message)
+            thread = threading.Thread(target=decode_loop, args=(make_engine(model, self.tokenizer), worker.inbox, send, autocast_ctx), name=f"decode-{gpu_id}", daemon=True)
+            thread.start()
 
+        self.token_vocab = TokenVocab.from_tokenizer(self.tokenizer)
         print(f"All {self.num_gpus} workers initialized!")
 
-    async def acquire_worker(self) -> Worker:
-        """Get an available worker from the pool."""
-        return await self.available_workers.get()
-
-    async def release_worker(self, worker: Worker):
-        """Return a worker to the pool."""
-        await self.available_workers.put(worker)
+    def start_cpu_workers(self, source, model_tag, step):
+        """
+        Load the model once, then fork a decode process per share of the cores. The weights are only ever read,
+        so the children keep mapping the pages of the parent (copy-on-write) instead of loading copies of them.
+        """
+        assert device_type == "cpu", "--cpu-workers is for CPU inference"
+        partitions = cpu_partitions(self.num_cpu_workers)
+        print(f"Initializing worker pool with {self.num_cpu_workers} CPU worker processes...")
+        # OpenMP is not fork-safe: the parent must not start its thread pool before forking (the loading doesn't need it)
+        torch.set_num_threads(1)
+        model, self.tokenizer, _ = load_model(source, torch.device("cpu"), phase="eval", model_tag=model_tag, step=step, quantize=args.quantize, quantize_lm_head=args.quantize_lm_head)
+        model.requires_grad_(False)
+        context = multiprocessing.get_context("fork")
+        outboxes, processes = [], []
+        for worker_id, (cpus, num_threads) in enumerate(partitions):
+            inbox, outbox = context.Queue(), context.Queue()
+            process = context.Process(target=run_cpu_worker, args=(model, self.tokenizer, cpus, num_threads, inbox, outbox), name=f"decode-{worker_id}", daemon=True)
+            process.start()
+            print(f"Worker {worker_id}: pid {process.pid}, cpus {cpus}, {num_threads} threads")
+            self.workers.append(Worker(worker_id=worker_id, device=f"cpu{cpus}", inbox=inbox, streams={}))
+            outboxes.append(outbox)
+            processes.append(process)
+        # (only now start threads in the parent, none of them should be running while forking)
+        for worker, outbox, process in zip(self.workers, outboxes, processes):
+            thread = threading.Thread(target=self.forward_outbox, args=(worker, outbox), name=f"outbox-{worker.worker_id}", daemon=True)
+            thread.start()
+            thread = threading.Thread(target=self.watch_process, args=(worker, process), name=f"watch-{worker.worker_id}", daemon=True)
+            thread.start()
+        self.token_vocab = TokenVocab.from_tokenizer(self.tokenizer)
+        print(f"All {self.num_cpu_workers} workers initialized!")
+
+    def forward_outbox(self, worker: Worker, outbox):
+        """Hand the messages of a worker process over to the event loop, on a thread of the parent."""
+        while True:
+            self.loop.call_soon_threadsafe(self.receive, worker, outbox.get())
+
+    def watch_process(self, worker: Worker, process):
+        """Wait for a worker process to exit (it never does on its own, e.g. it got killed for memory), on a thread of the parent."""
+        process.join()
+        self.loop.call_soon_threadsafe(self.worker_died, worker, process.exitcode)
+
+    def worker_died(self, worker: Worker, exitcode):
+        """End the streams of a dead worker, on the event loop, and stop sending it requests."""
+        logger.error(f"Worker {worker.worker_id} ({worker.device}) died with exit code {exitcode}, ending its {len(worker.streams)} streams")
+        worker.alive = False
+        for stream in worker.streams.values():
+            stream.queue.put_nowait(None)
+        worker.streams.clear()
+
+    def receive(self, worker: Worker, message):
+        """Take a message of a decode loop in, on the event loop: the tokens of a step go to their streams."""
+        kind, payload = message
+        if kind == "status":
+            worker.status = payload
+            return
+        for stream_id, token in payload:
+            stream = worker.streams.get(stream_id)
+            if stream is None:
+                continue # (the consumer went away)
+            stream.queue.put_nowait(token)
+            if token is None:
+                del worker.streams[stream_id]
+                continue
+            stream.num_sent += 1
+            if not stream.throttled and stream.lag() >= MAX_STREAM_LAG:
+                stream.throttled = True # resumed by generate_stream once the client caught up
+                worker.inbox.put(("pause", stream_id))
+
+    def submit(self, worker: Worker, tokens, **sampling) -> Stream:
+        """Hand a request over to the decode loop of a worker, its tokens come back through the returned Stream."""
+        # (the monotonic clock is system-wide, the deadline holds in the worker processes too)
+        stream = Stream(next(self.stream_ids), deadline=time.monotonic() + args.request_timeout if args.request_timeout > 0 else None)
+        worker.streams[stream.stream_id] = stream
+        worker.inbox.put(("add", stream.stream_id, tokens, dict(sampling, deadline=stream.deadline)))
+        return stream
+
+    def release(self, worker: Worker, stream: Stream):
+        """The consumer of a stream is done with it, e.g. the client went away: free the slot of its request."""
+        if worker.streams.pop(stream.stream_id, None) is not None:
+            worker.inbox.put(("cancel", stream.stream_id))
+
+    def acquire_worker(self) -> Worker:
+        """Get the least loaded worker of the pool."""
+        workers = [w for w in self.workers if w.alive]
+        if not workers:
+            raise HTTPException(status_code=503, detail="No worker left to serve the request")
+        return min(workers, key=lambda w: len(w.streams))
+
+    def num_active_requests(self) -> int:
+        return sum(len(w.streams) for w in self.workers)
 
 class ChatMessage(BaseModel):
     role: str
@@ -156,6 +379,13 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = None
     max_tokens: Optional[int] = None
     top_k: Optional[int] = None
+    top_p: Optional[float] = None
+    min_p: Optional[float] = None
+    repetition_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
+    presence_penalty: Optional[float] = None
+    regex: Optional[str] = None # constrain the response to match this regex...
+    json_schema: Optional[dict] = None # ...or to be a JSON document of this schema
 
 def validate_chat_request(request: ChatRequest):
     """Validate chat request to prevent abuse."""
@@ -212,6 +442,24 @@ def validate_chat_request(request: ChatRequest):
                 detail=f"top_k must be between {MIN_TOP_K} and {MAX_TOP_K}"
             )
 
+    # Validate top_p and min_p
+    if request.top_p is not None and not (0.0 < request.top_p <= 1.0):
+        raise HTTPException(status_code=400, detail="top_p must be in (0, 1]")
+    if request.min_p is not None and not (0.0 <= request.min_p <= 1.0):
+        raise HTTPException(status_code=400, detail="min_p must be in [0, 1]")
+
+    # Validate the penalties
+    if request.repetition_penalty is not None and not (1.0 / MAX_PENALTY <= request.repetition_penalty <= MAX_PENALTY):
+        raise HTTPException(status_code=400, detail=f"repetition_penalty must be between {1.0 / MAX_PENALTY} and {MAX_PENALTY}")
+    for name in ["frequency_penalty", "presence_penalty"]:
+        value = getattr(request, name)
+        if value is not None and not (-MAX_PENALTY <= value <= MAX_PENALTY):
+            raise HTTPException(status_code=400, detail=f"{name} must be between {-MAX_PENALTY} and {MAX_PENALTY}")
+
+    # Validate the output constraints
+    if request.regex is not None and request.json_schema is not None:
+        raise HTTPException(status_code=400, detail="Use either regex or json_schema, not both")
+
     # Validate max_tokens
     if request.max_tokens is not None:
         if not (MIN_MAX_TOKENS <= request.max_tokens <= MAX_MAX_TOKENS):
@@ -220,11 +468,20 @@ def validate_chat_request(request: ChatRequest):
                 detail=f"max_tokens must be between {MIN_MAX_TOKENS} and {MAX_MAX_TOKENS}"
             )
 
+# the output constraints compile here, once, then the workers get the compiled grammar (a thread can't be
+# interrupted: a compile past MAX_CONSTRAINT_COMPILE_TIME runs to its end, bounded by the limits of nanochat.grammar)
+grammar_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="grammar")
+
+@lru_cache(maxsize=64)
+def compile_grammar(pattern):
+    """Compile the regex of an output constraint with the allowed tokens of all its states, a ValueError if not supported."""
+    return Grammar(pattern, app.state.worker_pool.token_vocab).precompute()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Load models on all GPUs on startup."""
     print("Loading nanochat models across GPUs...")
-    app.state.worker_pool = WorkerPool(num_gpus=args.num_gpus)
+    app.state.worker_pool = WorkerPool(num_gpus=args.num_gpus, num_cpu_workers=args.cpu_workers)
     await app.state.worker_pool.initialize(args.source, model_tag=args.model_tag, step=args.step)
     print(f"Server ready at http://localhost:{args.port}")
     yield
@@ -264,51 +521,65 @@ async def generate_stream(
     tokens,
     temperature=None,
     max_new_tokens=None,
-    top_k=None
+    top_k=None,
+    **sampling
 ) -> AsyncGenerator[str, None]:
     """Generate assistant response with streaming."""
     temperature = temperature if temperature is not None else args.temperature
     max_new_tokens = max_new_tokens if max_new_tokens is not None else args.max_tokens
     top_k = top_k if top_k is not None else args.top_k
 
-    assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
-    bos = worker.tokenizer.get_bos_token_id()
+    tokenizer = app.state.worker_pool.tokenizer
+    assistant_end = tokenizer.encode_special("<|assistant_end|>")
+    bos = tokenizer.get_bos_token_id()
 
     # Accumulate tokens to properly handle multi-byte UTF-8 characters (like emojis)
     accumulated_tokens = []
     # Track the last complete UTF-8 string (without replacement characters)
     last_clean_text = ""
 
-    with worker.autocast_ctx:
-        for token_column, token_masks in worker.engine.generate(
-            tokens,
-            num_samples=1,
-            max_tokens=max_new_tokens,
-            temperature=temperature,
-            top_k=top_k,
-            seed=random.randint(0, 2**31 - 1)
-        ):
-            token = token_column[0]
+    # Hand the request over to the worker's decode loop, the tokens come back through a stream
+    stream = app.state.worker_pool.submit(
+        worker,
+        tokens,
+        max_tokens=max_new_tokens,
+        temperature=temperature,
+        top_k=top_k,
+        seed=random.randint(0, 2**31 - 1),
+        **sampling # top_p, min_p, the penalties and grammar, None = off
+    )
+
+    try:
+        while True:
+            token = await stream.queue.get()
 
             # Stopping criteria
-            if token == assistant_end or token == bos:
+            if token is None or token == assistant_end or token == bos:
                 break
+            stream.num_received += 1
+            if stream.throttled and stream.lag() < MAX_STREAM_LAG // 2:
+                stream.throttled = False # caught up, the decode loop can resume the request
+                worker.inbox.put(("resume", stream.stream_id))
 
             # Append the token to sequence
             accumulated_tokens.append(token)
             # Decode all accumulated tokens to get proper UTF-8 handling
             # Note that decode is a quite efficient operation, basically table lookup and string concat
-            current_text = worker.tokenizer.decode(accumulated_tokens)
+            current_text = tokenizer.decode(accumulated_tokens)
             # Only emit text if it doesn't end with a replacement character
             # This ensures we don't emit incomplete UTF-8 sequences
             if not current_text.endswith('�'):
                 # Extract only the new text since last clean decode
                 new_text = current_text[len(last_clean_text):]
                 if new_text:  # Only yield if there's new content
-                    yield f"data: {json.dumps({'token': new_text, 'gpu': worker.gpu_id}, ensure_ascii=False)}\n\n"
+                    yield f"data: {json.dumps({'token': new_text, 'gpu': worker.worker_id}, ensure_ascii=False)}\n\n"
                     last_clean_text = current_text
+    finally:
+        # e.g. the client went away: the request leaves the batch at the next step (a no-op if it completed)
+        app.state.worker_pool.release(worker, stream)
 
-    yield f"data: {json.dumps({'done': True})}\n\n"
+    timed_out = stream.deadline is not None and time.monotonic() >= stream.deadline and token is None
+    yield f"data: {json.dumps({'done': True, 'timed_out': True} if timed_out else {'done': True})}\n\n"
 
 @app.post("/chat/completions")
 async def chat_completions(request: ChatRequest):
@@ -323,63 +594,76 @@ async def chat_completions(request: ChatRequest):
         logger.info(f"[{message.role.upper()}]: {message.content}")
     logger.info("-"*20)
 
-    # Acquire a worker from the pool (will wait if all are busy)
+    # Pick the least loaded worker from the pool (its scheduler batches us with its other requests)
     worker_pool = app.state.worker_pool
-    worker = await worker_pool.acquire_worker()
-
-    try:
-        # Build conversation tokens
-        bos = worker.tokenizer.get_bos_token_id()
-        user_start = worker.tokenizer.encode_special("<|user_start|>")
-        user_end = worker.tokenizer.encode_special("<|user_end|>")
-        assistant_start = worker.tokenizer.encode_special("<|assistant_start|>")
-        assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
-
-        conversation_tokens = [bos]
-        for message in request.messages:
-            if message.role == "user":
-                conversation_tokens.append(user_start)
-                conversation_tokens.extend(worker.tokenizer.encode(message.content))
-                conversation_tokens.append(user_end)
-            elif message.role == "assistant":
-                conversation_tokens.append(assistant_start)
-                conversation_tokens.extend(worker.tokenizer.encode(message.content))
-                conversation_tokens.append(assistant_end)
-
-        conversation_tokens.append(assistant_start)
-
-        # Streaming response with worker release after completion
-        response_tokens = []
-        async def stream_and_release():
-            try:
-                async for chunk in generate_stream(
-                    worker,
-                    conversation_tokens,
-                    temperature=request.temperature,
-                    max_new_tokens=request.max_tokens,
-                    top_k=request.top_k
-                ):
-                    # Accumulate response for logging
-                    chunk_data = json.loads(chunk.replace("data: ", "").strip())
-                    if "token" in chunk_data:
-                        response_tokens.append(chunk_data["token"])
-                    yield chunk
-            finally:
-                # Log the assistant response to console
-                full_response = "".join(response_tokens)
-                logger.info(f"[ASSISTANT] (GPU {worker.gpu_id}): {full_response}")
-                logger.info("="*20)
-                # Release worker back to pool after streaming is done
-                await worker_pool.release_worker(worker)
-
-        return StreamingResponse(
-            stream_and_release(),
-            media_type="text/event-stream"
-        )
-    except Exception as e:
-        # Make sure to release worker even on error
-        await worker_pool.release_worker(worker)
-        raise e
+    worker = worker_pool.acquire_worker()
+
+    # Build conversation tokens
+    tokenizer = worker_pool.tokenizer
+    bos = tokenizer.get_bos_token_id()
+    user_start = tokenizer.encode_special("<|user_start|>")
+    user_end = tokenizer.encode_special("<|user_end|>")
+    assistant_start = tokenizer.encode_special("<|assistant_start|>")
+    assistant_end = tokenizer.encode_special("<|assistant_end|>")
+
+    conversation_tokens = [bos]
+    for message in request.messages:
+        if message.role == "user":
+            conversation_tokens.append(user_start)
+            conversation_tokens.extend(tokenizer.encode(message.content))
+            conversation_tokens.append(user_end)
+        elif message.role == "assistant":
+            conversation_tokens.append(assistant_start)
+            conversation_tokens.extend(tokenizer.encode(message.content))
+            conversation_tokens.append(assistant_end)
+
+    conversation_tokens.append(assistant_start)
+
+    # Compile the output constraints, if any: off the event loop, and off the decode loops that the worker would stall
+    regex = request.regex
+    grammar = None
+    if request.json_schema is not None or regex is not None:
+        try:
+            regex = json_schema_to_regex(request.json_schema) if request.json_schema is not None else regex
+            compiling = asyncio.get_running_loop().run_in_executor(grammar_executor, compile_grammar, regex)
+            grammar = await asyncio.wait_for(compiling, timeout=MAX_CONSTRAINT_COMPILE_TIME)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid output constraint: {e}")
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=400, detail="Invalid output constraint: too costly to compile")
+
+    # Streaming response with logging after completion
+    response_tokens = []
+    async def stream_and_log():
+        try:
+            async for chunk in generate_stream(
+                worker,
+                conversation_tokens,
+                temperature=request.temperature,
+                max_new_tokens=request.max_tokens,
+                top_k=request.top_k,
+                top_p=request.top_p,
+                min_p=request.min_p,
+                repetition_penalty=request.repetition_penalty,
+                frequency_penalty=request.frequency_penalty,
+                presence_penalty=request.presence_penalty,
+                grammar=grammar,
+            ):
+                # Accumulate response for logging
+                chunk_data = json.loads(chunk.replace("data: ", "").strip())
+                if "token" in chunk_data:
+                    response_tokens.append(chunk_data["token"])
+                yield chunk
+        finally:
+            # Log the assistant response to console
+            full_response = "".join(response_tokens)
+            logger.info(f"[ASSISTANT] (worker {worker.worker_id}): {full_response}")
+            logger.info("="*20)
+
+    return StreamingResponse(
+        stream_and_log(),
+        media_type="text/event-stream"
+    )
 
 @app.get("/health")
 async def health():
@@ -387,9 +671,9 @@ async def health():
     worker_pool = getattr(app.state, 'worker_pool', None)
     return {
         "status": "ok",
-        "ready": worker_pool is not None and len(worker_pool.workers) > 0,
+        "ready": worker_pool is not None and any(w.alive for w in worker_pool.workers),
         "num_gpus": worker_pool.num_gpus if worker_pool else 0,
-        "available_workers": worker_pool.available_workers.qsize() if worker_pool else 0
+        "active_requests": worker_pool.num_active_requests() if worker_pool else 0
     }
 
 @app.get("/stats")
@@ -398,12 +682,14 @@ async def stats():
     worker_pool = app.state.worker_pool
     return {
         "total_workers": len(worker_pool.workers),
-        "available_workers": worker_pool.available_workers.qsize(),
-        "busy_workers": len(worker_pool.workers) - worker_pool.available_workers.qsize(),
+        "active_requests": worker_pool.num_active_requests(),
         "workers": [
             {
-                "gpu_id": w.gpu_id,
-                "device": str(w.device)
+                "worker_id": w.worker_id,
+                "device": w.device,
+                "alive": w.alive,
+                "active_requests": len(w.streams),
+                **(w.status or {}), # running/waiting/paused/prefilling requests, prefix cache, generation stats
             } for w in worker_pool.workers
         ]
     }
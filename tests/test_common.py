@@ -0,0 +1,39 @@
+"""
+Test the common utilities. Example run:
+
+python -m pytest tests/test_common.py -v
+"""
+
+from nanochat.common import _read_cpu_list, cpu_partitions
+
+def fake_topology(monkeypatch):
+    """16 cpus: 8 physical cores with 2 hyperthreads each (cpu n and n + 8), over 2 NUMA nodes of 4 cores."""
+    files = {"/sys/devices/system/node/node0/cpulist": "0-3,8-11", "/sys/devices/system/node/node1/cpulist": "4-7,12-15"}
+    for cpu in range(16):
+        files[f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"] = f"{cpu % 8},{cpu % 8 + 8}"
+    def read_cpu_list(path):
+        if path not in files:
+            raise FileNotFoundError(path)
+        ranges = [part.partition("-") for part in files[path].split(",")]
+        return [cpu for first, _, last in ranges for cpu in range(int(first), int(last or first) + 1)]
+    monkeypatch.setattr("nanochat.common._read_cpu_list", read_cpu_list)
+    monkeypatch.setattr("nanochat.common.glob.glob", lambda pattern: [path for path in files if path.endswith("/cpulist")])
+    monkeypatch.setattr("nanochat.common.os.sched_getaffinity", lambda pid: set(range(16)))
+
+def test_read_cpu_list(tmp_path):
+    path = tmp_path / "cpulist"
+    path.write_text("0-3,8-11\n")
+    assert _read_cpu_list(path) == [0, 1, 2, 3, 8, 9, 10, 11]
+    path.write_text("5\n")
+    assert _read_cpu_list(path) == [5]
+
+def test_cpu_partitions(monkeypatch):
+    """The workers split evenly over the NUMA nodes, and the hyperthreads of a core go to the same worker."""
+    fake_topology(monkeypatch)
+    assert cpu_partitions(4) == [([0, 8, 1, 9], 2), ([2, 10, 3, 11], 2), ([4, 12, 5, 13], 2), ([6, 14, 7, 15], 2)]
+    assert cpu_partitions(2) == [([0, 8, 1, 9, 2, 10, 3, 11], 4), ([4, 12, 5, 13, 6, 14, 7, 15], 4)]
+    # 3 workers can't be spread evenly over 2 nodes: the nodes are ignored, the cores are still kept whole
+    assert cpu_partitions(3) == [([0, 8, 1, 9], 2), ([2, 10, 3, 11, 4, 12], 3), ([5, 13, 6, 14, 7, 15], 3)]
+    # only the cpus this process may run on are handed out
+    monkeypatch.setattr("nanochat.common.os.sched_getaffinity", lambda pid: {0, 1, 2, 3, 4, 5, 6, 7})
+    assert cpu_partitions(2) == [([0, 1, 2, 3], 4), ([4, 5, 6, 7], 4)]
@@ -4,8 +4,59 @@ Test Engine class. Example run:
 python -m pytest tests/test_engine.py -v
 """
 
+import threading
+import warnings
+import concurrent.futures
+import pytest
 import torch
-from nanochat.engine import KVCache
+from concurrent.futures import Future
+from nanochat.engine import KVCache, KVBlockPool, BlockTable, PagedKVCache, PrefixCache, Engine, Scheduler, Session, CancelToken, RowState, ToolRunner, GenerationStats, prompt_lookup, process_logits, sample_rows
+from nanochat.gpt import GPT, GPTConfig
+from nanochat.tokenizer import SPECIAL_TOKENS
+
+class MockTokenizer:
+    """Byte-level tokenizer with the special tokens appended at the end, enough to drive the Engine."""
+
+    def __init__(self):
+        self.special = {name: 256 + i for i, name in enumerate(SPECIAL_TOKENS)}
+
+    def get_vocab_size(self):
+        return 256 + len(self.special)
+
+    def encode_special(self, text):
+        return self.special[text]
+
+    def get_bos_token_id(self):
+        return self.special["<|bos|>"]
+
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode(self, ids):
+        return bytes(i for i in ids if i < 256).decode("utf-8", errors="replace")
+
+    def get_token_byte_strings(self):
+        return [bytes([i]) for i in range(256)] + [None] * len(self.special)
+
+def build_model_and_tokenizer(seed=0, n_layer=2):
+    """A tiny randomly initialized GPT (with GQA) on CPU."""
+    tokenizer = MockTokenizer()
+    torch.manual_seed(seed)
+    config = GPTConfig(sequence_len=64, vocab_size=tokenizer.get_vocab_size(), n_layer=n_layer, n_head=4, n_kv_head=2, n_embd=32)
+    model = GPT(config)
+    model.init_weights()
+    # init_weights zeros out the output projections, give them some signal so that decoding is not trivial
+    torch.nn.init.normal_(model.lm_head.weight, std=0.5)
+    for block in model.transformer.h:
+        torch.nn.init.normal_(block.attn.c_proj.weight, std=0.1)
+        torch.nn.init.normal_(block.mlp.c_proj.weight, std=0.1)
+    model.eval()
+    return model, tokenizer
+
+def make_prompts(tokenizer):
+    bos = tokenizer.get_bos_token_id()
+    texts = ["The chemical formula of water is", "Hi", "If 5*x + 3 = 13, then x is", "abc"]
+    return [[bos] + tokenizer.encode(text) for text in texts]
 
 def test_kv_cache_resize():
     """
@@ -64,3 +115,756 @@ def test_kv_cache_resize():
             original_v = original_cache[layer_idx, 1, :, :, token_idx, :]
             assert (actual_k == original_k).all(), f"Layer {layer_idx}, token {token_idx}: key doesn't match original"
             assert (actual_v == original_v).all(), f"Layer {layer_idx}, token {token_idx}: value doesn't match original"
+
+
+def test_scheduler_matches_generate():
+    """Continuous batching of ragged requests must produce the same greedy tokens as one-at-a-time generation."""
+    model, tokenizer = build_model_and_tokenizer()
+    engine = Engine(model, tokenizer)
+    prompts = make_prompts(tokenizer)
+    expected = []
+    for prompt in prompts:
+        expected.append([column[0] for column, _ in engine.generate(prompt, max_tokens=10, temperature=0.0)])
+
+    # fewer slots than requests, so that requests get admitted while others are mid-flight
+    for prefill_chunk_size in [None, 4]: # with chunked prefill, prompts take several steps to get in
+        engine.prefill_chunk_size = prefill_chunk_size
+        scheduler = Scheduler(engine, max_batch_size=2)
+        requests = [scheduler.add_request(prompt, max_tokens=10 - i, temperature=0.0) for i, prompt in enumerate(prompts)]
+        produced = {request.request_id: [] for request in requests}
+        while scheduler.has_work():
+            for request, token, mask in scheduler.step():
+                produced[request.request_id].append(token)
+        for i, request in enumerate(requests):
+            assert produced[request.request_id] == expected[i][:10 - i], f"Request {i} diverged from Engine.generate"
+
+
+def test_paged_kv_cache_copy_on_write():
+    """Forked rows share the prompt blocks until they write into them, and blocks go back to the pool."""
+    num_heads, head_dim, num_layers, block_size = 2, 4, 3, 4
+    pool = KVBlockPool(num_heads=num_heads, head_dim=head_dim, num_layers=num_layers, block_size=block_size, num_blocks=2)
+
+    def insert(rows, values):
+        # insert one token per row, with a distinct fill value per row, into all layers
+        kv_cache = PagedKVCache(pool, rows)
+        for layer_idx in range(num_layers):
+            k = torch.stack([torch.full((num_heads, 1, head_dim), float(x)) for x in values])
+            keys, values_ = kv_cache.insert_kv(layer_idx, k, -k)
+        return keys
+
+    # a prompt of 6 tokens spans one full block and one partial block
+    prompt = BlockTable(pool)
+    for t in range(6):
+        insert([prompt], [t])
+    assert prompt.length == 6 and len(prompt.blocks) == 2
+    rows = [prompt] + [prompt.fork() for _ in range(2)]
+    assert all(pool.refcount[b] == 3 for b in prompt.blocks)
+
+    # each row writes its own token: the partial block gets copied, the full block stays shared
+    keys = insert(rows, [100, 200, 300]) # (B, H, Tk, D)
+    assert keys.shape == (3, num_heads, 7, head_dim)
+    for i, x in enumerate([100, 200, 300]):
+        assert (keys[i, :, :6] == torch.arange(6.0)[None, :, None]).all(), "shared prefix got corrupted"
+        assert (keys[i, :, 6] == x).all()
+    assert pool.refcount[rows[0].blocks[0]] == 3
+    assert len({row.blocks[1] for row in rows}) == 3
+    assert pool.num_blocks() >= 4 # the arena had to grow to fit the copies
+
+    # rows can be rolled back and released, after which every block is free again
+    rows[1].truncate(3)
+    assert rows[1].length == 3 and len(rows[1].blocks) == 1
+    for row in rows:
+        row.release()
+    assert pool.num_free_blocks() == pool.num_blocks()
+
+
+def test_prefix_cache():
+    """The radix tree returns the longest cached prefix in whole blocks, splits edges and evicts by LRU."""
+    block_size = 4
+    pool = KVBlockPool(num_heads=1, head_dim=2, num_layers=1, block_size=block_size, num_blocks=16)
+    pool.init_arena(torch.float32, torch.device("cpu"))
+    bytes_per_block = 2 * block_size * 2 * 4
+    prefix_cache = PrefixCache(pool, max_bytes=6 * bytes_per_block)
+
+    def make_row(tokens):
+        row = prefix_cache.match(tokens)
+        row.prepare_write(len(tokens) - row.length) # (pretend to) prefill the rest
+        row.length = len(tokens)
+        prefix_cache.insert(tokens, row.blocks)
+        return row
+
+    a = list(range(10)) # 2 full blocks + 2 tokens
+    row_a = make_row(a)
+    assert prefix_cache.num_blocks == 2
+    # shares the first block with a, then diverges: the edge gets split
+    b = list(range(4)) + [100 + i for i in range(8)]
+    row_b = make_row(b)
+    assert row_b.blocks[0] == row_a.blocks[0] and row_b.blocks[1] != row_a.blocks[1]
+    assert prefix_cache.num_blocks == 4
+    match = prefix_cache.match(a + [7, 7, 7])
+    assert match.length == 8 and match.blocks == row_a.blocks[:2]
+    match.release()
+    for row in (row_a, row_b):
+        row.release()
+    # the tree keeps its blocks alive after the rows are gone
+    assert pool.num_free_blocks() == pool.num_blocks() - 4
+    # going over the budget evicts the least recently used blocks (b's tail, a was matched more recently)
+    c = [200 + i for i in range(12)]
+    make_row(c).release()
+    assert prefix_cache.num_blocks == 6
+    assert prefix_cache.match(b).length == 8 # was 12 before the eviction
+    assert prefix_cache.match(a).length == 8
+
+def test_engine_prefix_cache_reuse():
+    """Generating with a prefix cache gives the same tokens as without, and a follow-up turn reuses the KV."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompt = make_prompts(tokenizer)[2]
+    reference = Engine(model, tokenizer).generate_batch(prompt, max_tokens=8, temperature=0.0)[0][0]
+    engine = Engine(model, tokenizer, kv_block_size=4, prefix_cache_bytes=1024**2)
+    first = engine.generate_batch(prompt, max_tokens=8, temperature=0.0)[0][0]
+    second = engine.generate_batch(prompt, max_tokens=8, temperature=0.0)[0][0]
+    assert first == reference and second == reference
+    follow_up = first + tokenizer.encode("ok")
+    row = engine.prefix_cache.match(follow_up)
+    assert row.length >= (len(first) - 1) // 4 * 4 - 4 # all but the partial tail of the first turn
+    row.release()
+
+def test_speculative_decoding_greedy():
+    """With greedy decoding, speculation must not change a single token, whatever the draft proposes."""
+    model, tokenizer = build_model_and_tokenizer()
+    draft_model, _ = build_model_and_tokenizer(seed=1, n_layer=1)
+    prompt = make_prompts(tokenizer)[0]
+    reference = Engine(model, tokenizer).generate_batch(prompt, num_samples=2, max_tokens=20, temperature=0.0)[0]
+    for draft in [model, draft_model]: # a perfect draft (everything accepted) and a poor one (mostly rejected)
+        engine = Engine(model, tokenizer, draft_model=draft, num_draft_tokens=3)
+        results = engine.generate_batch(prompt, num_samples=2, max_tokens=20, temperature=0.0)[0]
+        assert results == reference
+        assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks() # rolled back blocks go back to the pool
+    # the draft keeps its KV like the model does, and prefills in the same chunks
+    engine = Engine(model, tokenizer, draft_model=draft_model, kv_dtype="int8", prefill_chunk_size=8)
+    assert engine.draft.kv_dtype == "int8" and engine.draft.prefill_chunk_size == 8
+    engine.generate_batch(prompt, num_samples=2, max_tokens=8, temperature=0.0)
+    assert engine.draft.kv_pool.kv_dtype == "int8"
+
+def test_speculative_decoding_ragged_acceptance():
+    """In a batch, each row keeps as many speculated tokens as it accepted, and the greedy outputs don't change."""
+    model, tokenizer = build_model_and_tokenizer()
+    # a noisy copy of the model as the draft: it agrees with the model often, but not always, so rows accept different numbers of tokens
+    draft_model, _ = build_model_and_tokenizer()
+    with torch.no_grad():
+        draft_model.lm_head.weight.add_(0.3 * torch.randn_like(draft_model.lm_head.weight))
+    prompts = make_prompts(tokenizer)
+    expected = Engine(model, tokenizer).generate_many_batch(prompts, max_tokens=20, temperature=0.0)
+    engine = Engine(model, tokenizer, draft_model=draft_model, num_draft_tokens=3)
+    run_lengths = []
+    speculate = engine._speculate
+    def recording_speculate(*args, **kwargs):
+        speculation = speculate(*args, **kwargs)
+        run_lengths.append([len(run) for run in speculation[0]])
+        return speculation
+    engine._speculate = recording_speculate
+    assert engine.generate_many_batch(prompts, max_tokens=20, temperature=0.0) == expected
+    assert any(len(set(lengths)) > 1 for lengths in run_lengths)
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
+    assert engine.draft.kv_pool.num_free_blocks() == engine.draft.kv_pool.num_blocks()
+
+def test_prompt_lookup_decoding():
+    """Prompt lookup proposes what followed the last n-gram match, and verification keeps greedy outputs exact."""
+    assert prompt_lookup([1, 2, 3, 4, 1, 2], 3, 2) == [3, 4]
+    assert prompt_lookup([1, 2, 3, 9, 2, 3], 3, 5) == [9, 2, 3]
+    assert prompt_lookup([5, 6, 7], 3, 4) == []
+    model, tokenizer = build_model_and_tokenizer()
+    prompt = make_prompts(tokenizer)[2] + make_prompts(tokenizer)[2][1:] # repetitive prompt, so that there are matches
+    reference = Engine(model, tokenizer).generate_batch(prompt, num_samples=2, max_tokens=20, temperature=0.0)[0]
+    engine = Engine(model, tokenizer, prompt_lookup_ngram=3, num_draft_tokens=4)
+    assert engine.generate_batch(prompt, num_samples=2, max_tokens=20, temperature=0.0)[0] == reference
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
+
+def test_prompt_lookup_rows_without_match():
+    """In a batch, the rows that have nothing to propose don't speculate: they take a plain decode step."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)
+    prompts = [prompts[2] + prompts[2][1:], prompts[3]] # a repetitive prompt (matches) and a short one (no match at first)
+    engine = Engine(model, tokenizer, prompt_lookup_ngram=3, num_draft_tokens=4)
+    num_without_match = 0
+    speculate = engine._speculate
+    def checking_speculate(rows, draft_rows, row_states, *args):
+        nonlocal num_without_match
+        continuations = [prompt_lookup(state.current_tokens, 3, 4) for state in row_states]
+        speculation = speculate(rows, draft_rows, row_states, *args)
+        if speculation is None: # no row had a match, the step falls back to a plain decode
+            assert not any(continuations)
+            num_without_match += len(continuations)
+            return None
+        for continuation, run in zip(continuations, speculation[0]):
+            assert len(run) <= len(continuation) + 1
+            num_without_match += not continuation
+        return speculation
+    engine._speculate = checking_speculate
+    expected = Engine(model, tokenizer).generate_many_batch(prompts, max_tokens=20, temperature=0.0)
+    assert engine.generate_many_batch(prompts, max_tokens=20, temperature=0.0) == expected
+    engine.generate_many_batch(prompts, max_tokens=20, temperature=1.0) # (the padding is never accepted when sampling either)
+    assert num_without_match > 0
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
+
+def test_generate_many_matches_generate():
+    """A ragged batch of prompts gives the same greedy tokens as generating for each prompt on its own."""
+    model, tokenizer = build_model_and_tokenizer()
+    engine = Engine(model, tokenizer)
+    prompts = make_prompts(tokenizer)
+    expected = [engine.generate_batch(prompt, max_tokens=10, temperature=0.0) for prompt in prompts]
+    results, masks = engine.generate_many_batch(prompts, num_samples=2, max_tokens=10, temperature=0.0)
+    for i in range(len(prompts)):
+        assert results[i] == expected[i][0] * 2
+        assert masks[i] == expected[i][1] * 2
+    # and with sampling, the first token is sampled independently for each row
+    first_tokens = [column for column, _ in engine.generate(prompts[1], num_samples=16, max_tokens=1, temperature=2.0)][0]
+    assert len(set(first_tokens)) > 1
+    # chunked prefill doesn't change anything either
+    engine.prefill_chunk_size = 5
+    assert engine.generate_many_batch(prompts, num_samples=2, max_tokens=10, temperature=0.0) == (results, masks)
+
+def test_forward_logits_positions_and_vocab_subset():
+    """Restricting the lm_head to some positions/columns gives the same logits as slicing the full ones."""
+    model, tokenizer = build_model_and_tokenizer()
+    ids = torch.randint(0, 256, (3, 10))
+    with torch.no_grad():
+        full = model(ids)
+        assert torch.allclose(model(ids, logits_positions=[-1]), full[:, -1:])
+        positions = torch.tensor([[2, 9], [0, 5], [7, 7]])
+        assert torch.allclose(model(ids, logits_positions=positions), full.gather(1, positions[:, :, None].expand(-1, -1, full.size(-1))))
+        subset = [65, 66, 67, 68]
+        assert torch.allclose(model(ids, logits_positions=positions[:, :1], vocab_subset=subset), full[torch.arange(3)[:, None], positions[:, :1]][..., subset])
+
+def test_kv_block_pool_int8():
+    """Int8 KV storage dequantizes to within half a quantization step, at a fraction of the memory."""
+    num_heads, head_dim, num_layers, block_size = 2, 64, 1, 4 # a realistic head_dim, the scales are per head
+    pools = {kv_dtype: KVBlockPool(num_heads, head_dim, num_layers, block_size=block_size, num_blocks=2, kv_dtype=kv_dtype) for kv_dtype in [None, "int8"]}
+    k, v = torch.randn(1, 8, num_heads, head_dim), torch.randn(1, 8, num_heads, head_dim)
+    blocks, offsets = torch.tensor([[0] * 4 + [1] * 4]), torch.arange(8).remainder(4)[None]
+    for pool in pools.values():
+        pool.init_arena(torch.float32, torch.device("cpu"))
+        pool.store(0, k, v, blocks, offsets)
+    k_fp, v_fp = pools[None].load(0, torch.tensor([[0, 1]]), torch.float32)
+    assert torch.equal(k_fp, k) and torch.equal(v_fp, v)
+    k_q, v_q = pools["int8"].load(0, torch.tensor([[0, 1]]), torch.float32)
+    for x, x_q in ((k, k_q), (v, v_q)):
+        half_step = x.abs().amax(dim=-1, keepdim=True) / 127 / 2
+        assert ((x - x_q).abs() <= half_step + 1e-6).all()
+    # one byte per element plus a fp32 scale per (token, head), against four bytes per element
+    assert pools["int8"].bytes_per_block() * 4 * head_dim == pools[None].bytes_per_block() * (head_dim + 4)
+    assert pools["int8"].bytes_per_block() < pools[None].bytes_per_block() / 3
+    # the whole engine runs on the quantized cache too
+    model, tokenizer = build_model_and_tokenizer()
+    results, _ = Engine(model, tokenizer, kv_dtype="int8").generate_batch(make_prompts(tokenizer)[0], num_samples=2, max_tokens=8, temperature=0.0)
+    assert len(results) == 2
+
+def test_kv_block_pool_max_blocks():
+    """A capped pool reads a row's consecutive blocks as a view, reclaims then raises when full, and is freed by release."""
+    pool = KVBlockPool(num_heads=1, head_dim=2, num_layers=1, block_size=4, num_blocks=4, max_blocks=4)
+    pool.init_arena(torch.float32, torch.device("cpu"))
+    row = BlockTable(pool)
+    row.prepare_write(12)
+    assert row.blocks == [0, 1, 2]
+    k, v = pool.load(0, range(0, 3), torch.float32)
+    assert k.shape == (1, 12, 1, 2) and k.data_ptr() == pool.arena.data_ptr() # no copy
+    other = BlockTable(pool)
+    other.prepare_write(4)
+    reclaimed = []
+    pool.reclaim = lambda: reclaimed.append(True)
+    try:
+        other.prepare_write(8)
+        assert False, "the pool should be out of blocks"
+    except RuntimeError:
+        pass
+    assert reclaimed and pool.num_blocks() == 4 # never grew
+    # the prefix cache gives back its least recently used blocks when the pool runs out
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)
+    engine = Engine(model, tokenizer, kv_block_size=4, prefix_cache_bytes=1024**2, kv_pool_blocks=16)
+    for prompt in prompts:
+        engine.generate_batch(prompt, max_tokens=16, temperature=0.0) # ~30 blocks in total would go to the prefix cache
+    assert engine.kv_pool.num_blocks() == 16 and engine.prefix_cache.num_blocks < 16
+    engine.release()
+    assert engine.kv_pool is None and engine.prefix_cache is None
+
+def test_decode_on_device():
+    """Draining the tokens every few steps gives the same generations as syncing every step."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)
+    expected = Engine(model, tokenizer).generate_many_batch(prompts, num_samples=2, max_tokens=15, temperature=0.0)
+    engine = Engine(model, tokenizer, sync_every=4)
+    assert engine.generate_many_batch(prompts, num_samples=2, max_tokens=15, temperature=0.0) == expected
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks() - 1 # all but the scratch block
+
+def test_decode_on_device_stops_at_tool_call():
+    """The device loop ends at the step where a row closes a tool call, the steps after it would be thrown away."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompt = make_prompts(tokenizer)[0]
+    greedy = Engine(model, tokenizer).generate_batch(prompt, max_tokens=12, temperature=0.0)[0][0][len(prompt):]
+    # pretend that a token the model is about to generate closes a tool call
+    tokenizer.special["<|python_end|>"] = greedy[5]
+    engine = Engine(model, tokenizer)
+    with torch.inference_mode():
+        rows, _ = engine.prefill_rows([prompt])
+        ids = torch.tensor([[greedy[0]]])
+        columns = engine._decode_on_device(rows, [RowState(prompt + greedy[:1])], ids, torch.Generator(), 0.0, None, 10)
+    assert [column[0] for column in columns] == greedy[1:greedy.index(greedy[5], 1) + 1]
+    assert rows[0].length == len(prompt) + len(columns)
+    rows[0].release()
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks() - 1 # all but the scratch block
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA")
+def test_decode_on_device_syncs_once():
+    """On CUDA, the device loop syncs with the host as many times for 8 steps as for 2: none inside the loop."""
+    model, tokenizer = build_model_and_tokenizer()
+    model.to("cuda")
+    prompt = make_prompts(tokenizer)[0]
+    engine = Engine(model, tokenizer)
+    num_syncs = []
+    for num_steps in (2, 8):
+        with torch.inference_mode():
+            rows, logits = engine.prefill_rows([prompt])
+            token = int(logits.argmax())
+            ids = torch.tensor([[token]], device="cuda")
+            torch.cuda.set_sync_debug_mode("warn")
+            try:
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter("always")
+                    columns = engine._decode_on_device(rows, [RowState(prompt + [token])], ids, torch.Generator(device="cuda"), 0.0, None, num_steps)
+            finally:
+                torch.cuda.set_sync_debug_mode("default")
+        assert len(columns) == num_steps
+        num_syncs.append(sum("synchroniz" in str(w.message) for w in caught))
+        rows[0].release()
+    assert num_syncs[0] == num_syncs[1]
+
+def test_finished_rows_leave_the_batch():
+    """Rows that complete are no longer forwarded: their blocks go back to the pool and they yield assistant_end."""
+    model, tokenizer = build_model_and_tokenizer()
+    engine = Engine(model, tokenizer)
+    assistant_end = tokenizer.encode_special("<|assistant_end|>")
+    prompt = make_prompts(tokenizer)[0]
+    # make assistant_end compete with the most frequent greedy token, so that sampled rows finish at different times
+    greedy = engine.generate_batch(prompt, max_tokens=30, temperature=0.0)[0][0][len(prompt):]
+    frequent = max(set(greedy), key=greedy.count)
+    with torch.no_grad():
+        model.lm_head.weight[assistant_end] = model.lm_head.weight[frequent]
+    batch_sizes = []
+    forward = model.forward
+    def counting_forward(idx, *args, **kwargs):
+        batch_sizes.append(idx.size(0))
+        return forward(idx, *args, **kwargs)
+    model.forward = counting_forward
+    generator = engine.generate(prompt, num_samples=8, max_tokens=30, temperature=1.0)
+    columns = [next(generator)]
+    batch_sizes.clear() # the prompt prefill is a single row, only the decode steps count
+    columns.extend(generator)
+    model.forward = forward
+    finished = [next((t for t, column in enumerate(columns) if column[0][i] == assistant_end), None) for i in range(8)]
+    for i, t in enumerate(finished):
+        if t is not None:
+            assert all(column[0][i] == assistant_end and column[1][i] == 0 for column in columns[t + 1:])
+    assert any(t is not None for t in finished)
+    assert batch_sizes == sorted(batch_sizes, reverse=True) and batch_sizes[-1] < 8 # the batch only ever shrinks
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
+
+def test_static_decode():
+    """Decode steps over the fixed-shape StaticKVCache (bucketed, padded) produce the same tokens."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)[:3] # batch of 3*2 = 6 rows, padded to a bucket of 8
+    expected = Engine(model, tokenizer).generate_many_batch(prompts, num_samples=2, max_tokens=12, temperature=0.0)
+    engine = Engine(model, tokenizer, kv_block_size=4, compile_decode=True)
+    engine._compiled_forward = model.forward # run the static-shape step eagerly, compilation itself is torch's business
+    assert engine.generate_many_batch(prompts, num_samples=2, max_tokens=12, temperature=0.0) == expected
+    scheduler = Scheduler(engine, max_batch_size=3)
+    requests = [scheduler.add_request(prompt, max_tokens=12, temperature=0.0) for prompt in prompts]
+    while scheduler.has_work():
+        scheduler.step()
+    for i, request in enumerate(requests):
+        # (the request also holds its terminal token, if any)
+        assert request.current_tokens[:len(expected[0][i][0])] == expected[0][i][0]
+
+def test_static_decode_compiled():
+    """The decode step really compiled (fullgraph, static arena and tables) gives the same tokens as eager."""
+    try:
+        torch.compile(lambda x: x * 2, fullgraph=True)(torch.ones(2))
+    except Exception as e: # e.g. no C++ compiler for inductor
+        pytest.skip(f"torch.compile is not available here: {e}")
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)[:3]
+    expected = Engine(model, tokenizer).generate_many_batch(prompts, num_samples=2, max_tokens=12, temperature=0.0)
+    engine = Engine(model, tokenizer, kv_block_size=4, compile_decode=True, kv_pool_blocks=64)
+    assert engine.generate_many_batch(prompts, num_samples=2, max_tokens=12, temperature=0.0) == expected
+    arena = engine.kv_pool.arena
+    engine.sync_every = 4 # the device loop runs through the same compiled step
+    assert engine.generate_many_batch(prompts, num_samples=2, max_tokens=12, temperature=0.0) == expected
+    assert engine.kv_pool.arena is arena # preallocated: never grew, so no recompile for a new arena
+
+def test_beam_search_and_best_of_n():
+    """Beam width 1 is greedy decoding, and beams / samples come back ranked by their logprob under the model."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompt = make_prompts(tokenizer)[0]
+    def sequence_logprob(tokens):
+        with torch.no_grad():
+            logprobs = torch.log_softmax(model(torch.tensor([tokens])).float(), dim=-1)[0]
+        return sum(logprobs[i - 1, tokens[i]].item() for i in range(len(prompt), len(tokens)))
+    engine = Engine(model, tokenizer)
+    greedy = engine.generate_batch(prompt, max_tokens=8, temperature=0.0)[0][0]
+    [(tokens, logprob)] = engine.beam_search(prompt, beam_width=1, max_tokens=8)
+    assert tokens == greedy
+    assert abs(logprob - sequence_logprob(tokens)) < 1e-3
+    beams = engine.beam_search(prompt, beam_width=4, max_tokens=8, length_penalty=0.0)
+    assert len(beams) == 4 and len({tuple(tokens) for tokens, _ in beams}) == 4
+    assert all(a[1] >= b[1] for a, b in zip(beams, beams[1:]))
+    for tokens, logprob in beams:
+        assert abs(logprob - sequence_logprob(tokens)) < 1e-3
+    samples = engine.best_of_n(prompt, n=4, max_tokens=8, temperature=1.0, length_penalty=0.0)
+    assert len(samples) == 4 and all(a[1] >= b[1] for a, b in zip(samples, samples[1:]))
+    for tokens, logprob in samples:
+        assert abs(logprob - sequence_logprob(tokens)) < 1e-3
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks() # the beams returned all their blocks
+
+def test_tool_runner():
+    """Tool calls run off the decode loop: memoized, forced once ready, and a waiting row is paused in the Scheduler."""
+    model, tokenizer = build_model_and_tokenizer()
+    runner = ToolRunner(max_workers=2)
+    assert runner.submit("1+2") is runner.submit("1+2") # memoized, one evaluation
+    assert runner.submit("1+2").result() == 3 and runner.submit("2**100").result() is None
+    engine = Engine(model, tokenizer, tool_runner=runner)
+    special = engine.special_tokens()
+    state = RowState([tokenizer.get_bos_token_id()])
+    for token in [special["python_start"]] + tokenizer.encode("6*7") + [special["python_end"]]:
+        engine.advance_row(state, token)
+    assert state.pending_tool is not None and state.may_force()
+    emitted = [engine.advance_row(state, 65) for _ in range(5)]
+    assert emitted == [(special["output_start"], 0), (ord("4"), 0), (ord("2"), 0), (special["output_end"], 0), (65, 1)]
+    # the Scheduler keeps decoding the other rows while one waits for its tool output
+    scheduler = Scheduler(engine)
+    prompts = make_prompts(tokenizer)
+    requests = [scheduler.add_request(prompt, max_tokens=8, temperature=0.0) for prompt in prompts[:2]]
+    scheduler.step()
+    requests[0].pending_tool = Future()
+    assert [r for r, _, _ in scheduler.step()] == [requests[1]]
+    requests[0].pending_tool.set_result(None)
+    assert [r for r, _, _ in scheduler.step()] == requests
+    runner.shutdown()
+
+def test_tool_runner_errors_and_slow_tools(monkeypatch):
+    """A failing tool outputs its error, and generate keeps decoding the other rows while a tool call is in flight."""
+    runner = ToolRunner(max_workers=1)
+    monkeypatch.setattr("nanochat.engine.use_calculator", lambda expr: 1 / 0)
+    assert runner.submit("1+1").result() == "Error: ZeroDivisionError: division by zero"
+    runner.shutdown()
+    # pretend that two tokens only the first prompt generates open and close a tool call
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)[:2]
+    expected, _ = Engine(model, tokenizer).generate_many_batch(prompts, max_tokens=20, temperature=0.0)
+    first, second = expected[0][0][len(prompts[0]):], expected[1][0][len(prompts[1]):]
+    candidates = [i for i, token in enumerate(first) if token not in second and token not in first[:i]]
+    if len(candidates) < 2 or candidates[1] - candidates[0] < 2:
+        pytest.skip("no tokens to stand in for the tool call")
+    tokenizer.special["<|python_start|>"], tokenizer.special["<|python_end|>"] = first[candidates[0]], first[candidates[1]]
+    class SlowTool:
+        """The output is only there once the model was forwarded a few times with the call in flight."""
+        def __init__(self):
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self.released = threading.Event()
+            self.num_calls = 0
+        def submit(self, expr):
+            self.num_calls += 1
+            return self.executor.submit(lambda: "ready" if self.released.wait(timeout=10) else "timed out")
+    tool = SlowTool()
+    num_forwards = 0
+    forward = model.forward
+    def counting_forward(*args, **kwargs):
+        nonlocal num_forwards
+        if tool.num_calls:
+            num_forwards += 1
+            if num_forwards == 3:
+                tool.released.set()
+        return forward(*args, **kwargs)
+    model.forward = counting_forward
+    results, _ = Engine(model, tokenizer, tool_runner=tool).generate_many_batch(prompts, max_tokens=20, temperature=0.0)
+    model.forward = forward
+    assert tool.num_calls >= 1
+    assert "ready" in tokenizer.decode(results[0][0])
+    assert results[1] == expected[1] # decoded ahead while the tool was running
+
+def test_forced_tokens_in_one_chunk():
+    """Forced tokens are emitted without forward passes, then go into the KV cache in one chunk with the next token."""
+    model, tokenizer = build_model_and_tokenizer()
+    engine = Engine(model, tokenizer)
+    scheduler = Scheduler(engine)
+    prompts = make_prompts(tokenizer)
+    requests = [scheduler.add_request(prompt, max_tokens=12, temperature=0.0) for prompt in prompts[:2]]
+    scheduler.step()
+    forced = tokenizer.encode("42") # e.g. a tool output
+    requests[0].forced_tokens.extend(forced)
+    for token in forced:
+        assert (requests[0], token, 0) in scheduler.step()
+    assert requests[0].kv.length == len(requests[0].current_tokens) - 1 - len(forced) # lagging behind
+    context = requests[0].current_tokens.copy()
+    while scheduler.has_work():
+        scheduler.step()
+    # the continuation is the same as if the forced tokens had been part of the prompt
+    expected = engine.generate_batch(context, max_tokens=12 - 1 - len(forced), temperature=0.0)[0][0]
+    assert requests[0].current_tokens[:len(expected)] == expected
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
+
+def test_process_logits():
+    """Every row of the batch gets its own temperature / top-k / top-p / min-p / penalties, in one vectorized pass."""
+    logits = torch.tensor([0.5, 0.3, 0.15, 0.05]).log().repeat(4, 1)
+    kept = lambda out: torch.isfinite(out).sum(dim=-1).tolist()
+    assert kept(process_logits(logits, temperature=torch.tensor([0.0, 1.0, 1.0, 1.0]))) == [1, 4, 4, 4]
+    assert kept(process_logits(logits, top_k=torch.tensor([2, 0, 1, 3]))) == [2, 4, 1, 3]
+    assert kept(process_logits(logits, top_p=torch.tensor([0.7, 1.0, 0.4, 0.9]))) == [2, 4, 1, 3]
+    assert kept(process_logits(logits, min_p=torch.tensor([0.5, 0.0, 0.7, 0.2]))) == [2, 4, 1, 3]
+    counts = torch.zeros(4, 4)
+    counts[:, 0] = 2
+    out = process_logits(logits, repetition_penalty=torch.tensor([1.0, 2.0, 1.0, 1.0]), frequency_penalty=torch.tensor([0.0, 0.0, 1.0, 0.0]), token_counts=counts)
+    assert torch.allclose(out[0], logits[0]) and torch.allclose(out[3], logits[3])
+    assert torch.isclose(out[1, 0], logits[1, 0] * 2) and torch.isclose(out[2, 0], logits[2, 0] - 2)
+    # a row samples the same tokens with its own generator, whatever else is in the batch
+    def generator(seed):
+        g = torch.Generator()
+        g.manual_seed(seed)
+        return g
+    alone = [sample_rows(logits[:1], [generator(7)]).item() for _ in range(3)]
+    batched = [sample_rows(logits[:3], [generator(1), generator(7), generator(2)])[1].item() for _ in range(3)]
+    assert alone == batched
+    # and greedy rows are greedy
+    assert sample_rows(logits[:2], [generator(0), generator(1)], temperature=0.0).tolist() == [[0], [0]]
+
+def test_scheduler_penalty_counts():
+    """The penalties count the generated tokens (forced ones too) incrementally, one step at a time."""
+    model, tokenizer = build_model_and_tokenizer()
+    scheduler = Scheduler(Engine(model, tokenizer))
+    prompts = make_prompts(tokenizer)
+    requests = [scheduler.add_request(prompt, max_tokens=16, temperature=1.0, frequency_penalty=0.5) for prompt in prompts[:2]]
+    requests.append(scheduler.add_request(prompts[2], max_tokens=16, temperature=1.0)) # no penalty, in the same batch
+    scheduler.step()
+    requests[0].forced_tokens.extend(tokenizer.encode("42"))
+    while scheduler.has_work():
+        scheduler.step()
+        for request in requests:
+            if request.token_counts is not None:
+                generated = request.current_tokens[request.prompt_len:request.prompt_len + request.num_counted]
+                assert request.token_counts.tolist() == torch.bincount(torch.tensor(generated, dtype=torch.long), minlength=tokenizer.get_vocab_size()).float().tolist()
+    assert requests[0].num_counted > 2 # past the forced tokens
+
+def test_constrained_generation():
+    """With a grammar, every sample matches it, and the tokens it leaves no choice about are forced."""
+    import re
+    model, tokenizer = build_model_and_tokenizer()
+    engine = Engine(model, tokenizer)
+    grammar = engine.get_grammar(regex=r"answer: [0-9]{2}(!|\?)")
+    assert engine.get_grammar(regex=r"answer: [0-9]{2}(!|\?)") is grammar # cached
+    prompt = make_prompts(tokenizer)[0]
+    results, masks = engine.generate_batch(prompt, num_samples=4, max_tokens=20, temperature=1.0, grammar=grammar)
+    for result, mask in zip(results, masks):
+        assert re.fullmatch(r"answer: [0-9]{2}(!|\?)", tokenizer.decode(result[len(prompt):]))
+        assert mask[len(prompt):] == [0] * len("answer: ") + [1, 1, 1] # the literal is jumped over
+    # the Scheduler constrains its requests the same way
+    scheduler = Scheduler(engine)
+    request = scheduler.add_request(prompt, max_tokens=20, grammar=grammar)
+    while scheduler.has_work():
+        scheduler.step()
+    assert re.fullmatch(r"answer: [0-9]{2}(!|\?)", tokenizer.decode(request.current_tokens[len(prompt):]))
+    # a grammar compiled elsewhere (as by chat_web) goes to another process without its vocab, the Engine gives it its own
+    import pickle
+    from nanochat.grammar import Grammar
+    sent = pickle.loads(pickle.dumps(Grammar(r"[ab]+", engine.token_vocab()).precompute()))
+    assert sent.vocab is None
+    adopted = engine.add_grammar(sent)
+    assert adopted is sent and adopted.vocab is engine.token_vocab() and engine.get_grammar(regex=r"[ab]+") is adopted
+    results, _ = engine.generate_batch(prompt, max_tokens=5, temperature=1.0, grammar=adopted)
+    assert re.fullmatch(r"[ab]+", tokenizer.decode(results[0][len(prompt):]))
+
+def test_score():
+    """Engine.score matches the logprobs of a plain forward over context + continuation."""
+    model, tokenizer = build_model_and_tokenizer()
+    engine = Engine(model, tokenizer, prefill_chunk_size=3)
+    prompts = make_prompts(tokenizer)
+    contexts = [prompts[0], prompts[0], prompts[1], prompts[2], prompts[0]]
+    continuations = [[65], [66, 67, 68], [69, 70], list(range(97, 105)), [65]]
+    scores = engine.score(contexts, continuations, batch_size=2)
+    for context, continuation, (logprob, mean_logprob, greedy) in zip(contexts, continuations, scores):
+        tokens = context + continuation
+        with torch.no_grad():
+            logits = model(torch.tensor([tokens]))[0, len(context) - 1:-1].float()
+        expected = torch.log_softmax(logits, dim=-1).gather(1, torch.tensor(continuation)[:, None]).sum().item()
+        assert abs(logprob - expected) < 1e-3 and abs(mean_logprob - expected / len(continuation)) < 1e-3
+        assert greedy == (logits.argmax(dim=-1).tolist() == continuation)
+    # the greedy continuation is flagged as such
+    greedy_tokens = engine.generate_batch(prompts[3], max_tokens=5, temperature=0.0)[0][0][len(prompts[3]):]
+    assert engine.score([prompts[3]], [greedy_tokens])[0][2]
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
+
+def test_generation_stats():
+    """The hooks see every prefill, step and finished generation, and the token counts add up."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)
+    engine = Engine(model, tokenizer)
+    records = []
+    class Recorder:
+        def on_step(self, record):
+            records.append(record)
+    engine.add_hook(Recorder())
+    stats = engine.add_hook(GenerationStats())
+    results, masks = engine.generate_many_batch(prompts, num_samples=2, max_tokens=6, temperature=0.0)
+    summary = stats.summary()
+    num_generated = sum(len(tokens) - len(prompt) for prompt, samples in zip(prompts, results) for tokens in samples)
+    assert summary["num_prefills"] == 1 and summary["prefill_tokens"] == sum(len(prompt) for prompt in prompts)
+    assert summary["num_finished"] == 2 * len(prompts) and summary["generated_tokens"] >= num_generated # (+ terminal tokens)
+    assert summary["num_steps"] == len(records) and 0 < summary["batch_occupancy"] <= 2 * len(prompts)
+    # every step after the first column (which comes from the prefill) is accounted for
+    assert summary["sampled_tokens"] + summary["forced_tokens"] == summary["generated_tokens"] - 2 * len(prompts)
+    assert all(record["kv_bytes"] > 0 and record["time"] >= 0 for record in records)
+    # the Scheduler emits the same records, one on_finish per request
+    stats.reset()
+    scheduler = Scheduler(engine, max_batch_size=2)
+    requests = [scheduler.add_request(prompt, max_tokens=5, temperature=0.0) for prompt in prompts]
+    while scheduler.has_work():
+        scheduler.step()
+    summary = stats.summary()
+    assert summary["num_finished"] == len(prompts) and summary["generated_tokens"] == sum(r.num_generated for r in requests)
+    assert summary["prefill_tokens"] == sum(len(prompt) for prompt in prompts) and summary["ttft_p50"] > 0
+    assert summary["sampled_tokens"] + summary["forced_tokens"] == summary["generated_tokens"] - len(prompts)
+
+def test_session():
+    """A Session only forwards the new tokens of each turn, and matches generating from the whole history."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)
+    forward = model.forward
+    forwarded = [] # number of tokens of each forward pass
+    model.forward = lambda ids, **kwargs: (forwarded.append(ids.size(1)), forward(ids, **kwargs))[1]
+    for prompt_lookup_ngram in [0, 2]: # plain decoding, then speculative
+        engine = Engine(model, tokenizer, kv_block_size=4, prompt_lookup_ngram=prompt_lookup_ngram)
+        session = Session(engine)
+        turns = []
+        for prompt in prompts[:3]:
+            turns.append(len(session.tokens))
+            session.extend(prompt)
+            history = session.tokens.copy()
+            expected = engine.generate_batch(history, max_tokens=6, temperature=0.0)[0][0][len(history):]
+            forwarded.clear()
+            tokens = [token for token, _ in session.generate(max_tokens=6, temperature=0.0)]
+            assert tokens[:len(expected)] == expected and session.tokens == history + tokens
+            # the first forward of a turn is the last token of the previous one (if any) plus the new prompt
+            assert forwarded[0] == len(prompt) + (len(turns) > 1)
+            assert session.row.length == len(session.tokens) - 1
+        # roll back the last turn and redo it, or edit it: only what comes after the change gets forwarded
+        session.truncate(turns[-1] + len(prompts[2]))
+        assert [token for token, _ in session.generate(max_tokens=6, temperature=0.0)] == tokens
+        edited = session.tokens[:turns[-1]] + prompts[1]
+        session.set_tokens(edited)
+        forwarded.clear()
+        list(session.generate(max_tokens=2, temperature=0.0))
+        assert forwarded[0] == len(prompts[1]) - 1 # both prompts start with bos, "Hi" and "If" differ right after it
+        session.close()
+        assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
+    model.forward = forward
+
+def test_kv_window_eviction():
+    """Rows keep their attention sinks and a recent window, with the keys rotated to their new positions."""
+    # with a single layer, the KV of a token only depends on the token and its position: after evictions,
+    # the row must hold what a fresh prefill of the tokens it kept would
+    model, tokenizer = build_model_and_tokenizer(n_layer=1)
+    prompt = make_prompts(tokenizer)[0]
+    engine = Engine(model, tokenizer, kv_block_size=4, kv_window=12, kv_sink_tokens=4)
+    row, logits = engine.prefill_row(prompt)
+    assert row.num_evicted > 0 and row.length == len(prompt) and row.kv_length() <= 4 + 12
+    kept = prompt[:4] + prompt[4 + row.num_evicted:]
+    reference = Engine(model, tokenizer, kv_block_size=4)
+    ref_row, ref_logits = reference.prefill_row(kept)
+    k, v = engine.kv_pool.load(0, torch.tensor([row.blocks]), torch.float32)
+    ref_k, ref_v = reference.kv_pool.load(0, torch.tensor([ref_row.blocks]), torch.float32)
+    assert torch.allclose(v[:, :len(kept)], ref_v[:, :len(kept)])
+    assert torch.allclose(k[:, :len(kept)], ref_k[:, :len(kept)], atol=5e-2) # (the rotary tables are bfloat16)
+    assert torch.allclose(logits, ref_logits, atol=1e-1)
+    row.release()
+    # long generations stay within the window: plain, speculative, continuous batching, sessions
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)
+    for prompt_lookup_ngram in [0, 2]:
+        engine = Engine(model, tokenizer, kv_block_size=4, kv_window=16, kv_sink_tokens=4, prompt_lookup_ngram=prompt_lookup_ngram)
+        stats = engine.add_hook(GenerationStats())
+        results, _ = engine.generate_many_batch(prompts, num_samples=2, max_tokens=80, temperature=1.0)
+        max_blocks = 2 * len(prompts) * (-(-(4 + 16) // 4) + 1) # a block per row may be partially filled
+        assert stats.summary()["kv_bytes_peak"] <= max_blocks * engine.kv_pool.bytes_per_block()
+        assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
+    scheduler = Scheduler(engine, max_batch_size=2)
+    requests = [scheduler.add_request(prompt, max_tokens=60, temperature=1.0) for prompt in prompts]
+    while scheduler.has_work():
+        scheduler.step()
+        assert all(r.kv.kv_length() <= 4 + 16 for r in scheduler.running)
+    session = Session(engine, prompts[0])
+    for _ in session.generate(max_tokens=40, temperature=1.0):
+        assert session.row.kv_length() <= 4 + 16
+    session.truncate(10) # rolled back onto evicted tokens: the session starts over
+    assert session.row.length == 0
+    list(session.generate(max_tokens=4, temperature=1.0))
+    session.close()
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
+
+def test_scheduler_paused_requests():
+    """A paused request sits in the batch with its KV while the others go on, and picks up where it left off."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)[:2]
+    expected = [Engine(model, tokenizer).generate_batch(prompt, max_tokens=8, temperature=0.0)[0][0] for prompt in prompts]
+    scheduler = Scheduler(Engine(model, tokenizer))
+    requests = [scheduler.add_request(prompt, max_tokens=8, temperature=0.0) for prompt in prompts]
+    scheduler.step()
+    requests[0].paused = True
+    assert [r for r, _, _ in scheduler.step()] == [requests[1]]
+    requests[1].paused = True
+    assert not scheduler.can_step() and scheduler.step() == []
+    requests[0].paused = requests[1].paused = False
+    while scheduler.has_work():
+        scheduler.step()
+    for request, tokens in zip(requests, expected):
+        assert request.current_tokens[:len(tokens)] == tokens
+
+def test_scheduler_capped_kv_pool():
+    """With a capped KV pool, the requests that could run out of blocks wait in the queue instead of failing the batch."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)
+    expected = [Engine(model, tokenizer).generate_batch(prompt, max_tokens=10, temperature=0.0)[0][0] for prompt in prompts]
+    # all four requests at once need 29 blocks of 4 tokens, admitted as they come the first two leave room for neither of the others
+    engine = Engine(model, tokenizer, kv_block_size=4, kv_pool_blocks=24)
+    scheduler = Scheduler(engine, max_batch_size=4)
+    requests = [scheduler.add_request(prompt, max_tokens=10, temperature=0.0) for prompt in prompts]
+    scheduler.step()
+    assert len(scheduler.running) + len(scheduler.prefilling) == 2 and len(scheduler.waiting) == 2
+    while scheduler.has_work():
+        scheduler.step()
+    for request, tokens in zip(requests, expected):
+        assert request.current_tokens[:len(tokens)] == tokens
+    assert engine.kv_pool.num_blocks() == 24 and engine.kv_pool.num_free_blocks() == 24
+
+def test_cancellation():
+    """Cancelled requests (or past their deadline) leave at the next step and give their KV back, wherever they were."""
+    model, tokenizer = build_model_and_tokenizer()
+    prompts = make_prompts(tokenizer)
+    engine = Engine(model, tokenizer, kv_block_size=4)
+    scheduler = Scheduler(engine, max_batch_size=2)
+    cancels = [CancelToken() for _ in prompts]
+    requests = [scheduler.add_request(prompt, max_tokens=50, temperature=0.0, cancel=cancel) for prompt, cancel in zip(prompts, cancels)]
+    scheduler.step() # two running, two waiting
+    cancels[0].cancel() # running
+    cancels[2].cancel() # waiting
+    cancels[3].deadline = 0.0 # waiting, long past its deadline
+    emitted = scheduler.step()
+    assert {r.request_id for r, token, _ in emitted if token is None} == {0, 2, 3}
+    assert all(r.cancelled and r.completed for r in (requests[0], requests[2], requests[3])) and not requests[1].cancelled
+    assert {r.request_id for r in scheduler.running} == {1}
+    cancels[1].cancel()
+    assert scheduler.step() == [(requests[1], None, 0)] and not scheduler.has_work()
+    assert engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
+    # generate stops at the next step too
+    cancel = CancelToken()
+    for num_steps, _ in enumerate(engine.generate(prompts[0], num_samples=2, max_tokens=50, temperature=0.0, cancel=cancel), 1):
+        if num_steps == 3:
+            cancel.cancel()
+    assert num_steps == 3 and engine.kv_pool.num_free_blocks() == engine.kv_pool.num_blocks()
@@ -0,0 +1,102 @@
+"""
+Test constrained decoding. Example run:
+
+python -m pytest tests/test_grammar.py -v
+"""
+
+import re
+import json
+import pytest
+from nanochat.grammar import compile_dfa, json_schema_to_regex, Grammar, TokenVocab
+
+def matches(pattern, text):
+    transitions, accepting, state = compile_dfa(pattern)
+    for b in text.encode("utf-8"):
+        state = transitions[state][b] if state >= 0 else -1
+    return state >= 0 and accepting[state]
+
+def build_vocab():
+    """The 256 bytes, a few merges, and a stop token."""
+    token_bytes = [bytes([i]) for i in range(256)] + [b'{"', b"true", b"fa", b"123", b'":', None]
+    encode = lambda text: list(text.encode("utf-8")) # byte-level is enough for jump-forward
+    return TokenVocab(token_bytes, encode, stop_token=len(token_bytes) - 1)
+
+def test_regex_dfa():
+    """The DFA accepts exactly what re.fullmatch accepts."""
+    cases = [
+        (r"[0-9]{3}", ["123", "12", "1234", "abc"]),
+        (r"(true|false)", ["true", "false", "tru", ""]),
+        (r"a(b|c)*d?", ["a", "abcbd", "ad", "abdd"]),
+        (r"\d+(\.\d+)?", ["1", "1.5", "1.", "x"]),
+        (r'"([^"\\]|\\.)*"', ['""', '"a\\"b"', '"é"', '"a"b"']),
+        (r"x{2,}", ["x", "xx", "xxxxx"]),
+        (r"(ab){1,3}c?", ["", "ab", "ababab", "abababab", "abc"]),
+        (r"[^a-c]+", ["def", "dac"]),
+    ]
+    for pattern, texts in cases:
+        for text in texts:
+            assert matches(pattern, text) == bool(re.fullmatch(pattern, text)), (pattern, text)
+
+def test_regex_limits():
+    """The regexes come from clients: the costly and the malformed ones are rejected with a ValueError."""
+    patterns = [
+        r"a{99999999}", # repeat count
+        r"(a|b)*a(a|b){30}", # exponential number of DFA states
+        r"(\d{1,1000}){1,1000}", # NFA size
+        "(" * 1000 + "a" + ")" * 1000, # nesting
+        "a" + "?" * 5000, "(" * 60 + "a" + ")?" * 60, # nesting through chains of quantifiers
+        "a\\", r"\x4", r"a{3,1}", r"(ab", r"[ab",
+    ]
+    for pattern in patterns:
+        with pytest.raises(ValueError):
+            compile_dfa(pattern)
+    deep = {"type": "string"}
+    for _ in range(1000):
+        deep = {"type": "array", "items": deep}
+    schemas = [[1], {"type": "object", "properties": [1]}, {"type": "array", "maxItems": "x"}, {"enum": 3}, {"anyOf": [None]}, deep]
+    for schema in schemas:
+        with pytest.raises(ValueError):
+            json_schema_to_regex(schema)
+    # bounded repeats as large as allowed are fine
+    for n in [0, 1000, 1001]:
+        assert matches(r"x{0,1000}", "x" * n) == (n <= 1000)
+    compile_dfa(json_schema_to_regex({"type": "string", "maxLength": 1000}))
+
+def test_json_schema_to_regex():
+    schema = {"type": "object", "properties": {
+        "name": {"type": "string", "maxLength": 10},
+        "age": {"type": "integer"},
+        "tags": {"type": "array", "items": {"type": "string"}, "maxItems": 3},
+        "ok": {"type": "boolean"},
+        "score": {"type": "number"},
+        "kind": {"enum": ["a", "b"]},
+        "nothing": {"type": "null"},
+    }}
+    pattern = json_schema_to_regex(schema)
+    docs = [
+        {"name": 'bob"x', "age": -12, "tags": [], "ok": True, "score": 1.5e3, "kind": "a", "nothing": None},
+        {"name": "é", "age": 0, "tags": ["a", "b", "c"], "ok": False, "score": -0.25, "kind": "b", "nothing": None},
+    ]
+    for doc in docs:
+        assert matches(pattern, json.dumps(doc, separators=(",", ":"), ensure_ascii=False))
+    assert not matches(pattern, json.dumps(dict(docs[0], tags=["a", "b", "c", "d"]), separators=(",", ":")))
+    assert not matches(pattern, json.dumps(docs[0])) # only compact JSON
+    pattern = json_schema_to_regex({"type": "string", "pattern": "^a|b$"})
+    assert matches(pattern, '"a"') and matches(pattern, '"b"') and not matches(pattern, '"a') and not matches(pattern, 'b"')
+
+def test_token_masks_and_jump_forward():
+    """Allowed tokens per state come from the trie walk, single continuations are forced."""
+    vocab = build_vocab()
+    stop = vocab.stop_token
+    grammar = Grammar(r"(true|false)", vocab)
+    assert set(grammar.allowed_tokens(grammar.start)) == {ord("t"), ord("f"), 257, 258} # t, f, true, fa
+    state = grammar.advance(grammar.start, 258) # "fa"
+    assert grammar.jump_forward(state) == list(b"lse") + [stop]
+    assert grammar.allowed_tokens(grammar.advance(state, ord("l"))) == [ord("s")]
+    assert grammar.jump_forward(grammar.start) == [] # a choice to make
+    mask = grammar.token_mask(grammar.advance(grammar.start, 257), len(vocab.token_bytes), "cpu")
+    assert mask.nonzero().flatten().tolist() == [stop] # "true" is complete, only stopping is left
+    grammar = Grammar.from_json_schema({"type": "object", "properties": {"answer": {"type": "integer"}}}, vocab)
+    assert bytes(grammar.jump_forward(grammar.start)) == b'{"answer":'
+    assert grammar.precompute().advance(grammar.start, 257) == -1 # off the rails
+    assert grammar.allowed_tokens(-1) == [stop]
@@ -0,0 +1,85 @@
+"""
+Test weight-only quantization. Example run:
+
+python -m pytest tests/test_quantize.py -v
+"""
+
+import pytest
+import torch
+import torch.nn.functional as F
+from nanochat.quantize import QuantizedLinear, quantize_model, model_size_bytes
+from nanochat.gpt import GPT, GPTConfig
+
+
+def build_model():
+    torch.manual_seed(0)
+    config = GPTConfig(sequence_len=64, vocab_size=300, n_layer=2, n_head=4, n_kv_head=2, n_embd=64)
+    model = GPT(config)
+    model.init_weights()
+    # init_weights zeros out the output projections, give them some signal
+    torch.nn.init.normal_(model.lm_head.weight, std=0.5)
+    for block in model.transformer.h:
+        torch.nn.init.normal_(block.attn.c_proj.weight, std=0.1)
+        torch.nn.init.normal_(block.mlp.c_proj.weight, std=0.1)
+    model.eval()
+    return model
+
+
+def test_quantized_linear():
+    """Dequantized weights are within half a quantization step, and forward matches the dequantized matmul."""
+    torch.manual_seed(0)
+    weight = torch.randn(48, 64)
+    x = torch.randn(3, 5, 64)
+    for bits, group_size, max_q in [(8, 64, 127), (4, 32, 7)]:
+        layer = QuantizedLinear(weight, bits=bits, group_size=group_size)
+        w = layer.dequantize()
+        half_step = weight.view(48, -1, layer.group_size).abs().amax(dim=-1, keepdim=True) / max_q / 2
+        assert ((weight - w).view(48, -1, layer.group_size).abs() <= half_step + 1e-6).all()
+        if bits == 8:
+            assert torch.allclose(layer(x), F.linear(x, w), atol=1e-4)
+        elif layer.int4_kernel("cpu", x.dtype):
+            # int4 on CPU goes through the fused kernel
+            expected = F.linear(x, w)
+            assert (layer(x) - expected).abs().max() <= 0.02 * expected.abs().max()
+        else:
+            # ...or not at all: dequantizing on every forward is slower than the unquantized model
+            with pytest.raises(RuntimeError):
+                layer(x)
+            with pytest.raises(ValueError):
+                quantize_model(build_model(), bits=4, group_size=32)
+    # int4 packs two weights per byte
+    assert QuantizedLinear(weight, bits=4, group_size=16).qweight.numel() == weight.numel() // 2
+
+
+def test_quantize_model():
+    """A quantized GPT is smaller and its logits stay close to the original ones."""
+    model = build_model()
+    ids = torch.randint(0, 300, (2, 16))
+    with torch.no_grad():
+        reference = model(ids)
+        size_before = model_size_bytes(model)
+        quantize_model(model, bits=8, include_lm_head=True, group_size=32)
+        assert isinstance(model.lm_head, QuantizedLinear) and isinstance(model.transformer.h[0].attn.c_q, QuantizedLinear)
+        assert model_size_bytes(model) < size_before
+        logits = model(ids)
+        assert (logits - reference).abs().max() < 0.1 * reference.abs().max()
+        assert (logits.argmax(-1) == reference.argmax(-1)).float().mean() > 0.9
+        # the lm_head weight slicing of vocab_subset still works
+        assert torch.allclose(model(ids, logits_positions=[-1], vocab_subset=[1, 2, 3]), logits[:, -1:, [1, 2, 3]], atol=1e-4)
+
+
+def test_quantized_linear_rows_and_kernels():
+    """Dequantizing some rows only matches the full weights, and the fused kernels match the dequantized matmul."""
+    torch.manual_seed(0)
+    weight = torch.randn(64, 128)
+    rows = torch.tensor([3, 0, 17])
+    for bits in (8, 4):
+        layer = QuantizedLinear(weight, bits=bits, group_size=32)
+        assert torch.equal(layer.dequantize(rows=rows), layer.dequantize()[rows])
+    if torch.cuda.is_available():
+        x = torch.randn(5, 128, device="cuda", dtype=torch.bfloat16)
+        for bits in (8, 4):
+            layer = QuantizedLinear(weight, bits=bits, group_size=32).cuda()
+            expected = F.linear(x, layer.dequantize(torch.bfloat16))
+            assert (layer(x) - expected).abs().max() <= 0.02 * expected.abs().max()
+            assert (layer._dequantized is not None) == (bits == 8) # int8 on CUDA dequantizes once and keeps it